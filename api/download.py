@@ -1,71 +1,154 @@
 import sys
 import os
+import json
 from pathlib import Path
+from email.utils import formatdate
+from urllib.parse import quote
 
 # Add the project root to the path
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-from backend.app import app, extractor
-from flask import send_file
+import time
+from backend.app import (
+    app, extractor, disk_quota, artifacts, artifact_etag, artifact_not_modified, artifact_byte_range, metrics,
+    ARTIFACT_CHUNK_SIZE, FILE_EXPIRY
+)
+from http.server import BaseHTTPRequestHandler
 
-def handler(req):
-    """Vercel serverless function handler for /api/download/<task_id>"""
-    with app.app_context():
+class handler(BaseHTTPRequestHandler):
+    """Vercel serverless function handler for /api/download/<task_id>
+
+    Streams the file in fixed-size chunks (or with sendfile where the socket
+    supports it), so memory use does not depend on the file size. Supports
+    Range, If-Range, If-None-Match and If-Modified-Since.
+    """
+
+    headers_sent = False
+
+    def end_headers(self):
+        super().end_headers()
+        self.headers_sent = True
+
+    def send_json(self, status, body):
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    def do_GET(self):
         try:
-            # Extract task_id from the URL path
-            path = req.url.split('/')
-            if len(path) < 3:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app'},
-                    'body': {'error': 'Task ID is required'}
-                }
-            
-            task_id = path[-1]  # Get the last part of the path
-            
-            if task_id not in extractor.active_downloads:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app'},
-                    'body': {'error': 'Task not found'}
-                }
-            
-            task = extractor.active_downloads[task_id]
-            
-            if task['status'] != 'completed':
-                return {
-                    'statusCode': 400,
-                    'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app'},
-                    'body': {'error': 'Download not completed'}
-                }
-            
-            file_path = task.get('file_path')
-            if not file_path or not Path(file_path).exists():
-                return {
-                    'statusCode': 404,
-                    'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app'},
-                    'body': {'error': 'Downloaded file not found'}
-                }
-            
-            # For Vercel, we need to return the file content as binary
-            with open(file_path, 'rb') as f:
-                file_content = f.read()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Access-Control-Allow-Origin': 'https://carbalite.vercel.app',
-                    'Content-Type': 'application/octet-stream',
-                    'Content-Disposition': f'attachment; filename="{task.get("filename", "download")}"'
-                },
-                'body': file_content,
-                'isBase64Encoded': True
-            }
-            
+            with app.app_context():
+                # Extract task_id from the URL path
+                task_id = self.path.split('?')[0].rstrip('/').split('/')[-1]
+                if not task_id or task_id == 'download':
+                    self.send_json(400, {'error': 'Task ID is required'})
+                    return
+
+                task = extractor.tasks.get(task_id)
+                if task is None:
+                    self.send_json(404, {'error': 'Task not found'})
+                    return
+
+                if task['status'] != 'completed':
+                    self.send_json(400, {'error': 'Download not completed'})
+                    return
+
+                if task.get('artifact_key'):
+                    # In object storage: send the client straight to the bucket
+                    filename = task.get('filename', 'download')
+                    url = artifacts.presigned_url(
+                        task['artifact_key'], filename, True, 'application/octet-stream'
+                    )
+                    if not url:
+                        self.send_json(404, {'error': 'Downloaded file not found'})
+                        return
+                    extractor.tasks.update(task_id, {'last_accessed_at': time.time()}, ttl=FILE_EXPIRY)
+                    self.send_response(302)
+                    self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
+                    self.send_header('Location', url)
+                    self.send_header('Cache-Control', 'no-store')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                file_path = task.get('file_path')
+                if not file_path or not Path(file_path).exists():
+                    self.send_json(404, {'error': 'Downloaded file not found'})
+                    return
+
+                # Accessing an artifact keeps it (and its task) alive for another FILE_EXPIRY
+                extractor.tasks.update(task_id, {'last_accessed_at': time.time()}, ttl=FILE_EXPIRY)
+                disk_quota.touch(file_path)
+
+                stat_result = os.stat(file_path)
+                file_size = stat_result.st_size
+                etag = artifact_etag(stat_result)
+                filename = task.get('filename', 'download')
+
+                if artifact_not_modified(
+                    self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since'), etag, stat_result.st_mtime
+                ):
+                    self.send_response(304)
+                    self.send_header('ETag', f'"{etag}"')
+                    self.end_headers()
+                    return
+
+                try:
+                    byte_range = artifact_byte_range(
+                        self.headers.get('Range'), self.headers.get('If-Range'), etag, stat_result.st_mtime, file_size
+                    )
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
+                    self.send_header('Content-Range', f'bytes */{file_size}')
+                    self.end_headers()
+                    return
+
+                start, end = byte_range or (0, file_size - 1)
+                length = end - start + 1 if file_size else 0
+
+                self.send_response(206 if byte_range else 200)
+                self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
+                self.send_header('Access-Control-Expose-Headers', 'Content-Length, Content-Range, Content-Disposition, ETag')
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Disposition', f"attachment; filename*=UTF-8''{quote(filename)}")
+                self.send_header('Content-Length', str(length))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', f'"{etag}"')
+                self.send_header('Last-Modified', formatdate(stat_result.st_mtime, usegmt=True))
+                self.send_header('Cache-Control', f'private, max-age={FILE_EXPIRY}')
+                if byte_range:
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
+                self.end_headers()
+                metrics.served_bytes.inc(length, endpoint='download')
+
+                with open(file_path, 'rb') as f:
+                    try:
+                        # socket.sendfile uses os.sendfile when possible and falls back to send()
+                        self.connection.sendfile(f, offset=start, count=length)
+                    except (AttributeError, ValueError):
+                        f.seek(start)
+                        remaining = length
+                        while remaining > 0:
+                            chunk = f.read(min(ARTIFACT_CHUNK_SIZE, remaining))
+                            if not chunk:
+                                break
+                            self.wfile.write(chunk)
+                            remaining -= len(chunk)
+
         except Exception as e:
-            return {
-                'statusCode': 500,
-                'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app'},
-                'body': {'error': f'Failed to download file: {str(e)}'}
-            }
+            if self.headers_sent:
+                # Mid-body: a JSON error would corrupt the response, so drop the connection instead
+                print(f"Download of {self.path} failed after the response started: {e}")
+                self.close_connection = True
+                return
+            self.send_json(500, {'error': f'Failed to download file: {str(e)}'})
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
+        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Range, If-Range, If-None-Match, If-Modified-Since')
+        self.end_headers()
@@ -1,15 +1,14 @@
 import sys
-import os
 from pathlib import Path
-import uuid
-import threading
 
 # Add the project root to the path
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-from backend.app import app, extractor
-from flask import request, jsonify
+from backend.app import (
+    app, extractor, admission, schedule_extraction, parse_preferences, client_key, queue_full_error,
+    overloaded_payload, invalid_url_message, QueueFullError, InsufficientStorageError, OverloadedError
+)
 
 def handler(req):
     """Vercel serverless function handler for /api/extract"""
@@ -43,18 +42,8 @@ def handler(req):
             media_type = data.get('type', 'audio')
             format_id = data.get('format_id')
             
-            # User preferences from frontend
-            preferences = data.get('preferences', {})
-            preferred_format = None
-            quality_settings = {}
-            
-            if media_type == 'audio':
-                preferred_format = preferences.get('selectedAudioFormat', 'mp3')
-                quality_settings['audioQuality'] = preferences.get('audioQuality', '320k')
-            else:
-                preferred_format = preferences.get('selectedVideoFormat', 'mp4')
-                quality_settings['videoQuality'] = preferences.get('videoQuality', '720p')
-                quality_settings['audioQuality'] = preferences.get('audioQuality', '320k')
+            # User preferences from frontend, normalised like the Flask route so both share dedup keys
+            preferred_format, quality_settings = parse_preferences(media_type, data.get('preferences', {}))
             
             if not url:
                 return {
@@ -67,19 +56,37 @@ def handler(req):
                 return {
                     'statusCode': 400,
                     'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app'},
-                    'body': {'error': 'Invalid YouTube or SoundCloud URL'}
+                    'body': {'error': invalid_url_message(url)}
                 }
             
-            # Generate unique task ID
-            task_id = str(uuid.uuid4())
+            # Queue extraction on the shared worker pool, reusing identical jobs where possible;
+            # the same admission checks as the Flask route
+            try:
+                admission.check_client(client_key(getattr(req, 'headers', None) or {}, getattr(req, 'remote_addr', None)))
+                task_id, queue_position, reused = schedule_extraction(
+                    url, format_id, media_type, preferred_format, quality_settings, check_load=True
+                )
+            except (OverloadedError, QueueFullError) as e:
+                error = queue_full_error(e) if isinstance(e, QueueFullError) else e
+                body, headers = overloaded_payload(error)
+                return {
+                    'statusCode': error.status,
+                    'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app', **headers},
+                    'body': body
+                }
+            except InsufficientStorageError as e:
+                return {
+                    'statusCode': 507,
+                    'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app'},
+                    'body': {'error': f'{str(e)}. Please retry later.'}
+                }
             
-            # Start extraction in background thread with user preferences
-            thread = threading.Thread(
-                target=extractor.extract_raw_media, 
-                args=(url, task_id, format_id, media_type, preferred_format, quality_settings)
-            )
-            thread.daemon = True
-            thread.start()
+            if reused == 'completed':
+                message = f'Media already available with format: {preferred_format}'
+            elif reused == 'running':
+                message = f'Attached to running extraction with format: {preferred_format}'
+            else:
+                message = f'Media extraction queued with format: {preferred_format}'
             
             return {
                 'statusCode': 200,
@@ -89,7 +96,9 @@ def handler(req):
                 },
                 'body': {
                     'task_id': task_id,
-                    'message': f'Media extraction started with format: {preferred_format}',
+                    'message': message,
+                    'queue_position': queue_position,
+                    'deduplicated': reused is not None,
                     'preferences': {
                         'format': preferred_format,
                         'quality': quality_settings
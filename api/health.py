@@ -1,28 +1,21 @@
-import sys
-import os
 import json
-from pathlib import Path
-
-# Add the project root to the path
-project_root = Path(__file__).parent.parent
-sys.path.insert(0, str(project_root))
-
-from backend.app import app, extractor
 from http.server import BaseHTTPRequestHandler
 
+# Liveness only: importing backend.app here would make every health check pay
+# for a full cold start of the extraction backend
+
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
-            with app.app_context():
-                self.send_response(200)
-                self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                response = {
-                    'status': 'healthy', 
-                    'message': 'CarbaLite backend is running on Vercel'
-                }
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+            self.send_response(200)
+            self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            response = {
+                'status': 'healthy', 
+                'message': 'CarbaLite backend is running on Vercel'
+            }
+            self.wfile.write(json.dumps(response).encode('utf-8'))
         except Exception as e:
             self.send_response(500)
             self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
@@ -6,7 +6,7 @@ from pathlib import Path
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-from backend.app import app, extractor
+from backend.app import app, extractor, record_poll, task_queue_info
 
 def handler(req):
     """Vercel serverless function handler for /api/status/<task_id>"""
@@ -23,20 +23,26 @@ def handler(req):
             
             task_id = path[-1]  # Get the last part of the path
             
-            if task_id not in extractor.active_downloads:
+            task = extractor.tasks.get(task_id)
+            if task is None:
                 return {
                     'statusCode': 404,
                     'headers': {'Access-Control-Allow-Origin': 'https://carbalite.vercel.app'},
                     'body': {'error': 'Task not found'}
                 }
             
+            record_poll(task_id, task)
+            queue_info = task_queue_info(task_id)
+            if queue_info:
+                task.update(queue_info)
+            
             return {
                 'statusCode': 200,
                 'headers': {
                     'Access-Control-Allow-Origin': 'https://carbalite.vercel.app',
                     'Content-Type': 'application/json'
                 },
-                'body': extractor.active_downloads[task_id]
+                'body': task
             }
             
         except Exception as e:
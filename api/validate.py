@@ -2,76 +2,117 @@ import sys
 import os
 import json
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs
 
 # Add the project root to the path
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-from backend.app import app, extractor
-from flask import Flask
+from backend.app import (
+    app, extractor, brotli, dumps_json, json_etag, compress_body, project_fields, invalid_url_message,
+    VALIDATE_FIELDS
+)
 from http.server import BaseHTTPRequestHandler
 
 class handler(BaseHTTPRequestHandler):
+    """Vercel serverless function handler for /api/validate
+
+    Same options as the Flask route: fields= (comma-separated keys to
+    return, e.g. title,duration,formats.format_id) and urls=1 (include each
+    format's signed upstream URL), from the query string or the JSON body.
+    Responses carry a weak ETag (GET requests can revalidate with
+    If-None-Match) and are br/gzip compressed when the client accepts it.
+    """
+
+    def send_json(self, status, body):
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
         self.end_headers()
 
+    def do_GET(self):
+        self.validate({})
+
     def do_POST(self):
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(content_length).decode('utf-8')) if content_length else {}
+        except ValueError:
+            self.send_json(400, {'error': 'Invalid JSON body'})
+            return
+        self.validate(data)
+
+    def accepted_encoding(self):
+        """Best of br/gzip the client accepts (ignoring q-values other than q=0)"""
+        accepted = set()
+        for part in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = part.strip().partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(name.strip().lower())
+        for encoding in (('br', 'gzip') if brotli is not None else ('gzip',)):
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def validate(self, data):
         try:
             with app.app_context():
-                # Read request body
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length:
-                    post_data = self.rfile.read(content_length)
-                    data = json.loads(post_data.decode('utf-8'))
-                else:
-                    data = {}
-                
-                url = data.get('url', '').strip()
+                query = {key: values[-1] for key, values in parse_qs(urlparse(self.path).query).items()}
+                url = (data.get('url') or query.get('url', '')).strip()
+                fields = data.get('fields') or query.get('fields', '')
+                if isinstance(fields, str):
+                    fields = [field.strip() for field in fields.split(',') if field.strip()]
+                include_urls = str(data.get('urls', query.get('urls', ''))).lower() in ('1', 'true', 'yes')
                 
                 if not url:
-                    self.send_response(400)
-                    self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    response = {'error': 'URL is required'}
-                    self.wfile.write(json.dumps(response).encode('utf-8'))
+                    self.send_json(400, {'error': 'URL is required'})
                     return
                 
                 if not extractor.is_valid_url(url):
-                    self.send_response(400)
-                    self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    response = {'error': 'Invalid YouTube or SoundCloud URL'}
-                    self.wfile.write(json.dumps(response).encode('utf-8'))
+                    self.send_json(400, {'error': invalid_url_message(url)})
                     return
                 
-                # Get video info
-                video_info = extractor.get_video_info(url)
+                include_urls = include_urls or 'formats.url' in fields
+                unknown = [field for field in fields if field.partition('.')[0] not in VALIDATE_FIELDS]
+                if unknown:
+                    self.send_json(400, {'error': f'Unknown fields: {", ".join(unknown)}'})
+                    return
+                
+                video_info = extractor.get_video_info(url, include_urls=include_urls)
+                if fields:
+                    video_info = project_fields(video_info, fields)
+                
+                body = dumps_json({'valid': True, 'video_info': video_info})
+                etag = f'W/"{json_etag(body)}"'
+                if self.command == 'GET':
+                    if_none_match = self.headers.get('If-None-Match', '')
+                    if etag[2:] in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]:
+                        self.send_response(304)
+                        self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
+                        self.send_header('ETag', etag)
+                        self.send_header('Vary', 'Accept-Encoding')
+                        self.end_headers()
+                        return
                 
+                body, encoding = compress_body(body, self.accepted_encoding())
                 self.send_response(200)
                 self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
                 self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Vary', 'Accept-Encoding')
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
                 self.end_headers()
-                response = {
-                    'valid': True,
-                    'video_info': video_info
-                }
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+                self.wfile.write(body)
                 
         except Exception as e:
-            self.send_response(500)
-            self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            response = {'error': str(e)}
-            self.wfile.write(json.dumps(response).encode('utf-8'))
-
-    def do_GET(self):
-        self.send_response(405)
-        self.send_header('Access-Control-Allow-Origin', 'https://carbalite.vercel.app')
-        self.end_headers()
+            self.send_json(500, {'error': str(e)})
@@ -10,7 +10,7 @@ export default function Home() {
   const [currentPage, setCurrentPage] = useState("save");
   const [url, setUrl] = useState("");
 
-  const { status, processMedia, reset } = useCarbaLite();
+  const { status, processMedia, cancel, reset } = useCarbaLite();
   const { 
     preferences, 
     isLoaded: preferencesLoaded,
@@ -277,6 +277,16 @@ export default function Home() {
                         <div className="text-xs text-gray-500 dark:text-gray-400 mt-2 text-center font-medium">
                           {Math.round(status.progress)}% complete
                         </div>
+                        {status.stage === 'extracting' && (
+                          <div className="mt-3 text-center">
+                            <button
+                              onClick={cancel}
+                              className="text-xs px-3 py-1 rounded-md bg-gray-200 dark:bg-gray-700 text-gray-600 dark:text-gray-400 hover:bg-gray-300 dark:hover:bg-gray-600 transition-colors"
+                            >
+                              Cancel
+                            </button>
+                          </div>
+                        )}
                         {status.videoInfo && (
                           <div className="mt-3 pt-3 border-t border-gray-200 dark:border-gray-700">
                             <div className="text-sm">
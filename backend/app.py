@@ -9,17 +9,77 @@ import re
 import json
 import tempfile
 import shutil
-from pathlib import Path
-from flask import Flask, request, jsonify, send_file, Response
-from flask_cors import CORS
-import yt_dlp
-import requests
-from urllib.parse import urlparse
+import importlib
+import hashlib
+import heapq
+import gzip
+import math
 import uuid
-from datetime import datetime, timedelta
 import threading
 import time
 import io
+import mimetypes
+import subprocess
+import copy
+import atexit
+import signal
+from pathlib import Path
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs, quote
+from flask import Flask, request, jsonify, send_file, Response, redirect
+from flask_cors import CORS
+
+class LazyModule:
+    """Stand-in for a heavy module that is imported on first attribute access
+
+    Keeps cold starts (serverless handlers, /api/health) from paying for
+    yt-dlp, requests or Pillow until a request actually uses them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._missing = False
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    @property
+    def available(self):
+        """Whether the module can be imported (for optional dependencies)"""
+        if self._module is None and not self._missing:
+            try:
+                self._load()
+            except ImportError:
+                self._missing = True
+        return not self._missing
+
+yt_dlp = LazyModule('yt_dlp')
+requests = LazyModule('requests')
+Image = LazyModule('PIL.Image')  # Optional: enables resized and WebP thumbnail variants
+try:
+    import orjson  # Optional: faster serialisation of large JSON payloads
+except ImportError:
+    orjson = None
+try:
+    import brotli  # Optional: br response compression
+except ImportError:
+    brotli = None
+
+# Allow sibling modules to be imported both via `python app.py` and as `backend.app`
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from task_store import create_task_store, TERMINAL_STATUSES, DEFAULT_TASK_TTL
+from media_identity import parse_media_url, media_key
+from artifact_store import create_artifact_store, LocalArtifactStore, ARTIFACT_STORE_BACKEND
+from job_queue import create_job_broker, JOB_QUEUE_BACKEND
+import metrics
 
 app = Flask(__name__)
 
@@ -38,37 +98,1450 @@ if os.getenv('VERCEL_URL'):
 CORS(app, 
      origins=ALLOWED_ORIGINS,  # Allow specific domains
      methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
-     allow_headers=['Content-Type', 'Authorization', 'Accept', 'Origin', 'X-Requested-With'],
-     expose_headers=['Content-Length', 'Content-Type', 'Content-Disposition'],
+     allow_headers=['Content-Type', 'Authorization', 'Accept', 'Origin', 'X-Requested-With',
+                    'Range', 'If-Range', 'If-None-Match', 'If-Modified-Since'],
+     expose_headers=['Content-Length', 'Content-Type', 'Content-Disposition',
+                     'Accept-Ranges', 'Content-Range', 'ETag', 'Last-Modified'],
      supports_credentials=False,
      send_wildcard=False,  # Explicitly disable wildcard
      automatic_options=True  # Handle OPTIONS requests automatically
 )
 
 # Configuration
-DOWNLOAD_DIR = Path("downloads")
-DOWNLOAD_DIR.mkdir(exist_ok=True)
+DOWNLOAD_DIR = Path("downloads")  # Created by start_background_tasks or the first job
+
+# Expired tasks and their files are cleaned up every CLEANUP_INTERVAL seconds
+CLEANUP_INTERVAL = 60  # Expiry lookups are indexed, so checking every minute is cheap
+FILE_EXPIRY = 3600  # Files expire 1 hour after they were last accessed
+
+# Disk quota for DOWNLOAD_DIR
+DISK_QUOTA_BYTES = int(os.getenv('CARBALITE_DISK_QUOTA_BYTES', 10 * 1024 ** 3))  # High-water mark for artifacts
+DISK_LOW_WATER_RATIO = 0.9  # Evict down to 90% of the quota once it is exceeded
+DISK_MIN_FREE_BYTES = int(os.getenv('CARBALITE_DISK_MIN_FREE_BYTES', 1024 ** 3))  # Keep this much free on the volume
+ADMISSION_SAFETY_FACTOR = 2.0  # Source and converted output coexist while postprocessing
+
+# Metadata cache for yt-dlp extract_info results
+METADATA_CACHE_TTL = int(os.getenv('CARBALITE_METADATA_CACHE_TTL', 900))  # 15 minutes
+METADATA_CACHE_MAX_BYTES = int(os.getenv('CARBALITE_METADATA_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+SIGNED_URL_SAFETY_MARGIN = 120  # Expire cached entries 2 minutes before their signed URLs do
+
+# Job scheduler for /api/extract: a large pool for network-bound downloads feeding
+# a CPU-sized pool for ffmpeg transcodes, so both the link and the cores stay busy
+JOB_WORKERS = int(os.getenv('CARBALITE_JOB_WORKERS', 16))
+JOB_QUEUE_MAX_DEPTH = int(os.getenv('CARBALITE_JOB_QUEUE_MAX_DEPTH', 100))
+TRANSCODE_WORKERS = int(os.getenv('CARBALITE_TRANSCODE_WORKERS', os.cpu_count() or 2))
+TRANSCODE_QUEUE_MAX_DEPTH = int(os.getenv('CARBALITE_TRANSCODE_QUEUE_MAX_DEPTH', 100))
+SHUTDOWN_DRAIN_TIMEOUT = int(os.getenv('CARBALITE_SHUTDOWN_DRAIN_TIMEOUT', 30))
+
+# Minimum seconds between progress writes to the task store
+PROGRESS_WRITE_INTERVAL = float(os.getenv('CARBALITE_PROGRESS_WRITE_INTERVAL', 0.5))
+
+# Cancellation and per-stage timeouts for extraction jobs
+METADATA_TIMEOUT = int(os.getenv('CARBALITE_METADATA_TIMEOUT', 60))
+DOWNLOAD_TIMEOUT = int(os.getenv('CARBALITE_DOWNLOAD_TIMEOUT', 1800))
+POSTPROCESS_TIMEOUT = int(os.getenv('CARBALITE_POSTPROCESS_TIMEOUT', 900))
+UPSTREAM_SOCKET_TIMEOUT = 30  # A stalled upstream socket errors out instead of hanging a worker
+ABANDON_GRACE_PERIOD = int(os.getenv('CARBALITE_ABANDON_GRACE_PERIOD', 300))  # 0 disables auto-cancel
+POLL_TOUCH_INTERVAL = 10  # Record client polls at most this often per task
+JOB_MONITOR_INTERVAL = 1  # Seconds between deadline / cancel-request checks on running jobs
+ATTACH_RETRIES = 5  # Attempts to join a shared job whose record keeps changing before starting a new one
+SHARED_TASK_FIELDS = ('attachments',)  # Kept when a job replaces its task record on finishing
+
+# Download acceleration: DASH/HLS fragments fetched concurrently, large progressive
+# files split into parallel range requests. The split needs aria2c on PATH; without it a
+# progressive file still arrives over one connection, only in sequential ranged chunks
+DOWNLOAD_ACCELERATION = os.getenv('CARBALITE_DOWNLOAD_ACCELERATION', '1') == '1'
+DOWNLOAD_CONNECTIONS_PER_JOB = int(os.getenv('CARBALITE_DOWNLOAD_CONNECTIONS_PER_JOB', 4))
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv('CARBALITE_DOWNLOAD_MAX_CONNECTIONS', 32))  # Shared by all jobs
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('CARBALITE_DOWNLOAD_CHUNK_SIZE', 10 * 1024 * 1024))
+DOWNLOAD_SPLIT_MIN_BYTES = int(os.getenv('CARBALITE_DOWNLOAD_SPLIT_MIN_BYTES', 32 * 1024 * 1024))
+ARIA2C_PATH = shutil.which('aria2c')
+
+# Admission control for new jobs: shed load with 503 before it turns into timeouts,
+# and rate-limit each client (API key, else IP) with a token bucket (429)
+ADMISSION_QUEUE_HIGH_WATER = float(os.getenv('CARBALITE_ADMISSION_QUEUE_HIGH_WATER', 0.8))  # Of JOB_QUEUE_MAX_DEPTH
+ADMISSION_MAX_FFMPEG = int(os.getenv('CARBALITE_ADMISSION_MAX_FFMPEG', (os.cpu_count() or 2) * 2))
+ADMISSION_ERROR_RATE = float(os.getenv('CARBALITE_ADMISSION_ERROR_RATE', 0.5))  # Upstream failures that pause intake
+ADMISSION_ERROR_WINDOW = 60  # Seconds of upstream outcomes the error rate is computed over
+ADMISSION_ERROR_MIN_SAMPLES = 20  # Too few outcomes say nothing about upstream health
+RATE_LIMIT_PER_MINUTE = float(os.getenv('CARBALITE_RATE_LIMIT_PER_MINUTE', 30))  # 0 disables per-client limits
+RATE_LIMIT_BURST = int(os.getenv('CARBALITE_RATE_LIMIT_BURST', 10))
+RATE_LIMIT_MAX_CLIENTS = 10000  # Buckets kept in memory; idle ones are dropped first
+TRUST_PROXY_HEADERS = os.getenv('CARBALITE_TRUST_PROXY') == '1'  # Key on X-Forwarded-For behind a proxy
+# Failures that say upstream (or the path to it) is unhealthy; "Video unavailable" and the like do not
+UPSTREAM_FAILURE_TYPES = ('TransportError', 'IncompleteRead', 'URLError', 'RemoteDisconnected', 'SSLError', 'ProxyError')
+UPSTREAM_FAILURE_MARKERS = ('http error 429', 'http error 5', 'timed out', 'connection reset', 'connection refused',
+                            'connection aborted', 'name resolution', 'too many requests')
+RETRY_AFTER_MIN = 1
+RETRY_AFTER_MAX = 300
+
+# Serving completed artifacts
+ARTIFACT_CHUNK_SIZE = 256 * 1024  # Read size when streaming files without sendfile
+# Let Apache/lighttpd (X-Sendfile) or nginx (X-Accel-Redirect) send the bytes themselves
+app.config['USE_X_SENDFILE'] = os.getenv('CARBALITE_USE_X_SENDFILE') == '1'
+X_ACCEL_REDIRECT_PREFIX = os.getenv('CARBALITE_X_ACCEL_PREFIX')  # e.g. '/protected-downloads/'
+
+# Progressive stream-through mode (yt-dlp -> ffmpeg -> client, nothing written to DOWNLOAD_DIR)
+STREAM_THROUGH_MAX_SESSIONS = int(os.getenv('CARBALITE_STREAM_MAX_SESSIONS', 8))
+STREAM_THROUGH_CHUNK_SIZE = 64 * 1024
+# (media_type, format) -> (ffmpeg output arguments, mimetype); only pipe-friendly containers
+STREAM_THROUGH_OUTPUTS = {
+    ('audio', 'mp3'): (['-vn', '-c:a', 'libmp3lame', '-b:a', '{bitrate}', '-f', 'mp3'], 'audio/mpeg'),
+    ('audio', 'aac'): (['-vn', '-c:a', 'aac', '-b:a', '{bitrate}', '-f', 'adts'], 'audio/aac'),
+    ('audio', 'flac'): (['-vn', '-c:a', 'flac', '-f', 'flac'], 'audio/flac'),
+    ('audio', 'wav'): (['-vn', '-c:a', 'pcm_s16le', '-f', 'wav'], 'audio/wav'),
+    ('video', 'mp4'): (['-c:v', 'copy', '-c:a', 'aac', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'], 'video/mp4'),
+    ('video', 'webm'): (['-c:v', 'copy', '-c:a', 'libopus', '-f', 'webm'], 'video/webm'),
+    ('video', 'mkv'): (['-c', 'copy', '-f', 'matroska'], 'video/x-matroska'),
+}
+
+# Format planner: codecs each output container can hold without re-encoding
+CODEC_FAMILIES = (
+    ('mp4a', 'aac'), ('aac', 'aac'), ('mp3', 'mp3'), ('opus', 'opus'), ('vorbis', 'vorbis'), ('flac', 'flac'),
+    ('avc', 'h264'), ('h264', 'h264'), ('hev', 'h265'), ('hvc', 'h265'),
+    ('vp09', 'vp9'), ('vp9', 'vp9'), ('vp8', 'vp8'), ('av01', 'av1'),
+)
+CONTAINER_CODECS = {  # container -> (video families, audio families); None means anything
+    'mp4': ({'h264', 'h265', 'av1'}, {'aac', 'mp3'}),
+    'webm': ({'vp8', 'vp9', 'av1'}, {'opus', 'vorbis'}),
+    'mkv': (None, None),
+}
+AUDIO_COPY_FORMATS = ('mp3', 'aac', 'flac')  # wav always needs decoding to PCM
+COPY_BITRATE_TOLERANCE = 1.1  # Copy a source up to 10% above the requested bitrate
+AUDIO_QUALITIES = ('128k', '256k', '320k')  # The bitrates the frontend offers
+DEFAULT_AUDIO_QUALITY = '320k'
+
+# Direct upstream proxy for the client-side (ffmpeg.wasm) flow
+PROXY_CHUNK_SIZE = int(os.getenv('CARBALITE_PROXY_CHUNK_SIZE', 256 * 1024))
+PROXY_POOL_SIZE = int(os.getenv('CARBALITE_PROXY_POOL_SIZE', 32))  # Keep-alive connections per upstream host
+PROXY_FORWARD_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
+PROXY_RESPONSE_HEADERS = (
+    'Content-Length', 'Content-Range', 'Content-Type', 'Accept-Ranges', 'ETag', 'Last-Modified'
+)
+PROXY_DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'identity',  # Pass bytes through untouched so Content-Length/Range stay valid
+}
+
+# Thumbnail cache
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv('CARBALITE_THUMBNAIL_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+THUMBNAIL_SIZES = {'small': 160, 'medium': 320, 'large': None}  # Max width in pixels; None keeps the original
+THUMBNAIL_FORMATS = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+# Batch and playlist extraction
+BATCH_MAX_ITEMS = int(os.getenv('CARBALITE_BATCH_MAX_ITEMS', 500))
+BATCH_MAX_CONCURRENCY = int(os.getenv('CARBALITE_BATCH_MAX_CONCURRENCY', 4))  # Items in flight per batch
+BATCH_PUMP_INTERVAL = 2  # With an external job queue, seconds between checks for finished batch items
+
+# Lean /api/validate responses
+VALIDATE_FIELDS = (
+    'title', 'uploader', 'duration', 'thumbnail', 'description',
+    'upload_date', 'view_count', 'webpage_url', 'formats'
+)
+COMPRESS_MIN_BYTES = 1024  # Below this, compression costs more than the bytes it saves
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Higher levels cost far more CPU for a few percent on JSON
+
+# Server-Sent Events progress streams
+SSE_MAX_CONNECTIONS = int(os.getenv('CARBALITE_SSE_MAX_CONNECTIONS', 500))
+SSE_HEARTBEAT_INTERVAL = 15  # Seconds between keep-alive comments on idle streams
+SSE_RECHECK_INTERVAL = 2  # Re-read the store this often to catch updates from other processes
+
+def dumps_json(payload):
+    """Serialise payload to compact UTF-8 JSON, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def compact_format(fmt, include_url=False):
+    """A _get_format_info entry without null fields, and without its signed URL unless asked"""
+    return {
+        key: value for key, value in fmt.items()
+        if value is not None and (include_url or key != 'url')
+    }
+
+def project_fields(info, fields):
+    """Keep only the requested keys; 'formats.<key>' selects keys inside each format"""
+    wanted = {field.partition('.')[0] for field in fields}
+    format_keys = {field[len('formats.'):] for field in fields if field.startswith('formats.')}
+    projected = {key: value for key, value in info.items() if key in wanted}
+    if format_keys and 'formats' in projected and 'formats' not in fields:
+        projected['formats'] = [
+            {key: value for key, value in fmt.items() if key in format_keys}
+            for fmt in projected['formats']
+        ]
+    return projected
+
+def json_etag(body):
+    """ETag value for a serialised JSON body; used weak, so it covers every encoding of it"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def compress_body(body, encoding):
+    """Compress body with 'br' or 'gzip'; returns (body, applied encoding or None)"""
+    if not encoding or len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY), 'br'
+    return gzip.compress(body, compresslevel=GZIP_LEVEL), 'gzip'
+
+def compressed_json_response(payload):
+    """200 JSON response with a weak ETag, If-None-Match support and br/gzip compression"""
+    body = dumps_json(payload)
+    response = Response(mimetype='application/json')
+    # Weak, so the same ETag covers the identity, gzip and br encodings of the body
+    response.set_etag(json_etag(body), weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if request.method in ('GET', 'HEAD'):
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    
+    body, encoding = compress_body(
+        body, request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.set_data(body)
+    return response
+
+def normalize_audio_quality(value):
+    """Normalise a requested audio bitrate to one of AUDIO_QUALITIES, falling back to the default"""
+    value = str(value or '').strip().lower()
+    return value if value in AUDIO_QUALITIES else DEFAULT_AUDIO_QUALITY
+
+def audio_kbps(quality_settings):
+    """Requested audio bitrate in kbps, e.g. 320 for '320k'"""
+    return int(normalize_audio_quality((quality_settings or {}).get('audioQuality')).rstrip('k'))
+
+def codec_family(codec):
+    """Normalise a yt-dlp codec string ('mp4a.40.2', 'avc1.64001F') to a family name, or None"""
+    if not codec or codec == 'none':
+        return None
+    codec = codec.lower()
+    for prefix, family in CODEC_FAMILIES:
+        if codec.startswith(prefix):
+            return family
+    return codec
+
+def signed_url_expiry(info):
+    """Return the earliest expiry timestamp embedded in the format URLs, if any"""
+    earliest = None
+    for fmt in info.get('formats') or []:
+        fmt_url = fmt.get('url')
+        if not fmt_url:
+            continue
+        query = parse_qs(urlparse(fmt_url).query)
+        for param in ('expire', 'Expires'):
+            try:
+                value = int(query[param][0])
+            except (KeyError, ValueError, IndexError):
+                continue
+            if earliest is None or value < earliest:
+                earliest = value
+    return earliest
+
+class MetadataCache:
+    """Thread-safe LRU cache of yt-dlp info dicts with TTL and memory-based eviction"""
+
+    def __init__(self, ttl=METADATA_CACHE_TTL, max_bytes=METADATA_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, info)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a private copy of the cached info dict, or None on miss/expiry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, size, info = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.total_bytes -= size
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        # yt-dlp mutates info dicts while processing them, so never hand out the cached one
+        return copy.deepcopy(info)
+
+    def put(self, key, info):
+        """Cache an info dict, honouring signed-URL lifetimes and the memory budget"""
+        now = time.time()
+        expires_at = now + self.ttl
+        signed_expiry = signed_url_expiry(info)
+        if signed_expiry is not None:
+            expires_at = min(expires_at, signed_expiry - SIGNED_URL_SAFETY_MARGIN)
+        if expires_at <= now:
+            return
+
+        try:
+            size = len(json.dumps(info, default=str))
+        except (TypeError, ValueError):
+            return
+        if size > self.max_bytes:
+            return
+
+        info = copy.deepcopy(info)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+
+            self._entries[key] = (expires_at, size, info)
+            self.total_bytes += size
+
+            # Evict least recently used entries until we are back under budget
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop a cached entry, e.g. after its signed URLs were rejected upstream"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def stats(self):
+        """Return cache counters for monitoring"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': (self.hits / lookups) if lookups else 0.0
+            }
+
+def artifact_etag(stat_result):
+    """Strong ETag for a completed artifact, derived from its mtime and size"""
+    return f"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"
+
+def artifact_mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+def artifact_available(task):
+    """Whether a completed task's output can still be served"""
+    key = task.get('artifact_key')
+    if key:
+        try:
+            return artifacts.exists(key)
+        except Exception as e:
+            print(f"Could not check artifact {key}: {e}")
+            return False  # Re-running the job beats handing out a dead link
+    file_path = task.get('file_path')
+    return bool(file_path) and local_artifacts.exists(file_path)
+
+def remove_artifact(task):
+    """Delete a task's output from wherever it is stored"""
+    if task.get('artifact_key'):
+        artifacts.delete(task['artifact_key'])
+    elif task.get('file_path'):
+        disk_quota.remove(task['file_path'])
+
+def invalid_url_message(url):
+    """Error for a URL the single-item endpoints refuse"""
+    if extractor.is_playlist_url(url):
+        return 'Playlist and profile URLs hold several items; use /api/extract/batch'
+    return 'Invalid YouTube or SoundCloud URL'
+
+def parse_range_header(range_header, file_size):
+    """Parse a single 'bytes=' range into an inclusive (start, end) pair
+
+    Returns None when the header is absent, malformed or asks for several
+    ranges (the full body is served instead, as RFC 9110 allows). Raises
+    ValueError when the range cannot be satisfied.
+    """
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+
+    start, _, end = range_header[6:].strip().partition('-')
+    try:
+        start = int(start) if start else None
+        end = int(end) if end else None
+    except ValueError:
+        return None
+
+    if start is None:
+        # Suffix range: the last N bytes
+        if end is None:
+            return None
+        if end == 0:
+            raise ValueError('Range not satisfiable')
+        return max(0, file_size - end), file_size - 1
+
+    if end is None:
+        end = file_size - 1
+    if start >= file_size or end < start:
+        raise ValueError('Range not satisfiable')
+    return start, min(end, file_size - 1)
+
+def artifact_not_modified(if_none_match, if_modified_since, etag, mtime):
+    """Evaluate If-None-Match / If-Modified-Since against an artifact's validators
+
+    Takes the raw header values (None when absent) so every serving path,
+    whatever its request type, answers conditional requests the same way.
+    """
+    if if_none_match:
+        return if_none_match.strip() == '*' or f'"{etag}"' in [
+            tag.strip().removeprefix('W/') for tag in if_none_match.split(',')
+        ]
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def artifact_byte_range(range_header, if_range, etag, mtime, file_size):
+    """The (start, end) range to serve, or None for the whole artifact
+
+    Range is only honoured while If-Range (an ETag or an HTTP date) still
+    matches the artifact. Raises ValueError when the range cannot be satisfied.
+    """
+    if if_range:
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            applies = if_range == f'"{etag}"'  # Weak validators never match for If-Range
+        else:
+            try:
+                applies = int(mtime) == int(parsedate_to_datetime(if_range).timestamp())
+            except (TypeError, ValueError):
+                applies = False
+        if not applies:
+            return None
+    return parse_range_header(range_header, file_size)
+
+def sniff_image_type(data):
+    """Return the image mimetype from its magic bytes (thumbnails are often mislabelled)"""
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+class ThumbnailCache:
+    """Thread-safe LRU cache of thumbnail bytes bounded by total size"""
+
+    def __init__(self, max_bytes=THUMBNAIL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (data, content_type, etag)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def peek(self, key):
+        """Like get, without counting towards the hit ratio (for internal lookups)"""
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, data, content_type):
+        """Cache image bytes and return the (data, content_type, etag) entry"""
+        entry = (data, content_type, hashlib.sha1(data).hexdigest()[:20])
+        if len(data) > self.max_bytes:
+            return entry
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= len(previous[0])
+            self._entries[key] = entry
+            self.total_bytes += len(data)
+
+            while self.total_bytes > self.max_bytes:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits / lookups) if lookups else 0.0
+            }
+
+class InsufficientStorageError(Exception):
+    """Raised when a job's estimated output would not fit within the disk quota"""
+
+def estimate_output_size(video_info, media_type, preferred_format, quality_settings):
+    """Roughly estimate a job's output size in bytes from its metadata, or None if unknown"""
+    duration = video_info.get('duration')
+    quality_settings = quality_settings or {}
+    
+    if media_type == 'audio':
+        if not duration:
+            return None
+        if preferred_format == 'wav':
+            kbps = 1411  # 16-bit stereo PCM at 44.1 kHz
+        elif preferred_format == 'flac':
+            kbps = 900
+        else:
+            kbps = audio_kbps(quality_settings)
+        return int(duration * kbps * 1000 / 8)
+    
+    height_map = {'480p': 480, '720p': 720, '1080p': 1080, '1440p': 1440, '2160p': 2160}
+    max_height = height_map.get(quality_settings.get('videoQuality', '720p'), 720)
+    sizes = [
+        fmt.get('filesize') or fmt.get('filesize_approx')
+        for fmt in video_info.get('formats') or []
+        if (fmt.get('height') or 0) <= max_height
+    ]
+    sizes = [size for size in sizes if size]
+    if sizes:
+        return max(sizes)
+    if duration:
+        return int(duration * 2500 * 1000 / 8)  # Assume ~2.5 Mbit/s
+    return None
+
+class DiskQuotaManager:
+    """Tracks artifacts in DOWNLOAD_DIR and evicts least recently used ones
+
+    Artifacts sit in a last-access min-heap (stale heap entries are skipped
+    lazily), so each eviction is O(log n) and nothing ever rescans the
+    directory. Eviction runs as soon as usage passes the quota or the volume
+    runs low on free space. Running jobs reserve their estimated output size
+    so admission never overcommits the disk.
+    """
+
+    def __init__(self, directory, quota_bytes=DISK_QUOTA_BYTES, min_free_bytes=DISK_MIN_FREE_BYTES):
+        self.directory = Path(directory)
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.used_bytes = 0
+        self.reserved_bytes = 0
+        self.evictions = 0
+        self.on_evict = None  # Called with the owning task_id after its artifact is removed
+        self._artifacts = {}  # path -> [task_id, size, last_access]
+        self._heap = []  # (last_access, path)
+        self._reservations = {}  # task_id -> bytes
+        self._lock = threading.Lock()
+
+    def seed(self):
+        """Account for artifacts left by a previous run (one directory scan at startup)"""
+        for file_path in self.directory.glob('*'):
+            if file_path.is_file():
+                name = file_path.name
+                task_id = name[:36] if name[36:37] == '_' else None
+                self.register(task_id, file_path, last_access=file_path.stat().st_mtime, enforce=False)
+        self.enforce()
+
+    def register(self, task_id, file_path, last_access=None, enforce=True):
+        """Start tracking a finished artifact"""
+        path = str(file_path)
+        size = os.path.getsize(path)
+        last_access = time.time() if last_access is None else last_access
+        with self._lock:
+            previous = self._artifacts.get(path)
+            if previous is not None:
+                self.used_bytes -= previous[1]
+            self._artifacts[path] = [task_id, size, last_access]
+            heapq.heappush(self._heap, (last_access, path))
+            self.used_bytes += size
+        if enforce:
+            self.enforce()
+
+    def touch(self, file_path):
+        """Record an access so the artifact moves to the back of the eviction order"""
+        path = str(file_path)
+        now = time.time()
+        with self._lock:
+            artifact = self._artifacts.get(path)
+            if artifact is not None:
+                artifact[2] = now
+                heapq.heappush(self._heap, (now, path))
+
+    def remove(self, file_path):
+        """Stop tracking an artifact and delete it"""
+        path = str(file_path)
+        with self._lock:
+            artifact = self._artifacts.pop(path, None)
+            if artifact is not None:
+                self.used_bytes -= artifact[1]
+        try:
+            Path(path).unlink()
+        except FileNotFoundError:
+            pass
+
+    def free_bytes(self):
+        # Before the first job creates the directory, measure the volume it will live on
+        return shutil.disk_usage(self.directory if self.directory.exists() else self.directory.parent).free
+
+    def fits(self, nbytes):
+        """Whether nbytes more output fits under the quota and the free-space floor"""
+        with self._lock:
+            committed = self.used_bytes + self.reserved_bytes + nbytes
+            pending = self.reserved_bytes + nbytes
+        return committed <= self.quota_bytes and self.free_bytes() - pending >= self.min_free_bytes
+
+    def reserve(self, task_id, nbytes):
+        """Reserve space for a running job; returns False when it does not fit"""
+        if nbytes > self.quota_bytes:
+            return False  # Evicting everything would not help
+        if not self.fits(nbytes):
+            self.enforce(extra_bytes=nbytes)
+            if not self.fits(nbytes):
+                return False
+        with self._lock:
+            self._reservations[task_id] = self._reservations.get(task_id, 0) + nbytes
+            self.reserved_bytes += nbytes
+        return True
+
+    def release(self, task_id):
+        with self._lock:
+            self.reserved_bytes -= self._reservations.pop(task_id, 0)
+
+    def enforce(self, extra_bytes=0):
+        """Evict LRU artifacts while over the high-water mark or short on free space
+
+        Once triggered, eviction continues down to the low-water mark so the
+        next job does not immediately trigger another round.
+        """
+        with self._lock:
+            over_quota = self.used_bytes + self.reserved_bytes + extra_bytes > self.quota_bytes
+        if not over_quota and self.free_bytes() >= self.min_free_bytes + extra_bytes:
+            return
+        
+        low_water = int(self.quota_bytes * DISK_LOW_WATER_RATIO)
+        while True:
+            with self._lock:
+                committed = self.used_bytes + self.reserved_bytes + extra_bytes
+                if committed <= low_water and self.free_bytes() >= self.min_free_bytes + extra_bytes:
+                    return
+                
+                victim = None
+                while self._heap:
+                    last_access, path = heapq.heappop(self._heap)
+                    artifact = self._artifacts.get(path)
+                    if artifact is not None and artifact[2] == last_access:
+                        victim = (path, artifact[0])
+                        break
+                if victim is None:
+                    return  # Nothing left to evict
+            
+            path, task_id = victim
+            self.remove(path)
+            self.evictions += 1
+            print(f"Evicted artifact to free disk space: {path}")
+            if task_id and self.on_evict:
+                self.on_evict(task_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'artifacts': len(self._artifacts),
+                'used_bytes': self.used_bytes,
+                'reserved_bytes': self.reserved_bytes,
+                'quota_bytes': self.quota_bytes,
+                'evictions': self.evictions
+            }
+
+class QueueFullError(Exception):
+    """Raised when the job queue has reached its maximum depth"""
+
+class JobScheduler:
+    """Fixed-size worker pool fed by a bounded FIFO queue"""
+
+    def __init__(self, num_workers=JOB_WORKERS, max_queue_depth=JOB_QUEUE_MAX_DEPTH, name='download'):
+        self.name = name
+        self.num_workers = max(1, num_workers)
+        self.max_queue_depth = max_queue_depth
+        self.active_jobs = 0
+        self.completed_jobs = 0
+        self.avg_job_seconds = None  # Exponentially weighted moving average
+        self._pending = deque()  # (task_id, func, args, enqueued_at)
+        self._queued_ids = {}  # task_id -> enqueued_at
+        self._workers = []
+        self._accepting = True
+        self._cond = threading.Condition()
+
+    def _ensure_workers(self):
+        """Start worker threads on first use"""
+        if self._workers:
+            return
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f'carbalite-{self.name}-{i}')
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, task_id, func, *args):
+        """Queue a job and return its 1-based queue position"""
+        with self._cond:
+            if not self._accepting:
+                raise QueueFullError('Server is shutting down')
+            if len(self._pending) >= self.max_queue_depth:
+                raise QueueFullError('Job queue is full')
+
+            self._ensure_workers()
+            enqueued_at = time.time()
+            self._pending.append((task_id, func, args, enqueued_at))
+            self._queued_ids[task_id] = enqueued_at
+            self._cond.notify()
+            return len(self._pending)
+
+    def queue_info(self, task_id):
+        """Return queue position and wait times for a pending job, or None"""
+        with self._cond:
+            enqueued_at = self._queued_ids.get(task_id)
+            if enqueued_at is None:
+                return None
+
+            position = next(
+                (i for i, job in enumerate(self._pending, start=1) if job[0] == task_id),
+                len(self._pending)
+            )
+            info = {
+                'queue_position': position,
+                'queue_wait_seconds': round(time.time() - enqueued_at, 1)
+            }
+            if self.avg_job_seconds is not None:
+                info['estimated_wait_seconds'] = round(
+                    position / self.num_workers * self.avg_job_seconds, 1
+                )
+            return info
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and self._accepting:
+                    self._cond.wait()
+                if not self._pending:
+                    return  # Shutting down and fully drained
+
+                task_id, func, args, enqueued_at = self._pending.popleft()
+                self._queued_ids.pop(task_id, None)
+                self.active_jobs += 1
+
+            started_at = time.time()
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Job {task_id} failed: {e}")
+            finally:
+                duration = time.time() - started_at
+                with self._cond:
+                    self.active_jobs -= 1
+                    self.completed_jobs += 1
+                    if self.avg_job_seconds is None:
+                        self.avg_job_seconds = duration
+                    else:
+                        self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * duration
+
+    def cancel(self, task_id):
+        """Drop a job that has not started yet; returns False if it is not queued here"""
+        with self._cond:
+            if self._queued_ids.pop(task_id, None) is None:
+                return False
+            self._pending = deque(job for job in self._pending if job[0] != task_id)
+            return True
+
+    def shutdown(self, timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        """Stop accepting jobs, drain the queue and return task IDs that never ran"""
+        with self._cond:
+            self._accepting = False
+            self._cond.notify_all()
+
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.time()))
+
+        with self._cond:
+            abandoned = [job[0] for job in self._pending]
+            self._pending.clear()
+            self._queued_ids.clear()
+        return abandoned
+
+    def stats(self):
+        """Return scheduler counters for monitoring"""
+        with self._cond:
+            return {
+                'workers': self.num_workers,
+                'active_jobs': self.active_jobs,
+                'queued_jobs': len(self._pending),
+                'max_queue_depth': self.max_queue_depth,
+                'completed_jobs': self.completed_jobs,
+                'avg_job_seconds': self.avg_job_seconds
+            }
+
+class ExternalJobQueue:
+    """Download stage run by carbalite-worker processes through a job broker
+
+    Takes the place of the local download pool when CARBALITE_JOB_QUEUE names
+    a broker: this process only queues job descriptors, and the same
+    queue_info / cancel / stats calls report on the shared queue, so
+    admission control, status polling and metrics work unchanged.
+    """
+
+    def __init__(self, broker, max_queue_depth=JOB_QUEUE_MAX_DEPTH):
+        self.broker = broker
+        self.max_queue_depth = max_queue_depth
+        self._accepting = True
+
+    def submit(self, task_id, job):
+        """Queue a job descriptor and return its 1-based queue position"""
+        if not self._accepting:
+            raise QueueFullError('Server is shutting down')
+        if self.broker.depth() >= self.max_queue_depth:
+            raise QueueFullError('Job queue is full')
+        return self.broker.enqueue(task_id, job)
+
+    def queue_info(self, task_id):
+        """Return queue position and wait time for a job no worker has claimed yet, or None"""
+        waiting = self.broker.position(task_id)
+        if waiting is None:
+            return None
+        position, enqueued_at = waiting
+        return {
+            'queue_position': position,
+            'queue_wait_seconds': round(time.time() - enqueued_at, 1)
+        }
+
+    def cancel(self, task_id):
+        return self.broker.cancel(task_id)
+
+    def shutdown(self, timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        """Stop accepting jobs; waiting ones stay with the broker for the workers"""
+        self._accepting = False
+        return []
+
+    def stats(self):
+        stats = self.broker.stats()
+        return {
+            'workers': stats['slots'],
+            'worker_processes': stats['workers'],
+            'active_jobs': stats['claimed_jobs'],
+            'queued_jobs': stats['queued_jobs'],
+            'max_queue_depth': self.max_queue_depth,
+            'completed_jobs': None,  # Counted by each worker process
+            'avg_job_seconds': None
+        }
+
+class ConnectionBudget:
+    """Global cap on upstream connections, shared out between running downloads
+
+    Every job gets at least one connection so it always makes progress; the
+    extra connections used for fragment and range parallelism come out of
+    whatever the other jobs have left, up to DOWNLOAD_CONNECTIONS_PER_JOB.
+    """
+
+    def __init__(self, capacity=DOWNLOAD_MAX_CONNECTIONS, per_job=DOWNLOAD_CONNECTIONS_PER_JOB):
+        self.capacity = max(1, capacity)
+        self.per_job = max(1, per_job)
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Reserve connections for one download and return how many were granted"""
+        with self._lock:
+            granted = max(1, min(self.per_job, self.capacity - self.in_use))
+            self.in_use += granted
+            return granted
+
+    def release(self, granted):
+        with self._lock:
+            self.in_use = max(0, self.in_use - granted)
+
+    def stats(self):
+        with self._lock:
+            return {'capacity': self.capacity, 'per_job': self.per_job, 'in_use': self.in_use}
+
+def download_acceleration_options(connections, video_info, format_selector):
+    """yt-dlp options that spread one download over the granted connections"""
+    if not DOWNLOAD_ACCELERATION or connections <= 1:
+        return {}
+    opts = {
+        'concurrent_fragment_downloads': connections,  # DASH/HLS fragments in parallel
+        'http_chunk_size': DOWNLOAD_CHUNK_SIZE,  # Range requests also dodge per-connection throttling
+    }
+    sizes = {fmt.get('format_id'): fmt.get('filesize') or fmt.get('filesize_approx') or 0
+             for fmt in video_info.get('formats') or []}
+    largest = max((sizes.get(format_id, 0) for format_id in format_selector.split('+')), default=0)
+    if ARIA2C_PATH and largest >= DOWNLOAD_SPLIT_MIN_BYTES:
+        # yt-dlp fetches progressive files over a single connection; aria2c splits them
+        opts.pop('http_chunk_size')
+        opts['external_downloader'] = {'http': 'aria2c'}
+        opts['external_downloader_args'] = {'aria2c': [
+            '-x', str(connections), '-s', str(connections), '-k', '1M',
+            '--file-allocation=none', '--summary-interval=0'
+        ]}
+    return opts
+
+class DownloadProgress:
+    """Overall progress of a download made of several streams and concurrent fragments
+
+    yt-dlp reports each requested format separately (video then audio for a
+    merge), and with concurrent fragments its byte totals are estimates that
+    jump around, so the combined figure is averaged per stream and never
+    moves backwards.
+    """
+
+    def __init__(self, format_selector):
+        self.expected_streams = max(1, format_selector.count('+') + 1)
+        self.streams = {}  # filename -> (downloaded_bytes, total_bytes, fraction)
+        self.fraction = 0.0
+        self._lock = threading.Lock()  # Fragment threads call progress hooks concurrently
+
+    def update(self, d):
+        """Fold one yt-dlp progress hook call in and return the overall fraction (0-1)"""
+        key = d.get('filename') or d.get('tmpfilename') or 'download'
+        downloaded = d.get('downloaded_bytes') or 0
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        if d['status'] == 'finished':
+            fraction = 1.0
+        elif d.get('fragment_count'):
+            fraction = min(1.0, (d.get('fragment_index') or 0) / d['fragment_count'])
+        elif total:
+            fraction = min(1.0, downloaded / total)
+        else:
+            fraction = 0.0
+        with self._lock:
+            previous = self.streams.get(key)
+            if previous:
+                fraction = max(fraction, previous[2])
+            self.streams[key] = (downloaded, total, fraction)
+            streams = list(self.streams.values())
+            if len(streams) >= self.expected_streams and all(total for _, total, _ in streams):
+                overall = min(1.0, sum(done for done, _, _ in streams) / sum(total for _, total, _ in streams))
+                if all(fraction == 1.0 for _, _, fraction in streams):
+                    overall = 1.0
+            else:
+                overall = sum(fraction for _, _, fraction in streams) / max(self.expected_streams, len(streams))
+            self.fraction = max(self.fraction, overall)
+            return self.fraction
+
+class OverloadedError(Exception):
+    """Raised when a new job is refused; carries the HTTP status and Retry-After seconds"""
+
+    def __init__(self, message, status=503, retry_after=RETRY_AFTER_MIN, reason='overloaded'):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = int(max(RETRY_AFTER_MIN, min(RETRY_AFTER_MAX, math.ceil(retry_after))))
+        self.reason = reason
 
-# Clean up old files every hour
-CLEANUP_INTERVAL = 3600  # 1 hour
-FILE_EXPIRY = 3600  # Files expire after 1 hour
+def is_upstream_failure(error):
+    """True when an upstream call failed on the network or the site's side (HTTP 429/5xx),
+    not because of the content itself (private, removed or non-existent media)"""
+    cause, seen = error, set()
+    while cause is not None and id(cause) not in seen:
+        seen.add(id(cause))
+        if isinstance(cause, (ConnectionError, TimeoutError)) or type(cause).__name__ in UPSTREAM_FAILURE_TYPES:
+            return True
+        status = getattr(cause, 'status', None) or getattr(cause, 'code', None)
+        if isinstance(status, int) and (status == 429 or 500 <= status < 600):
+            return True
+        # yt-dlp's DownloadError keeps the original exception in exc_info
+        exc_info = getattr(cause, 'exc_info', None)
+        cause = exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else (cause.__cause__ or cause.__context__)
+    message = str(error).lower()
+    return any(marker in message for marker in UPSTREAM_FAILURE_MARKERS)
+
+class AdmissionController:
+    """Decides whether a new job may start, from live load and per-client budgets
+
+    Load signals: download queue depth, running ffmpeg processes, free disk
+    under DOWNLOAD_DIR and the recent upstream failure rate. Each refusal
+    estimates when capacity should be back, from the pools' moving-average
+    job times, for the Retry-After header.
+    With an external job queue (workers), ffmpeg and disk are the workers'
+    hosts, as published with their heartbeats, not this process's.
+    """
+
+    def __init__(self, downloads, transcodes, disk, workers=None):
+        self.downloads = downloads
+        self.transcodes = transcodes
+        self.disk = disk
+        self.workers = workers
+        self._outcomes = deque()  # (timestamp, ok) for upstream calls within ADMISSION_ERROR_WINDOW
+        self._buckets = OrderedDict()  # client key -> [tokens, updated_at], least recently used first
+        self._lock = threading.Lock()
+
+    def record_upstream(self, ok):
+        """Note the outcome of one metadata lookup or download
+
+        Callers report failures only when is_upstream_failure() holds, so
+        requests for private or missing media cannot trip the breaker.
+        """
+        now = time.time()
+        with self._lock:
+            self._outcomes.append((now, ok))
+            self._trim_outcomes(now)
+
+    def _trim_outcomes(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - ADMISSION_ERROR_WINDOW:
+            self._outcomes.popleft()
+
+    def upstream_error_rate(self):
+        """Fraction of recent upstream calls that failed, or None with too few samples"""
+        with self._lock:
+            self._trim_outcomes(time.time())
+            if len(self._outcomes) < ADMISSION_ERROR_MIN_SAMPLES:
+                return None
+            return sum(1 for _, ok in self._outcomes if not ok) / len(self._outcomes)
+
+    def check_load(self):
+        """Raise OverloadedError (503) when the server should not take on more work"""
+        stats = self.downloads.stats()
+        high_water = max(1, int(stats['max_queue_depth'] * ADMISSION_QUEUE_HIGH_WATER))
+        if stats['queued_jobs'] >= high_water:
+            raise OverloadedError(
+                'Server is busy: too many jobs waiting',
+                retry_after=self.queue_drain_seconds(stats['queued_jobs'] - high_water + 1),
+                reason='queue'
+            )
+        
+        if self.workers is not None:
+            self.check_worker_load()
+        else:
+            if ADMISSION_MAX_FFMPEG and count_ffmpeg_processes() >= ADMISSION_MAX_FFMPEG:
+                raise OverloadedError(
+                    'Server is busy: all transcoders are in use',
+                    retry_after=self.transcodes.stats()['avg_job_seconds'] or 10,
+                    reason='ffmpeg'
+                )
+            
+            if not self.disk.fits(0):
+                self.disk.enforce()
+                if not self.disk.fits(0):
+                    raise OverloadedError(
+                        'Server is low on disk space', retry_after=CLEANUP_INTERVAL, reason='disk'
+                    )
+        
+        error_rate = self.upstream_error_rate()
+        if error_rate is not None and error_rate >= ADMISSION_ERROR_RATE:
+            raise OverloadedError(
+                f'Upstream is failing ({error_rate:.0%} of recent requests), not accepting new jobs',
+                retry_after=ADMISSION_ERROR_WINDOW / 2,
+                reason='upstream_errors'
+            )
+
+    def check_worker_load(self):
+        """Refuse when no live worker has a free transcoder, or none has disk space left"""
+        loads = self.workers.worker_loads()
+        if not loads:
+            return  # No workers yet; the queue high-water mark still bounds the backlog
+        if all(load.get('ffmpeg_limit') and load.get('ffmpeg_processes', 0) >= load['ffmpeg_limit']
+               for load in loads):
+            raise OverloadedError(
+                'Server is busy: all transcoders are in use',
+                retry_after=min(load.get('avg_transcode_seconds') or 10 for load in loads),
+                reason='ffmpeg'
+            )
+        if not any(load.get('disk_ok', True) for load in loads):
+            raise OverloadedError(
+                'Server is low on disk space', retry_after=CLEANUP_INTERVAL, reason='disk'
+            )
+
+    def worker_load(self):
+        """Load to publish with this process's worker heartbeat (see carbalite-worker)"""
+        disk_ok = self.disk.fits(0)
+        if not disk_ok:
+            self.disk.enforce()
+            disk_ok = self.disk.fits(0)
+        return {
+            'ffmpeg_processes': count_ffmpeg_processes(),
+            'ffmpeg_limit': ADMISSION_MAX_FFMPEG,
+            'avg_transcode_seconds': self.transcodes.stats()['avg_job_seconds'],
+            'disk_ok': disk_ok
+        }
+
+    def queue_drain_seconds(self, jobs):
+        """Estimated time for the download pool to work through jobs more queued jobs"""
+        stats = self.downloads.stats()
+        return jobs / max(1, stats['workers']) * (stats['avg_job_seconds'] or 5)
+
+    def check_client(self, client_key, cost=1):
+        """Take cost tokens from the client's bucket, or raise OverloadedError (429)"""
+        if not RATE_LIMIT_PER_MINUTE:
+            return
+        rate = RATE_LIMIT_PER_MINUTE / 60
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.pop(client_key, None) or [float(RATE_LIMIT_BURST), now]
+            bucket[0] = min(RATE_LIMIT_BURST, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self._buckets[client_key] = bucket
+            while len(self._buckets) > RATE_LIMIT_MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+            if bucket[0] < cost:
+                raise OverloadedError(
+                    'Too many requests, slow down',
+                    status=429,
+                    retry_after=(cost - bucket[0]) / rate,
+                    reason='rate_limit'
+                )
+            bucket[0] -= cost
+
+    def stats(self):
+        with self._lock:
+            clients = len(self._buckets)
+        if self.workers is not None:
+            ffmpeg_processes = sum(load.get('ffmpeg_processes', 0) for load in self.workers.worker_loads())
+        else:
+            ffmpeg_processes = count_ffmpeg_processes()
+        return {
+            'upstream_error_rate': self.upstream_error_rate(),
+            'ffmpeg_processes': ffmpeg_processes,
+            'rate_limited_clients': clients
+        }
+
+def client_key(headers=None, remote_addr=None):
+    """Rate-limit key for a request: its API key, else the client IP
+
+    Defaults to the current Flask request; serverless handlers pass their own
+    headers and remote address.
+    """
+    if headers is None:
+        headers, remote_addr = request.headers, request.remote_addr
+    api_key = headers.get('X-API-Key')
+    if api_key:
+        return 'key:' + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:32]
+    if TRUST_PROXY_HEADERS and headers.get('X-Forwarded-For'):
+        return 'ip:' + headers['X-Forwarded-For'].split(',')[0].strip()
+    return f'ip:{remote_addr}'
+
+def queue_full_error(error):
+    """OverloadedError for a full job queue, retrying once a slot should have drained"""
+    return OverloadedError(
+        f'Server is busy: {str(error)}', retry_after=admission.queue_drain_seconds(1), reason='queue_full'
+    )
+
+def overloaded_payload(error):
+    """(body, headers) for an OverloadedError, shared by the Flask and serverless handlers"""
+    metrics.admission_rejections.inc(reason=error.reason)
+    body = {'error': f'{error}. Please retry in {error.retry_after}s.', 'retry_after': error.retry_after}
+    return body, {'Retry-After': str(error.retry_after)}
+
+def overloaded_response(error):
+    """JSON error response for an OverloadedError, with Retry-After"""
+    body, headers = overloaded_payload(error)
+    response = jsonify(body)
+    response.status_code = error.status
+    response.headers.update(headers)
+    return response
+
+class TaskCancelledError(Exception):
+    pass
+
+def child_processes():
+    """Yield (pid, command line) for each child of this process
+
+    Reads /proc, so this yields nothing on platforms without it.
+    """
+    proc_dir = Path('/proc')
+    if not proc_dir.is_dir():
+        return
+    
+    parent_pid = os.getpid()
+    for entry in proc_dir.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # Fields after the parenthesised command name: state, ppid, ...
+            ppid = int((entry / 'stat').read_text().rsplit(')', 1)[1].split()[1])
+            if ppid != parent_pid:
+                continue
+            yield int(entry.name), (entry / 'cmdline').read_bytes().decode('utf-8', 'replace')
+        except (OSError, ValueError, IndexError):
+            continue
+
+def kill_child_processes(marker):
+    """Kill child processes of this process whose command line contains marker
+
+    yt-dlp starts ffmpeg itself and keeps no handle we can reach, but the
+    command line always names files in the job's temp directory.
+    """
+    killed = 0
+    for pid, cmdline in child_processes():
+        if marker not in cmdline:
+            continue
+        try:
+            os.kill(pid, signal.SIGKILL)
+            killed += 1
+        except OSError:
+            continue
+    return killed
+
+def count_ffmpeg_processes():
+    """Running ffmpeg children, whether started by transcodes, merges or stream-through"""
+    return sum(1 for _, cmdline in child_processes() if 'ffmpeg' in cmdline.split('\0', 1)[0])
+
+class JobControl:
+    """Cancellation state and current stage deadline for one running extraction"""
+
+    def __init__(self, task_id, temp_path):
+        self.task_id = task_id
+        self.temp_path = temp_path
+        self.reason = None  # 'cancelled', 'abandoned' or 'timeout'
+        self.stage = None
+        self.stage_timeout = None
+        self.deadline = None
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def enter_stage(self, stage, timeout):
+        self.raise_if_cancelled()
+        self.stage = stage
+        self.stage_timeout = timeout
+        self.deadline = time.time() + timeout if timeout else None
+
+    def cancel(self, reason):
+        """Flag the job and kill its ffmpeg children; yt-dlp hooks raise on their next call"""
+        if self._event.is_set():
+            return
+        self.reason = reason
+        self._event.set()
+        killed = kill_child_processes(str(self.temp_path))
+        if killed:
+            print(f"Killed {killed} child process(es) of task {self.task_id}")
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise TaskCancelledError(self.describe())
+
+    def describe(self):
+        if self.reason == 'timeout':
+            return f'{self.stage.capitalize()} timed out after {self.stage_timeout}s'
+        if self.reason == 'abandoned':
+            return f'Cancelled: no client checked on this task for {ABANDON_GRACE_PERIOD}s'
+        return 'Cancelled by request'
+
+class JobMonitor:
+    """Watches this process's running jobs for stage timeouts, cancel requests and abandonment
+
+    Cancel requests and client polls are read from the task store, so a
+    DELETE or a status poll handled by another process still reaches the
+    worker that owns the job.
+    """
+
+    def __init__(self, interval=JOB_MONITOR_INTERVAL):
+        self.interval = interval
+        self._controls = {}  # task_id -> JobControl
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, task_id, temp_path):
+        control = JobControl(task_id, temp_path)
+        with self._lock:
+            self._controls[task_id] = control
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='carbalite-job-monitor')
+                self._thread.daemon = True
+                self._thread.start()
+        return control
+
+    def unregister(self, task_id):
+        with self._lock:
+            self._controls.pop(task_id, None)
+
+    def cancel(self, task_id, reason='cancelled'):
+        """Cancel a job running in this process; returns False if it is not running here"""
+        with self._lock:
+            control = self._controls.get(task_id)
+        if control is None:
+            return False
+        control.cancel(reason)
+        return True
+
+    def check(self, control, now):
+        if control.deadline is not None and now >= control.deadline:
+            control.cancel('timeout')
+            return
+        
+        task = extractor.tasks.get(control.task_id) or {}
+        if task.get('cancel_requested'):
+            control.cancel('cancelled')
+        elif is_abandoned(task, now):
+            control.cancel('abandoned')
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                controls = list(self._controls.values())
+            now = time.time()
+            for control in controls:
+                try:
+                    self.check(control, now)
+                except Exception as e:
+                    print(f"Job monitor error for task {control.task_id}: {e}")
+
+def is_abandoned(task, now=None):
+    """True when a client-driven task has gone unpolled for longer than the grace period
+
+    Only tasks created for a polling client carry last_polled_at; batch items
+    are tracked through their batch and never time out this way.
+    """
+    if not ABANDON_GRACE_PERIOD or 'last_polled_at' not in task:
+        return False
+    now = time.time() if now is None else now
+    return now - task['last_polled_at'] > ABANDON_GRACE_PERIOD
+
+def record_poll(task_id, task):
+    """Note that a client is still watching a task, writing at most every POLL_TOUCH_INTERVAL"""
+    if task.get('status') in TERMINAL_STATUSES or 'last_polled_at' not in task:
+        return
+    now = time.time()
+    if now - task['last_polled_at'] >= POLL_TOUCH_INTERVAL:
+        extractor.tasks.update(task_id, {'last_polled_at': now})
+
+class TaskEventHub:
+    """Wakes SSE streams when a task they watch changes in this process"""
+
+    def __init__(self, max_connections=SSE_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._watched = {}  # task_id -> [condition, version, watcher_count]
+
+    def notify(self, task_id):
+        """Task store listener: bump the task's version and wake its watchers"""
+        with self._lock:
+            watched = self._watched.get(task_id)
+            if watched is not None:
+                watched[1] += 1
+                watched[0].notify_all()
+
+    def acquire(self, task_id):
+        """Reserve a stream slot; returns the current version or None when at capacity"""
+        with self._lock:
+            if self.connections >= self.max_connections:
+                return None
+            self.connections += 1
+            watched = self._watched.setdefault(task_id, [threading.Condition(self._lock), 0, 0])
+            watched[2] += 1
+            return watched[1]
+
+    def release(self, task_id):
+        with self._lock:
+            self.connections -= 1
+            watched = self._watched.get(task_id)
+            if watched is not None:
+                watched[2] -= 1
+                if watched[2] <= 0:
+                    del self._watched[task_id]
+
+    def wait(self, task_id, version, timeout):
+        """Block until the task's version moves past version or timeout; returns the new version"""
+        with self._lock:
+            watched = self._watched[task_id]
+            watched[0].wait_for(lambda: watched[1] != version, timeout)
+            return watched[1]
 
 class MediaExtractor:
     def __init__(self):
-        self.active_downloads = {}
+        self.tasks = create_task_store()  # Shared with other workers on this host
+        self.metadata_cache = MetadataCache()
+        self.thumbnail_cache = ThumbnailCache()
+        self._thumbnails_rendering = set()  # Thumbnail URLs whose variants are being precomputed
+        self._thumbnails_lock = threading.Lock()
+        self.jobs_lock = threading.Lock()  # Serialises deduplication checks in this process
+        self.stream_slots = threading.BoundedSemaphore(STREAM_THROUGH_MAX_SESSIONS)
+        self._sessions = {}  # upstream host -> requests.Session with its own connection pool
+        self._sessions_lock = threading.Lock()
+
+    def get_session(self, upstream_url):
+        """Return the pooled keep-alive session for the URL's host"""
+        host = urlparse(upstream_url).netloc
+        with self._sessions_lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=PROXY_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def extract_info(self, url):
+        """Extract (or reuse cached) yt-dlp metadata for a URL"""
+        cache_key = media_key(url)
+        video_info = self.metadata_cache.get(cache_key)
+        if video_info is not None:
+            return video_info
+
+        # The canonical URL drops &list=, timestamps and tracking noise before yt-dlp sees it
+        identity = parse_media_url(url)
+        target_url = identity.canonical_url if identity and identity.kind in ('video', 'track') else url
+        try:
+            with yt_dlp.YoutubeDL({'quiet': True, 'socket_timeout': UPSTREAM_SOCKET_TIMEOUT}) as ydl:
+                video_info = ydl.sanitize_info(ydl.extract_info(target_url, download=False))
+        except Exception as e:
+            metrics.upstream_errors.inc(source='metadata', type=type(e).__name__)
+            if is_upstream_failure(e):
+                admission.record_upstream(False)
+            raise
+        admission.record_upstream(True)
+
+        self.metadata_cache.put(cache_key, video_info)
+        return video_info
         
     def is_valid_url(self, url):
-        """Validate if the URL is a valid YouTube or SoundCloud URL"""
-        youtube_regex = re.compile(
-            r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
-            r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
-        )
-        
-        soundcloud_regex = re.compile(
-            r'(https?://)?(www\.)?soundcloud\.com/[\w\-\.]+'
-        )
+        """Validate if the URL is a single YouTube video or SoundCloud track
+
+        Playlists, sets and profile pages are rejected here: extracting one
+        would download every entry. They go through /api/extract/batch.
+        """
+        identity = parse_media_url(url)
+        return identity is not None and identity.kind in ('video', 'track')
+    
+    def is_playlist_url(self, url):
+        """Check for a YouTube playlist or SoundCloud set URL"""
+        identity = parse_media_url(url)
+        if identity is None:
+            return False
+        if identity.kind in ('playlist', 'set', 'user'):
+            return True
+        # watch?v=X&list=Y is a video for extraction, but a batch can still expand the list
+        return identity.site == 'youtube' and 'list' in parse_qs(urlparse(url if '://' in url else f'https://{url}').query)
+    
+    def expand_playlist(self, url):
+        """List playlist entries with flat extraction (one request, no per-item metadata)"""
+        with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': 'in_playlist'}) as ydl:
+            playlist = ydl.extract_info(url, download=False)
         
-        return youtube_regex.match(url) is not None or soundcloud_regex.match(url) is not None
+        entries = []
+        for entry in playlist.get('entries') or []:
+            entry_url = entry.get('webpage_url') or entry.get('url')
+            if entry_url:
+                entries.append({'url': entry_url, 'title': entry.get('title')})
+        return playlist.get('title'), entries
     
     def sanitize_filename(self, filename):
         """Remove invalid characters from filename"""
@@ -82,19 +1555,104 @@ class MediaExtractor:
     def download_thumbnail(self, thumbnail_url):
         """Download video thumbnail"""
         try:
-            response = requests.get(thumbnail_url, timeout=10)
+            response = self.get_session(thumbnail_url).get(thumbnail_url, timeout=10)
             response.raise_for_status()
             return response.content
         except Exception as e:
+            metrics.upstream_errors.inc(source='thumbnail', type=type(e).__name__)
             print(f"Warning: Could not download thumbnail: {e}")
             return None
     
-    def get_video_info(self, url):
-        """Extract video information without downloading"""
+    def get_thumbnail(self, thumbnail_url, size='large', image_format=None):
+        """Return a cached (data, content_type, etag) thumbnail variant, fetching it once
+
+        Fetching the original also starts rendering every other variant in the
+        background, so later size/format requests are served from the cache.
+        Without Pillow installed every variant is the original image.
+        """
+        variant_key = (thumbnail_url, size, image_format)
+        entry = self.thumbnail_cache.get(variant_key)
+        if entry is not None:
+            return entry
+        
+        original = self._thumbnail_original(thumbnail_url)
+        if original is None:
+            return None
+        if variant_key == (thumbnail_url, 'large', None) or not Image.available:
+            return original
+        return self._render_thumbnail(thumbnail_url, original, size, image_format)
+    
+    def precompute_thumbnails(self, thumbnail_url):
+        """Fetch the original and render every size/format variant into the cache, in the background"""
+        if not Image.available:
+            return
+        with self._thumbnails_lock:
+            if thumbnail_url in self._thumbnails_rendering:
+                return
+            self._thumbnails_rendering.add(thumbnail_url)
+        thread = threading.Thread(
+            target=self._render_thumbnail_variants, args=(thumbnail_url,), name='carbalite-thumbnails'
+        )
+        thread.daemon = True
+        thread.start()
+    
+    def _render_thumbnail_variants(self, thumbnail_url):
         try:
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                video_info = ydl.extract_info(url, download=False)
-                
+            original = self._thumbnail_original(thumbnail_url, precompute=False)
+            if original is None:
+                return
+            for size in THUMBNAIL_SIZES:
+                for image_format in (None, *THUMBNAIL_FORMATS):
+                    if (size, image_format) == ('large', None):
+                        continue
+                    if self.thumbnail_cache.peek((thumbnail_url, size, image_format)) is None:
+                        self._render_thumbnail(thumbnail_url, original, size, image_format)
+        except Exception as e:
+            print(f"Warning: Could not render thumbnail variants: {e}")
+        finally:
+            with self._thumbnails_lock:
+                self._thumbnails_rendering.discard(thumbnail_url)
+    
+    def _thumbnail_original(self, thumbnail_url, precompute=True):
+        """Return the cached original thumbnail entry, downloading it on a miss"""
+        original_key = (thumbnail_url, 'large', None)
+        original = self.thumbnail_cache.peek(original_key)
+        if original is not None:
+            return original
+        data = self.download_thumbnail(thumbnail_url)
+        if not data:
+            return None
+        original = self.thumbnail_cache.put(original_key, data, sniff_image_type(data))
+        if precompute:
+            self.precompute_thumbnails(thumbnail_url)
+        return original
+    
+    def _render_thumbnail(self, thumbnail_url, original, size, image_format):
+        image = Image.open(io.BytesIO(original[0]))
+        max_width = THUMBNAIL_SIZES[size]
+        if max_width and image.width > max_width:
+            image.thumbnail((max_width, max(1, image.height * max_width // image.width)))
+        
+        output_format = image_format or 'jpeg'
+        if output_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        
+        output = io.BytesIO()
+        image.save(output, format=output_format.upper(), quality=80)
+        return self.thumbnail_cache.put(
+            (thumbnail_url, size, image_format), output.getvalue(), THUMBNAIL_FORMATS[output_format]
+        )
+    
+    def get_video_info(self, url, include_urls=False):
+        """Extract video information without downloading
+
+        Formats are compact: null fields are dropped, and the long signed
+        upstream URLs are left out unless include_urls is set (clients fetch
+        bytes through /api/proxy/<format_id> instead).
+        """
+        try:
+            video_info = self.extract_info(url)
+
             return {
                 'title': video_info.get('title', 'Unknown'),
                 'uploader': video_info.get('uploader', 'Unknown'),
@@ -104,7 +1662,9 @@ class MediaExtractor:
                 'upload_date': video_info.get('upload_date'),
                 'view_count': video_info.get('view_count'),
                 'webpage_url': video_info.get('webpage_url', url),
-                'formats': self._get_format_info(video_info)
+                'formats': [
+                    compact_format(fmt, include_urls) for fmt in self._get_format_info(video_info)
+                ]
             }
         except Exception as e:
             raise Exception(f"Failed to extract video info: {str(e)}")
@@ -133,18 +1693,194 @@ class MediaExtractor:
                     formats.append(format_info)
         return formats
     
+    def build_format_options(self, media_type, preferred_format, quality_settings):
+        """Return the yt-dlp format selector and postprocessors for the user's preferences"""
+        opts = {}
+        if media_type == 'audio':
+            # Audio download with quality preferences
+            audio_quality = normalize_audio_quality((quality_settings or {}).get('audioQuality'))
+            quality_map = {'128k': '5', '256k': '0', '320k': '0'}  # ffmpeg quality scale (5=128k, 0=best)
+            ffmpeg_quality = quality_map.get(audio_quality, '0')
+            
+            if preferred_format == 'mp3':
+                opts['format'] = 'bestaudio/best'
+                opts['postprocessors'] = [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'mp3',
+                    'preferredquality': audio_quality.replace('k', ''),
+                }]
+            elif preferred_format == 'wav':
+                opts['format'] = 'bestaudio/best'
+                opts['postprocessors'] = [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'wav',
+                }]
+            elif preferred_format == 'flac':
+                opts['format'] = 'bestaudio/best'
+                opts['postprocessors'] = [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'flac',
+                }]
+            elif preferred_format == 'aac':
+                opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
+                opts['postprocessors'] = [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'aac',
+                    'preferredquality': audio_quality.replace('k', ''),
+                }]
+            else:
+                # Default to best audio
+                opts['format'] = 'bestaudio/best'
+        else:
+            # Video download with quality preferences
+            video_quality = quality_settings.get('videoQuality', '720p') if quality_settings else '720p'
+            height_map = {'480p': 480, '720p': 720, '1080p': 1080, '1440p': 1440, '2160p': 2160}
+            max_height = height_map.get(video_quality, 720)
+            
+            if preferred_format == 'mp4':
+                opts['format'] = f'best[ext=mp4][height<={max_height}]/best[height<={max_height}]/best[ext=mp4]/best'
+            elif preferred_format == 'webm':
+                opts['format'] = f'best[ext=webm][height<={max_height}]/best[height<={max_height}]/best[ext=webm]/best'
+            elif preferred_format == 'mkv':
+                opts['format'] = f'best[ext=mkv][height<={max_height}]/best[height<={max_height}]/best'
+                opts['postprocessors'] = [{
+                    'key': 'FFmpegVideoConvertor',
+                    'preferedformat': 'mkv',
+                }]
+            else:
+                opts['format'] = f'best[height<={max_height}]/best'
+        
+        return opts
+    
+    def plan_formats(self, video_info, media_type, preferred_format, quality_settings):
+        """Pick the cheapest way to produce the requested output from the available formats
+
+        Returns build_format_options-style yt-dlp options plus 'path', one of:
+        'direct' (download as-is), 'copy' (audio stream copied into a new
+        container), 'remux' (video/audio streams copied into the target
+        container, including merging separate DASH streams) or 'transcode'
+        (re-encode with ffmpeg, the fallback when no source stream fits).
+        """
+        formats = self._get_format_info(video_info)
+        quality_settings = quality_settings or {}
+        
+        if media_type == 'audio' and preferred_format in AUDIO_COPY_FORMATS:
+            target_kbps = audio_kbps(quality_settings)
+            copyable = [
+                fmt for fmt in formats
+                if codec_family(fmt['vcodec']) is None
+                and codec_family(fmt['acodec']) == preferred_format
+                # A lossy source above the requested bitrate is re-encoded to honour the smaller size
+                and (preferred_format == 'flac' or not fmt['abr'] or fmt['abr'] <= target_kbps * COPY_BITRATE_TOLERANCE)
+            ]
+            if copyable:
+                source = max(copyable, key=lambda fmt: fmt['abr'] or 0)
+                if source['ext'] == preferred_format:
+                    return {'format': source['format_id'], 'path': 'direct', 'source': source['format_id']}
+                return {
+                    'format': source['format_id'],
+                    # Same codec and no target quality: yt-dlp stream-copies into the new container
+                    'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': preferred_format}],
+                    'path': 'copy',
+                    'source': source['format_id']
+                }
+        
+        if media_type != 'audio' and preferred_format in CONTAINER_CODECS:
+            video_codecs, audio_codecs = CONTAINER_CODECS[preferred_format]
+            height_map = {'480p': 480, '720p': 720, '1080p': 1080, '1440p': 1440, '2160p': 2160}
+            max_height = height_map.get(quality_settings.get('videoQuality', '720p'), 720)
+            
+            def fits(family, allowed):
+                return family is not None and (allowed is None or family in allowed)
+            
+            def video_rank(fmt):
+                return (fmt['height'] or 0, fmt['vbr'] or 0)
+            
+            in_range = [fmt for fmt in formats if (fmt['height'] or 0) <= max_height]
+            progressive = [
+                fmt for fmt in in_range
+                if fits(codec_family(fmt['vcodec']), video_codecs) and fits(codec_family(fmt['acodec']), audio_codecs)
+            ]
+            video_only = [
+                fmt for fmt in in_range
+                if fits(codec_family(fmt['vcodec']), video_codecs) and codec_family(fmt['acodec']) is None
+            ]
+            audio_only = [
+                fmt for fmt in formats
+                if codec_family(fmt['vcodec']) is None and fits(codec_family(fmt['acodec']), audio_codecs)
+            ]
+            
+            best_progressive = max(progressive, key=video_rank, default=None)
+            best_video = max(video_only, key=video_rank, default=None)
+            best_audio = max(audio_only, key=lambda fmt: fmt['abr'] or 0, default=None)
+            
+            # Separate streams merged with -c copy beat a lower-resolution single file
+            if best_video and best_audio and (
+                best_progressive is None or (best_video['height'] or 0) > (best_progressive['height'] or 0)
+            ):
+                return {
+                    'format': f"{best_video['format_id']}+{best_audio['format_id']}",
+                    'merge_output_format': preferred_format,
+                    'path': 'remux',
+                    'source': f"{best_video['format_id']}+{best_audio['format_id']}"
+                }
+            if best_progressive:
+                if best_progressive['ext'] == preferred_format:
+                    return {'format': best_progressive['format_id'], 'path': 'direct', 'source': best_progressive['format_id']}
+                return {
+                    'format': best_progressive['format_id'],
+                    'postprocessors': [{'key': 'FFmpegVideoRemuxer', 'preferedformat': preferred_format}],
+                    'path': 'remux',
+                    'source': best_progressive['format_id']
+                }
+        
+        opts = self.build_format_options(media_type, preferred_format, quality_settings)
+        opts['path'] = 'transcode' if opts.get('postprocessors') else 'direct'
+        return opts
+    
     def extract_raw_media(self, url, task_id, format_id=None, media_type='audio', preferred_format=None, quality_settings=None):
-        """Download media with user preferences and provide file for download"""
+        """Download media with user preferences, then hand it to the transcode pool
+
+        This is the network-bound half of the pipeline and runs on the download
+        pool. Jobs that need ffmpeg postprocessing continue in transcode_media
+        on the CPU-sized transcode pool, so no download slot waits on ffmpeg.
+        """
+        task = self.tasks.get(task_id)
+        if task is None or task['status'] == 'cancelled':
+            return  # Deleted or cancelled while it was still queued
+        
+        created_at = task.get('created_at', time.time())
+        temp_path = DOWNLOAD_DIR / f"temp_{task_id}"
+        if task.get('cancel_requested') or is_abandoned(task):
+            metrics.jobs_cancelled.inc(reason='cancelled' if task.get('cancel_requested') else 'abandoned')
+            self.tasks.set(task_id, {
+                'status': 'cancelled',
+                'progress': 0,
+                'message': 'Cancelled before it started',
+                'created_at': created_at
+            }, keep=SHARED_TASK_FIELDS)
+            return
+        
+        control = job_monitor.register(task_id, temp_path)
+        job = {'control': control, 'created_at': created_at, 'temp_path': temp_path}
+        handed_off = False  # Once the transcode stage owns the job, it does the cleanup
         try:
-            self.active_downloads[task_id] = {
+            # update rather than set, so cancel requests and poll times survive the transition
+            self.tasks.update(task_id, {
                 'status': 'extracting',
                 'progress': 0,
                 'message': 'Extracting media information...'
-            }
+            })
+            
+            # Generate filename first (usually served from the metadata cache filled by /api/validate)
+            control.enter_stage('metadata', METADATA_TIMEOUT)
+            with metrics.stage_duration.time(stage='metadata'):
+                video_info = self.extract_info(url)
             
-            # Generate filename first
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                video_info = ydl.extract_info(url, download=False)
+            # Reserve disk space for the output before downloading anything
+            estimated_size = estimate_output_size(video_info, media_type, preferred_format, quality_settings)
+            if estimated_size and not disk_quota.reserve(task_id, int(estimated_size * ADMISSION_SAFETY_FACTOR)):
+                raise InsufficientStorageError('Not enough disk space for this job, please retry later')
             
             title = self.sanitize_filename(video_info.get('title', 'Unknown'))
             uploader = self.sanitize_filename(video_info.get('uploader', ''))
@@ -163,11 +1899,25 @@ class MediaExtractor:
                 else:
                     filename = f"{title}.{final_format}"
             
-            # Create output path
-            output_path = DOWNLOAD_DIR / filename
-            temp_path = DOWNLOAD_DIR / f"temp_{task_id}"
+            self.tasks.update(task_id, {'message': 'Configuring download options...'})
             
-            self.active_downloads[task_id]['message'] = 'Configuring download options...'
+            # Postprocessors are run later by the transcode stage, not by this download
+            format_options = self.plan_formats(video_info, media_type, preferred_format, quality_settings)
+            metrics.processing_paths.inc(path=format_options['path'])
+            self.tasks.update(task_id, {
+                'processing_path': format_options['path'],
+                'source_format': format_options.get('source')
+            })
+            job.update(
+                processing_path=format_options['path'],
+                source_format=format_options.get('source'),
+                video_info=video_info,
+                filename=filename,
+                final_format=final_format,
+                media_type=media_type,
+                quality_settings=quality_settings,
+                postprocessors=format_options.get('postprocessors') or []
+            )
             
             # Configure yt-dlp with proper download options
             ydl_opts = {
@@ -175,212 +1925,980 @@ class MediaExtractor:
                 'no_warnings': False,
                 'outtmpl': str(temp_path / '%(title)s.%(ext)s'),
                 'extract_flat': False,
+                'socket_timeout': UPSTREAM_SOCKET_TIMEOUT,
+                'continuedl': True,  # Pick up .part files left by a worker that died mid-download
+                'format': format_options['format'],
             }
+            if format_options.get('merge_output_format'):
+                ydl_opts['merge_output_format'] = format_options['merge_output_format']
             
-            # Configure format and post-processing based on user preferences
-            if media_type == 'audio':
-                # Audio download with quality preferences
-                audio_quality = quality_settings.get('audioQuality', '320k') if quality_settings else '320k'
-                quality_map = {'128k': '5', '256k': '0', '320k': '0'}  # ffmpeg quality scale (5=128k, 0=best)
-                ffmpeg_quality = quality_map.get(audio_quality, '0')
-                
-                if preferred_format == 'mp3':
-                    ydl_opts['format'] = 'bestaudio/best'
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': audio_quality.replace('k', ''),
-                    }]
-                elif preferred_format == 'wav':
-                    ydl_opts['format'] = 'bestaudio/best'
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'wav',
-                    }]
-                elif preferred_format == 'flac':
-                    ydl_opts['format'] = 'bestaudio/best'
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'flac',
-                    }]
-                elif preferred_format == 'aac':
-                    ydl_opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'aac',
-                        'preferredquality': audio_quality.replace('k', ''),
-                    }]
-                else:
-                    # Default to best audio
-                    ydl_opts['format'] = 'bestaudio/best'
-            else:
-                # Video download with quality preferences
-                video_quality = quality_settings.get('videoQuality', '720p') if quality_settings else '720p'
-                height_map = {'480p': 480, '720p': 720, '1080p': 1080, '1440p': 1440, '2160p': 2160}
-                max_height = height_map.get(video_quality, 720)
-                
-                if preferred_format == 'mp4':
-                    ydl_opts['format'] = f'best[ext=mp4][height<={max_height}]/best[height<={max_height}]/best[ext=mp4]/best'
-                elif preferred_format == 'webm':
-                    ydl_opts['format'] = f'best[ext=webm][height<={max_height}]/best[height<={max_height}]/best[ext=webm]/best'
-                elif preferred_format == 'mkv':
-                    ydl_opts['format'] = f'best[ext=mkv][height<={max_height}]/best[height<={max_height}]/best'
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegVideoConvertor',
-                        'preferedformat': 'mkv',
-                    }]
-                else:
-                    ydl_opts['format'] = f'best[height<={max_height}]/best'
+            # Add progress hook; yt-dlp calls it many times per second, so only
+            # write when the percentage changes and at most every PROGRESS_WRITE_INTERVAL
+            download_progress = DownloadProgress(format_options['format'])
+            last_write = {'progress': -1, 'time': 0.0}
+            write_lock = threading.Lock()
             
-            # Add progress hook
             def progress_hook(d):
-                if d['status'] == 'downloading':
-                    if 'total_bytes' in d or 'total_bytes_estimate' in d:
-                        total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                        downloaded = d.get('downloaded_bytes', 0)
-                        if total > 0:
-                            progress = int((downloaded / total) * 80)  # Reserve 20% for post-processing
-                            self.active_downloads[task_id].update({
-                                'progress': progress,
-                                'message': f'Downloading... {progress}%'
-                            })
-                elif d['status'] == 'finished':
-                    self.active_downloads[task_id].update({
-                        'progress': 80,
-                        'message': 'Processing audio/video...'
-                    })
+                control.raise_if_cancelled()  # Aborts the download from inside yt-dlp
+                if d['status'] not in ('downloading', 'finished'):
+                    return
+                progress = int(download_progress.update(d) * 80)  # Reserve 20% for post-processing
+                now = time.time()
+                with write_lock:
+                    if progress <= last_write['progress']:
+                        return
+                    if progress < 80 and now - last_write['time'] < PROGRESS_WRITE_INTERVAL:
+                        return
+                    last_write.update(progress=progress, time=now)
+                self.tasks.update(task_id, {
+                    'progress': progress,
+                    'message': 'Download finished' if progress >= 80 else f'Downloading... {progress}%'
+                })
             
             ydl_opts['progress_hooks'] = [progress_hook]
             
             # Create temp directory
-            temp_path.mkdir(exist_ok=True)
+            temp_path.mkdir(parents=True, exist_ok=True)
+            
+            resuming = any(temp_path.glob('*.part'))
+            self.tasks.update(task_id, {'message': 'Resuming download...' if resuming else 'Starting download...'})
             
-            self.active_downloads[task_id]['message'] = 'Starting download...'
+            # Download with yt-dlp, reusing the info dict instead of resolving the URL again
+            control.enter_stage('download', DOWNLOAD_TIMEOUT)
+            download_started_at = time.monotonic()
+            connections = download_connections.acquire()
+            ydl_opts.update(download_acceleration_options(connections, video_info, format_options['format']))
+            try:
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    ydl.process_ie_result(copy.deepcopy(video_info), download=True)
+            except Exception as e:
+                if not control.cancelled:
+                    metrics.upstream_errors.inc(source='download', type=type(e).__name__)
+                    if is_upstream_failure(e):
+                        admission.record_upstream(False)
+                raise
+            finally:
+                download_connections.release(connections)
+            admission.record_upstream(True)
+            control.raise_if_cancelled()
+            metrics.stage_duration.observe(time.monotonic() - download_started_at, stage='download')
             
-            # Download with yt-dlp
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+            if not self._downloaded_files(temp_path):
+                raise Exception("No file was downloaded")
             
-            # Find the downloaded file
-            downloaded_files = list(temp_path.glob('*'))
+            if not job['postprocessors']:
+                self._finish_job(task_id, job)
+                return
+            
+            if job.get('processing_path', 'transcode') != 'transcode':
+                # Stream copies take milliseconds; queueing them behind transcodes would cost more
+                handed_off = True
+                self.transcode_media(task_id, job)
+                return
+            
+            control.enter_stage('transcode_queue', None)  # Waiting for a core is not a stall
+            self.tasks.update(task_id, {
+                'status': 'transcode_queued',
+                'progress': 80,
+                'message': 'Waiting for a free transcoder...'
+            })
+            job['transcode_queued_at'] = time.monotonic()
+            handed_off = True
+            try:
+                transcode_scheduler.submit(task_id, self.transcode_media, task_id, job)
+            except QueueFullError:
+                # Transcode backlog is full: transcode here rather than throw the download away
+                self.transcode_media(task_id, job)
+            
+        except Exception as e:
+            handed_off = False
+            self._fail_job(task_id, job, e)
+        finally:
+            if not handed_off:
+                job_monitor.unregister(task_id)
+                disk_quota.release(task_id)
+    
+    def transcode_media(self, task_id, job):
+        """Run the job's ffmpeg postprocessors on its downloaded file; runs on the transcode pool"""
+        control = job['control']
+        try:
+            if 'transcode_queued_at' in job:  # Stream copies and remuxes run inline, never queued
+                metrics.stage_duration.observe(time.monotonic() - job['transcode_queued_at'], stage='transcode_wait')
+            control.enter_stage('postprocess', POSTPROCESS_TIMEOUT)
+            self.tasks.update(task_id, {
+                'status': 'transcoding',
+                'progress': 85,
+                'message': 'Processing audio/video...'
+            })
+            
+            def postprocessor_hook(d):
+                control.raise_if_cancelled()
+            
+            downloaded_file = self._downloaded_files(job['temp_path'])[0]
+            info = copy.deepcopy(job['video_info'])
+            info.update(filepath=str(downloaded_file), ext=downloaded_file.suffix[1:], __files_to_move={})
+            ydl_opts = {
+                'quiet': True,
+                'outtmpl': str(job['temp_path'] / '%(title)s.%(ext)s'),
+                'postprocessors': job['postprocessors'],
+                'postprocessor_hooks': [postprocessor_hook],
+            }
+            with metrics.stage_duration.time(stage='postprocess'):
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    ydl.post_process(str(downloaded_file), info)
+            control.raise_if_cancelled()  # A killed ffmpeg does not always surface as an error
+            
+            self._finish_job(task_id, job)
+        except Exception as e:
+            self._fail_job(task_id, job, e)
+        finally:
+            job_monitor.unregister(task_id)
+            disk_quota.release(task_id)
+    
+    def _downloaded_files(self, temp_path):
+        """Finished files in a job's temp directory, ignoring in-progress downloads"""
+        return [
+            path for path in temp_path.glob('*')
+            if not path.suffix.startswith('.part') and path.suffix not in ('.ytdl', '.aria2')
+        ]
+    
+    def _finish_job(self, task_id, job):
+        """Move the job's output into place and mark the task completed"""
+        video_info = job['video_info']
+        final_format = job['final_format']
+        with metrics.stage_duration.time(stage='rename'):
+            # Find the downloaded file, preferring the postprocessed output
+            downloaded_files = self._downloaded_files(job['temp_path'])
             if not downloaded_files:
                 raise Exception("No file was downloaded")
             
-            downloaded_file = downloaded_files[0]  # Get the first (should be only) file
+            converted = [path for path in downloaded_files if path.suffix == f'.{final_format}']
+            downloaded_file = (converted or downloaded_files)[0]
+            
+            # Move to a per-task location so concurrent jobs for the same title never collide
+            final_path = DOWNLOAD_DIR / f"{task_id}_{job['filename']}"
+            downloaded_file.rename(final_path)
+            
+            # Clean up temp directory
+            shutil.rmtree(job['temp_path'], ignore_errors=True)
+        
+        file_size = final_path.stat().st_size
+        content_type = artifact_mimetype(job['filename'])
+        location = None
+        if artifacts.remote:
+            self.tasks.update(task_id, {'progress': 95, 'message': 'Uploading...'})
+            try:
+                with metrics.stage_duration.time(stage='upload'):
+                    location = {'artifact_key': artifacts.put(task_id, final_path, job['filename'], content_type)}
+            except Exception as e:
+                # The output is done; serving it from local disk beats failing the job
+                metrics.upstream_errors.inc(source='artifact_upload', type=type(e).__name__)
+                print(f"Artifact upload failed for task {task_id}, serving it locally: {e}")
+        if location is None:
+            location = {'file_path': local_artifacts.put(task_id, final_path, job['filename'], content_type)}
+        
+        completed_at = time.time()
+        self.tasks.set(task_id, {
+            **location,
+            'status': 'completed',
+            'progress': 100,
+            'message': 'Download completed!',
+            'created_at': job['created_at'],
+            'completed_at': completed_at,
+            'last_accessed_at': completed_at,
+            'filename': job['filename'],
+            'file_size': file_size,
+            'format_info': {
+                'ext': final_format,
+                'media_type': job['media_type'],
+                'quality': job['quality_settings'],
+                'processing_path': job.get('processing_path'),
+                'source_format': job.get('source_format')
+            },
+            'processing_path': job.get('processing_path'),
+            'video_info': {
+                'title': video_info.get('title', 'Unknown'),
+                'uploader': video_info.get('uploader', 'Unknown'),
+                'duration': video_info.get('duration'),
+                'thumbnail': video_info.get('thumbnail'),
+                'upload_date': video_info.get('upload_date'),
+                'view_count': video_info.get('view_count'),
+                'description': video_info.get('description', '')[:500]
+            }
+        }, ttl=FILE_EXPIRY, keep=SHARED_TASK_FIELDS)
+        if 'file_path' in location:
+            disk_quota.register(task_id, Path(location['file_path']))
+        if video_info.get('thumbnail') and job_broker is None:
+            # This process serves /api/thumbnail too, so have the variants ready before the client asks
+            self.precompute_thumbnails(video_info['thumbnail'])
+    
+    def _fail_job(self, task_id, job, error):
+        """Record a failed or cancelled job and remove its temp directory"""
+        shutil.rmtree(job['temp_path'], ignore_errors=True)
+        
+        control = job['control']
+        if control.cancelled:
+            metrics.jobs_cancelled.inc(reason=control.reason)
+            # Timeouts are failures; explicit and automatic cancellations are not
+            status = 'error' if control.reason == 'timeout' else 'cancelled'
+            message = control.describe()
+        else:
+            status, message = 'error', str(error)
+        self.tasks.set(task_id, {
+            'status': status,
+            'progress': 0,
+            'message': f'Error: {message}' if status == 'error' else message,
+            'created_at': job['created_at']
+        }, keep=SHARED_TASK_FIELDS)
+    
+    def stream_through(self, url, media_type='audio', preferred_format=None, quality_settings=None):
+        """Pipe yt-dlp's download straight through ffmpeg and yield encoded chunks
+
+        Returns (filename, mimetype, generator). yt-dlp writes to a pipe that
+        ffmpeg reads, and ffmpeg writes to a pipe we read as the client
+        consumes the response, so a slow client fills the pipes and stalls the
+        upstream fetch instead of buffering. Closing the generator kills both
+        processes.
+        """
+        ffmpeg_path = shutil.which('ffmpeg')
+        if not ffmpeg_path:
+            raise Exception('FFmpeg is required for streaming mode')
+        
+        final_format = preferred_format or ('mp3' if media_type == 'audio' else 'mp4')
+        output = STREAM_THROUGH_OUTPUTS.get((media_type, final_format))
+        if output is None:
+            raise ValueError(f'Streaming is not supported for {media_type} format: {final_format}')
+        output_args, mimetype = output
+        bitrate = normalize_audio_quality((quality_settings or {}).get('audioQuality'))
+        output_args = [arg.format(bitrate=bitrate) for arg in output_args]
+        
+        video_info = self.extract_info(url)
+        title = self.sanitize_filename(video_info.get('title', 'Unknown'))
+        uploader = self.sanitize_filename(video_info.get('uploader', ''))
+        filename = f"{title} - {uploader}.{final_format}" if uploader else f"{title}.{final_format}"
+        
+        # Hand the (usually cached) info dict to yt-dlp so it does not resolve the URL again
+        info_file = tempfile.NamedTemporaryFile('w', suffix='.info.json', delete=False)
+        with info_file:
+            json.dump(video_info, info_file)
+        
+        def remove_info_file():
+            try:
+                os.unlink(info_file.name)
+            except OSError:
+                pass
+        
+        format_selector = self.build_format_options(media_type, preferred_format, quality_settings)['format']
+        try:
+            downloader = subprocess.Popen(
+                [sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', '--no-progress',
+                 '--load-info-json', info_file.name, '-f', format_selector, '-o', '-'],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+        except Exception:
+            remove_info_file()
+            raise
+        try:
+            encoder = subprocess.Popen(
+                [ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+                 *output_args, '-flush_packets', '1', 'pipe:1'],
+                stdin=downloader.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+        except Exception:
+            # Nothing will ever read yt-dlp's output, so stop and reap it
+            downloader.kill()
+            downloader.stdout.close()
+            downloader.wait()
+            remove_info_file()
+            raise
+        downloader.stdout.close()  # ffmpeg owns the read end now; if it dies, yt-dlp gets SIGPIPE
+        
+        def generate():
+            try:
+                while True:
+                    # read1 returns as soon as ffmpeg has produced anything
+                    chunk = encoder.stdout.read1(STREAM_THROUGH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                for process in (encoder, downloader):
+                    if process.poll() is None:
+                        process.kill()
+                    process.wait()
+                encoder.stdout.close()
+                remove_info_file()
+        
+        return filename, mimetype, generate()
+    
+    def _find_format(self, url, format_id, refresh=False):
+        """Return the format dict for format_id, re-resolving metadata if asked or expired"""
+        cache_key = media_key(url)
+        if refresh:
+            self.metadata_cache.invalidate(cache_key)
+        
+        video_info = self.extract_info(url)
+        fmt = next((f for f in video_info.get('formats') or [] if f.get('format_id') == format_id), None)
+        if fmt is None:
+            raise LookupError(f'Format {format_id} not available')
+        
+        # Refresh proactively when the signed URL is about to expire
+        expiry = signed_url_expiry({'formats': [fmt]})
+        if not refresh and expiry is not None and expiry - SIGNED_URL_SAFETY_MARGIN <= time.time():
+            return self._find_format(url, format_id, refresh=True)
+        return fmt
+    
+    def stream_media(self, url, format_id, request_headers):
+        """Proxy one upstream format to the client, forwarding Range and conditional headers"""
+        try:
+            fmt = self._find_format(url, format_id)
+            
+            def open_upstream(fmt):
+                headers = dict(PROXY_DEFAULT_HEADERS)
+                headers.update(fmt.get('http_headers') or {})  # Headers yt-dlp says the URL needs
+                headers['Accept-Encoding'] = 'identity'
+                for name in PROXY_FORWARD_HEADERS:
+                    if request_headers.get(name):
+                        headers[name] = request_headers[name]
+                return self.get_session(fmt['url']).get(
+                    fmt['url'], stream=True, timeout=30, headers=headers
+                )
             
-            # Move to final location with correct filename
-            final_path = DOWNLOAD_DIR / filename
-            if final_path.exists():
-                final_path.unlink()  # Remove existing file
+            response = open_upstream(fmt)
+            if response.status_code in (403, 410):
+                # Signed URL expired or was revoked: re-resolve once and retry
+                metrics.upstream_errors.inc(source='proxy', type=f'http_{response.status_code}')
+                response.close()
+                response = open_upstream(self._find_format(url, format_id, refresh=True))
             
-            downloaded_file.rename(final_path)
+            if response.status_code >= 400 and response.status_code != 416:
+                metrics.upstream_errors.inc(source='proxy', type=f'http_{response.status_code}')
+                response.close()
+                return jsonify({'error': f'Upstream returned HTTP {response.status_code}'}), 502
             
-            # Clean up temp directory
-            shutil.rmtree(temp_path, ignore_errors=True)
+            # Create a generator to stream the content; closing it returns the connection to the pool
+            def generate():
+                try:
+                    for chunk in response.iter_content(chunk_size=PROXY_CHUNK_SIZE):
+                        if chunk:  # Filter out keep-alive chunks
+                            yield chunk
+                finally:
+                    response.close()
             
-            self.active_downloads[task_id] = {
-                'status': 'completed',
-                'progress': 100,
-                'message': 'Download completed!',
-                'file_path': str(final_path),
-                'filename': filename,
-                'file_size': final_path.stat().st_size,
-                'format_info': {
-                    'ext': final_format,
-                    'media_type': media_type,
-                    'quality': quality_settings
-                },
-                'video_info': {
-                    'title': video_info.get('title', 'Unknown'),
-                    'uploader': video_info.get('uploader', 'Unknown'),
-                    'duration': video_info.get('duration'),
-                    'thumbnail': video_info.get('thumbnail'),
-                    'upload_date': video_info.get('upload_date'),
-                    'view_count': video_info.get('view_count'),
-                    'description': video_info.get('description', '')[:500]
-                }
+            headers = {
+                name: response.headers[name]
+                for name in PROXY_RESPONSE_HEADERS
+                if name in response.headers
             }
+            headers.setdefault('Accept-Ranges', 'bytes')
+            headers['Cache-Control'] = 'no-cache'
+            headers['X-Content-Type-Options'] = 'nosniff'
             
-        except Exception as e:
-            # Clean up temp directory on error
-            if 'temp_path' in locals():
-                shutil.rmtree(temp_path, ignore_errors=True)
+            return Response(generate(), status=response.status_code, headers=headers)
             
-            self.active_downloads[task_id] = {
-                'status': 'error',
-                'progress': 0,
-                'message': f'Error: {str(e)}'
-            }
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        except Exception as e:
+            if isinstance(e, requests.RequestException):
+                metrics.upstream_errors.inc(source='proxy', type=type(e).__name__)
+            print(f"Streaming error: {e}")
+            return jsonify({'error': f'Failed to stream media: {str(e)}'}), 500
+
+# Initialize extractor, job scheduler, progress event hub and disk quota
+extractor = MediaExtractor()
+job_scheduler = JobScheduler()
+# With an external broker, extraction jobs go to carbalite-worker processes instead of job_scheduler
+job_broker = create_job_broker()
+extraction_queue = ExternalJobQueue(job_broker) if job_broker is not None else job_scheduler
+transcode_scheduler = JobScheduler(TRANSCODE_WORKERS, TRANSCODE_QUEUE_MAX_DEPTH, name='transcode')
+job_monitor = JobMonitor()
+download_connections = ConnectionBudget()
+task_events = TaskEventHub()
+extractor.tasks.add_listener(task_events.notify)
+disk_quota = DiskQuotaManager(DOWNLOAD_DIR)
+disk_quota.on_evict = extractor.tasks.delete
+artifacts = create_artifact_store()
+# Where outputs are kept when artifacts is remote but an upload fails
+local_artifacts = artifacts if not artifacts.remote else LocalArtifactStore()
+admission = AdmissionController(extraction_queue, transcode_scheduler, disk_quota, workers=job_broker)
+
+def _cache_stats():
+    return {'metadata': extractor.metadata_cache.stats(), 'thumbnail': extractor.thumbnail_cache.stats()}
+
+def task_queue_info(task_id):
+    """Queue position and wait estimates from whichever pipeline stage holds the task"""
+    return extraction_queue.queue_info(task_id) or transcode_scheduler.queue_info(task_id)
+
+def _pool_stats():
+    return {'download': extraction_queue.stats(), 'transcode': transcode_scheduler.stats()}
+
+metrics.registry.callback(
+    'carbalite_queue_depth', 'Jobs waiting for a worker in each pipeline stage',
+    lambda: {(name,): stats['queued_jobs'] for name, stats in _pool_stats().items()},
+    ['pool']
+)
+metrics.registry.callback(
+    'carbalite_active_workers', 'Workers currently busy in each pipeline stage',
+    lambda: {(name,): stats['active_jobs'] for name, stats in _pool_stats().items()},
+    ['pool']
+)
+metrics.registry.callback(
+    'carbalite_workers', 'Size of each pipeline stage\'s worker pool',
+    lambda: {(name,): stats['workers'] for name, stats in _pool_stats().items()},
+    ['pool']
+)
+metrics.registry.callback(
+    'carbalite_completed_jobs_total', 'Jobs finished by each pipeline stage',
+    lambda: {(name,): stats['completed_jobs'] for name, stats in _pool_stats().items()},
+    ['pool'], kind='counter'
+)
+metrics.registry.callback(
+    'carbalite_download_connections', 'Upstream connections reserved by running downloads',
+    lambda: download_connections.stats()['in_use']
+)
+metrics.registry.callback(
+    'carbalite_cache_hits_total', 'Cache lookups that found an entry',
+    lambda: {(name,): stats['hits'] for name, stats in _cache_stats().items()},
+    ['cache'], kind='counter'
+)
+metrics.registry.callback(
+    'carbalite_cache_misses_total', 'Cache lookups that missed',
+    lambda: {(name,): stats['misses'] for name, stats in _cache_stats().items()},
+    ['cache'], kind='counter'
+)
+metrics.registry.callback(
+    'carbalite_cache_hit_ratio', 'Hits over lookups since process start',
+    lambda: {(name,): stats['hit_ratio'] for name, stats in _cache_stats().items()},
+    ['cache']
+)
+metrics.registry.callback(
+    'carbalite_cache_bytes', 'Bytes held by each cache',
+    lambda: {(name,): stats['bytes'] for name, stats in _cache_stats().items()},
+    ['cache']
+)
+metrics.registry.callback(
+    'carbalite_disk_used_bytes', 'Bytes used by completed artifacts',
+    lambda: disk_quota.stats()['used_bytes']
+)
+metrics.registry.callback(
+    'carbalite_event_streams', 'Open Server-Sent Events connections',
+    lambda: task_events.connections
+)
+
+def extraction_job_key(url, media_type, preferred_format, quality_settings):
+    """Key identical extraction requests by media identity and output settings"""
+    return (
+        media_key(url),
+        media_type,
+        preferred_format,
+        tuple(sorted((quality_settings or {}).items()))
+    )
+
+def schedule_extraction(url, format_id, media_type, preferred_format, quality_settings, track_polling=True,
+                        check_load=False):
+    """Queue an extraction job, or attach to an identical running or finished one
+
+    Returns (task_id, queue_position, reused) where reused is None for a new job,
+    'running' when attached to an in-flight job and 'completed' when the artifact
+    already exists. Every request counts as an attachment on the task, so
+    cancel_task only stops or deletes it once the last client lets go. Raises QueueFullError when the queue is saturated and
+    InsufficientStorageError when the output is known not to fit on disk.
+    With check_load, new jobs (not reused ones) are first put to the
+    admission controller, which raises OverloadedError under load.
+    With track_polling, the job is cancelled if no client polls it for
+    ABANDON_GRACE_PERIOD seconds.
+    """
+    job_key = json.dumps(extraction_job_key(url, media_type, preferred_format, quality_settings))
+
+    def find_reusable():
+        for _ in range(ATTACH_RETRIES):
+            existing_id = extractor.tasks.get_job(job_key)
+            existing = extractor.tasks.get(existing_id) if existing_id else None
+            if existing is None:
+                return None
+            if existing['status'] == 'completed':
+                if not artifact_available(existing):
+                    return None
+                reused = 'completed'
+            elif existing['status'] not in TERMINAL_STATUSES:
+                reused = 'running'
+            else:
+                return None
+            # Conditional on the status too, so we never join a job that was cancelled in between
+            attachments = existing.get('attachments')
+            if extractor.tasks.compare_and_update(
+                existing_id, {'status': existing['status'], 'attachments': attachments},
+                {'attachments': (attachments or 1) + 1}
+            ):
+                return existing_id, None, reused
+        return None
+
+    # Load checks scan /proc and may evict artifacts, so they run before jobs_lock is taken;
+    # reused jobs cost nothing and skip them
+    reusable = find_reusable()
+    if reusable is not None:
+        return reusable
     
-    def stream_media(self, stream_url):
-        """Stream media content with proper headers for CORS"""
-        try:
-            # Use proper headers that YouTube expects
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': '*/*',
-                'Accept-Language': 'en-US,en;q=0.9',
-                'Accept-Encoding': 'gzip, deflate',
-                'DNT': '1',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
+    if check_load:
+        admission.check_load()
+
+    # Admission control: with metadata already cached (the usual validate-then-extract
+    # flow) we can refuse jobs whose output cannot fit before queueing them
+    cached_info = extractor.metadata_cache.get(media_key(url))
+    if cached_info is not None:
+        estimated_size = estimate_output_size(cached_info, media_type, preferred_format, quality_settings)
+        if estimated_size and not disk_quota.fits(int(estimated_size * ADMISSION_SAFETY_FACTOR)):
+            disk_quota.enforce(extra_bytes=int(estimated_size * ADMISSION_SAFETY_FACTOR))
+            if not disk_quota.fits(int(estimated_size * ADMISSION_SAFETY_FACTOR)):
+                raise InsufficientStorageError('Not enough disk space for this job')
+
+    with extractor.jobs_lock:
+        # An identical request may have queued the job while we were checking
+        reusable = find_reusable()
+        if reusable is not None:
+            return reusable
+        
+        task_id = str(uuid.uuid4())
+        now = time.time()
+        task = {
+            'status': 'queued',
+            'progress': 0,
+            'message': 'Waiting for a free worker...',
+            'created_at': now,
+            'queued_at': now,
+            'attachments': 1,  # Clients sharing this job through deduplication
+            # Enough to re-run the job from another process if this one dies mid-way;
+            # queued jobs are owned by the broker until a worker claims them
+            'worker_id': None if job_broker is not None else current_worker_id(),
+            'job': {
+                'url': url,
+                'format_id': format_id,
+                'media_type': media_type,
+                'preferred_format': preferred_format,
+                'quality_settings': quality_settings
             }
+        }
+        if track_polling:
+            task['last_polled_at'] = now
+        extractor.tasks.set(task_id, task)
+        try:
+            queue_position = dispatch_extraction(task_id, task['job'])
+        except QueueFullError:
+            extractor.tasks.delete(task_id)
+            raise
+
+        extractor.tasks.set_job(job_key, task_id)
+        return task_id, queue_position, None
+
+def dispatch_extraction(task_id, job):
+    """Queue a task's job descriptor on the external broker if one is configured, else the local download pool"""
+    if job_broker is not None:
+        return extraction_queue.submit(task_id, job)
+    return job_scheduler.submit(
+        task_id, extractor.extract_raw_media,
+        job['url'], task_id, job['format_id'], job['media_type'],
+        job['preferred_format'], job['quality_settings']
+    )
+
+class BatchManager:
+    """Fans batch items out to the job scheduler, at most `concurrency` at a time per batch
+
+    The batch record lives in the task store and holds everything needed to
+    carry on: each item's URL and task_id plus the scheduling state
+    (next_index, in_flight), so any process can report or pump it. Items
+    start as earlier ones reach a terminal state, which we learn from the
+    task store's change listener (or the poll loop with an external job
+    queue); the cleanup cycle adopts batches whose process went away.
+    """
+
+    def __init__(self):
+        self._active = set()  # batch_ids this process is pumping
+        self._item_index = {}  # item task_id -> set of batch_ids waiting on it
+        self._lock = threading.RLock()  # Re-entrant: scheduling an item triggers our own listener
+
+    def start(self, urls, media_type, preferred_format, quality_settings, concurrency, playlist_url=None):
+        """Create the batch record and queue the expansion/first items; returns batch_id"""
+        batch_id = str(uuid.uuid4())
+        now = time.time()
+        extractor.tasks.set(batch_id, {
+            'kind': 'batch',
+            'status': 'expanding' if playlist_url else 'running',
+            'created_at': now,
+            'playlist_url': playlist_url,
+            # Who is expanding the playlist, so a dead expansion can be restarted
+            'worker_id': None if job_broker is not None or not playlist_url else current_worker_id(),
+            'schedule': {
+                'media_type': media_type,
+                'preferred_format': preferred_format,
+                'quality_settings': quality_settings,
+                'concurrency': concurrency,
+                'next_index': 0,
+                'in_flight': []
+            },
+            'items': [{'url': url, 'title': None, 'task_id': None} for url in urls]
+        })
+        
+        if playlist_url:
+            try:
+                self._dispatch_expansion(batch_id, playlist_url)
+            except QueueFullError:
+                extractor.tasks.delete(batch_id)
+                raise
+        else:
+            self.pump(batch_id)
+        return batch_id
+
+    def _dispatch_expansion(self, batch_id, playlist_url):
+        if job_broker is not None:
+            extraction_queue.submit(batch_id, {'kind': 'expand_playlist', 'url': playlist_url})
+        else:
+            job_scheduler.submit(batch_id, self._expand, batch_id, playlist_url)
+
+    def _expand(self, batch_id, playlist_url):
+        try:
+            title, entries = extractor.expand_playlist(playlist_url)
+        except Exception as e:
+            extractor.tasks.update(batch_id, {'status': 'error', 'message': f'Error: {str(e)}'})
+            return
+        
+        extractor.tasks.compare_and_update(batch_id, {'status': 'expanding'}, {
+            'status': 'running',
+            'title': title,
+            'truncated': len(entries) > BATCH_MAX_ITEMS,
+            'items': [dict(entry, task_id=None) for entry in entries[:BATCH_MAX_ITEMS]]
+        })
+        self.pump(batch_id)
+
+    def _resume_expansion(self, batch_id, batch):
+        """Restart the expansion of a batch whose expanding process died"""
+        worker_id = batch.get('worker_id')
+        if is_worker_alive(worker_id) or (job_broker is not None and job_broker.contains(batch_id)):
+            return
+        owner = None if job_broker is not None else current_worker_id()
+        if not extractor.tasks.compare_and_update(batch_id, {'worker_id': worker_id}, {'worker_id': owner}):
+            return  # Another process restarted it first
+        try:
+            self._dispatch_expansion(batch_id, batch['playlist_url'])
+        except QueueFullError:
+            extractor.tasks.update(batch_id, {'worker_id': None})  # Retried on the next cleanup cycle
+
+    def pump(self, batch_id):
+        """Start pending items until the batch's concurrency cap is reached"""
+        with self._lock:
+            batch = extractor.tasks.get(batch_id)
+            if batch is None or batch['status'] in TERMINAL_STATUSES:
+                self._active.discard(batch_id)  # e.g. expansion failed in a worker process
+                return
+            if batch['status'] != 'running':
+                return
             
-            # Make request to the media URL with proper headers
-            response = requests.get(stream_url, stream=True, timeout=30, headers=headers)
-            response.raise_for_status()
+            schedule = batch.get('schedule')
+            if schedule is None:
+                # Created before scheduling state was stored; nothing can say where it stopped
+                extractor.tasks.update(batch_id, {'status': 'error', 'message': 'Interrupted by a server restart'})
+                return
+            next_index = schedule['next_index']
+            # Drop items that finished without us hearing about it (e.g. run by another process)
+            in_flight = []
+            for task_id in schedule['in_flight']:
+                task = extractor.tasks.get(task_id)
+                if task is not None and task['status'] not in TERMINAL_STATUSES:
+                    in_flight.append(task_id)
             
-            # Get content length and type
-            content_length = response.headers.get('content-length', '')
-            content_type = response.headers.get('content-type', 'application/octet-stream')
+            items = batch['items']
+            while len(in_flight) < schedule['concurrency'] and next_index < len(items):
+                item = items[next_index]
+                try:
+                    task_id, _, reused = schedule_extraction(
+                        item['url'], None, schedule['media_type'],
+                        schedule['preferred_format'], schedule['quality_settings'], track_polling=False
+                    )
+                except QueueFullError:
+                    break  # Retried on the next completion or cleanup cycle
+                except InsufficientStorageError as e:
+                    item['error'] = str(e)
+                    next_index += 1
+                    continue
+                
+                item['task_id'] = task_id
+                next_index += 1
+                if reused != 'completed':
+                    in_flight.append(task_id)
             
-            # Create a generator to stream the content
-            def generate():
-                for chunk in response.iter_content(chunk_size=16384):  # Larger chunks for better performance
-                    if chunk:  # Filter out keep-alive chunks
-                        yield chunk
-            
-            # Return response with appropriate headers
-            return Response(
-                generate(),
-                content_type=content_type,
-                headers={
-                    'Content-Length': content_length,
-                    'Accept-Ranges': 'bytes',
-                    'Cache-Control': 'no-cache',
-                    'X-Content-Type-Options': 'nosniff'
-                }
-            )
+            done = next_index >= len(items) and not in_flight
+            fields = {'schedule': dict(schedule, next_index=next_index, in_flight=in_flight), 'items': items}
+            if done:
+                fields['status'] = 'completed'
+            # Commit only if no other process pumped the batch meanwhile; an item we both
+            # scheduled resolves to the same task through schedule_extraction's dedup
+            if not extractor.tasks.compare_and_update(
+                batch_id, {'schedule': schedule}, fields, ttl=FILE_EXPIRY if done else None
+            ):
+                return
             
-        except Exception as e:
-            print(f"Streaming error: {e}")
-            return jsonify({'error': f'Failed to stream media: {str(e)}'}), 500
+            if done:
+                self._active.discard(batch_id)
+                return
+            self._active.add(batch_id)
+            for task_id in in_flight:
+                self._item_index.setdefault(task_id, set()).add(batch_id)
 
-# Initialize extractor
-extractor = MediaExtractor()
+    def pump_all(self, adopt=False):
+        """Pump the batches this process is running; with adopt, every unfinished batch in the store"""
+        with self._lock:
+            batch_ids = set(self._active)
+        if adopt:
+            for batch_id, batch in extractor.tasks.unfinished():
+                if batch.get('kind') != 'batch':
+                    continue
+                if batch['status'] == 'expanding':
+                    self._resume_expansion(batch_id, batch)
+                else:
+                    batch_ids.add(batch_id)
+        for batch_id in batch_ids:
+            self.pump(batch_id)
+
+    def poll(self, interval=BATCH_PUMP_INTERVAL):
+        """Pump this process's batches on a short timer
+
+        With an external job queue, items finish in worker processes, so
+        on_task_changed never fires here; this loop takes its place.
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                self.pump_all()
+            except Exception as e:
+                print(f"Batch pump error: {e}")
+
+    def on_task_changed(self, task_id):
+        """Task store listener: move a batch on when one of its items finishes"""
+        if task_id not in self._item_index:
+            return  # Cheap check first; this runs on every progress write
+        
+        task = extractor.tasks.get(task_id)
+        if task is not None and task['status'] not in TERMINAL_STATUSES:
+            return
+        
+        with self._lock:
+            batch_ids = self._item_index.pop(task_id, ())
+        for batch_id in batch_ids:
+            self.pump(batch_id)
+
+    def status(self, batch_id):
+        """Aggregate per-item task status into a batch summary, or None"""
+        batch = extractor.tasks.get(batch_id)
+        if batch is None or batch.get('kind') != 'batch':
+            return None
+        
+        counts = {'pending': 0, 'queued': 0, 'running': 0, 'completed': 0, 'error': 0, 'cancelled': 0}
+        total_progress = 0
+        items = []
+        for item in batch['items']:
+            task = extractor.tasks.get(item['task_id']) if item['task_id'] else None
+            if item.get('error'):
+                status, progress = 'error', 0
+            elif task is None:
+                status, progress = 'pending', 0
+            else:
+                status, progress = task['status'], task.get('progress', 0)
+            
+            bucket = status if status in counts else 'running'
+            counts[bucket] += 1
+            total_progress += 100 if status in TERMINAL_STATUSES else progress
+            items.append({
+                'url': item['url'],
+                'title': item.get('title') or (task or {}).get('video_info', {}).get('title'),
+                'task_id': item['task_id'],
+                'status': status,
+                'progress': progress,
+                'message': item.get('error') or (task or {}).get('message')
+            })
+        
+        total = len(items)
+        return {
+            'batch_id': batch_id,
+            'status': batch['status'],
+            'title': batch.get('title'),
+            'message': batch.get('message'),
+            'truncated': batch.get('truncated', False),
+            'total': total,
+            'counts': counts,
+            'progress': int(total_progress / total) if total else 0,
+            'items': items
+        }
+
+batch_manager = BatchManager()
+extractor.tasks.add_listener(batch_manager.on_task_changed)
+
+def run_queued_job(task_id, job):
+    """Run one job claimed from the external job queue (see worker.py)"""
+    if job.get('kind') == 'expand_playlist':
+        # Only lists the entries; the web process that owns the batch schedules them
+        batch_manager._expand(task_id, job['url'])
+        return
+    extractor.extract_raw_media(
+        job['url'], task_id, job['format_id'], job['media_type'],
+        job['preferred_format'], job['quality_settings']
+    )
+
+def parse_preferences(media_type, preferences):
+    """Map frontend preferences to (preferred_format, quality_settings)"""
+    quality_settings = {}
+    if media_type == 'audio':
+        preferred_format = preferences.get('selectedAudioFormat', 'mp3')
+        quality_settings['audioQuality'] = normalize_audio_quality(preferences.get('audioQuality'))
+    else:
+        preferred_format = preferences.get('selectedVideoFormat', 'mp4')
+        quality_settings['videoQuality'] = preferences.get('videoQuality', '720p')
+        quality_settings['audioQuality'] = normalize_audio_quality(preferences.get('audioQuality'))
+    return preferred_format, quality_settings
+
+_worker_ids = {}
+
+def current_worker_id():
+    """'<pid>:<token>' for this process; the token tells a restarted process apart from
+    its predecessor when both get the same PID (e.g. PID 1 in a container)"""
+    pid = os.getpid()  # Looked up per call so forked workers do not share an ID
+    return _worker_ids.setdefault(pid, f'{pid}:{uuid.uuid4().hex[:12]}')
+
+def is_worker_alive(worker_id):
+    """True if the process that owns worker_id is still running
+
+    Local workers are checked by PID on this host; with an external job
+    queue, workers may run anywhere and are judged by their heartbeats.
+    """
+    if not worker_id:
+        return False
+    if worker_id == current_worker_id():
+        return True
+    if job_broker is not None:
+        return job_broker.is_alive(worker_id)
+    pid = int(worker_id.split(':')[0])
+    if pid == os.getpid():
+        return False  # Our PID, but an earlier incarnation
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, owned by someone else
+    return True
+
+def resume_orphaned_jobs():
+    """Re-queue extraction jobs whose worker process died, keeping their task IDs
+
+    A job is orphaned when the worker recorded in its task is no longer
+    alive (or released it on shutdown). Each orphan is claimed with a
+    compare-and-set on worker_id, so when several processes start at once
+    only one of them resumes it. The job's temp directory is left in place,
+    so yt-dlp continues from its .part files.
+    With an external job queue, claims held by workers that stopped sending
+    heartbeats go back to the queue first, and orphans are re-queued on the
+    broker for any worker to pick up.
+    """
+    if job_broker is not None:
+        released = job_broker.requeue_stale()
+        if released:
+            print(f"Re-queued {len(released)} job(s) claimed by unresponsive workers")
+    
+    resumed = 0
+    for task_id, task in extractor.tasks.unfinished():
+        job = task.get('job')
+        worker_id = task.get('worker_id')
+        if not job or is_worker_alive(worker_id):
+            continue  # Batches, pre-descriptor tasks and jobs with a live owner
+        if job_broker is not None and job_broker.contains(task_id):
+            continue  # Waiting in the queue or claimed by a live worker
+        
+        now = time.time()
+        fields = {
+            'status': 'queued',
+            'worker_id': None if job_broker is not None else current_worker_id(),
+            'message': 'Resuming after a server restart...',
+            'resume_count': task.get('resume_count', 0) + 1,
+            'queued_at': now
+        }
+        if 'last_polled_at' in task:
+            fields['last_polled_at'] = now  # Give clients a fresh grace period to reconnect
+        if not extractor.tasks.compare_and_update(task_id, {'worker_id': worker_id}, fields):
+            continue  # Another process claimed it first
+        
+        try:
+            dispatch_extraction(task_id, job)
+        except QueueFullError:
+            # Hand it back so the next cleanup cycle (here or elsewhere) retries
+            extractor.tasks.update(task_id, {'worker_id': None})
+            break
+        resumed += 1
+    
+    if resumed:
+        print(f"Resumed {resumed} interrupted extraction job(s)")
+    return resumed
+
+def remove_stray_temp_dirs():
+    """Delete temp_<task_id> directories whose task finished or no longer exists"""
+    for temp_path in DOWNLOAD_DIR.glob('temp_*'):
+        task = extractor.tasks.get(temp_path.name[len('temp_'):])
+        if task is None or task['status'] in TERMINAL_STATUSES:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+def shutdown_scheduler():
+    """Drain running jobs on exit and release any that never started for another process to resume"""
+    # Downloads drain first since they can still hand work to the transcode pool
+    pools = [job_scheduler, transcode_scheduler]
+    if extraction_queue is not job_scheduler:
+        pools.insert(0, extraction_queue)
+    for task_id in [task_id for pool in pools for task_id in pool.shutdown()]:
+        extractor.tasks.update(task_id, {
+            'worker_id': None,
+            'message': 'Waiting for the server to restart...'
+        })
+
+atexit.register(shutdown_scheduler)
 
 # Routes
-@app.route('/api/validate', methods=['POST'])
+@app.route('/api/validate', methods=['GET', 'POST'])
 def validate_url():
-    """Validate URL and get video information"""
+    """Validate URL and get video information
+
+    Query parameters (or JSON body keys on POST):
+    - fields: comma-separated keys to return, e.g. title,duration,formats.format_id
+    - urls: 1 to include each format's signed upstream URL
+    GET responses can be revalidated with If-None-Match.
+    """
     try:
-        data = request.get_json()
-        url = data.get('url', '').strip()
+        data = (request.get_json(silent=True) if request.method == 'POST' else None) or {}
+        url = (data.get('url') or request.args.get('url', '')).strip()
+        fields = data.get('fields') or request.args.get('fields', '')
+        if isinstance(fields, str):
+            fields = [field.strip() for field in fields.split(',') if field.strip()]
+        include_urls = str(data.get('urls', request.args.get('urls', ''))).lower() in ('1', 'true', 'yes')
         
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
         if not extractor.is_valid_url(url):
-            return jsonify({'error': 'Invalid YouTube or SoundCloud URL'}), 400
+            return jsonify({'error': invalid_url_message(url)}), 400
         
-        # Get video info
-        video_info = extractor.get_video_info(url)
+        include_urls = include_urls or 'formats.url' in fields
+        unknown = [field for field in fields if field.partition('.')[0] not in VALIDATE_FIELDS]
+        if unknown:
+            return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
         
-        return jsonify({
+        # Cache misses cost an upstream request, so lookups share the per-client budget
+        admission.check_client(client_key())
+        video_info = extractor.get_video_info(url, include_urls=include_urls)
+        if fields:
+            video_info = project_fields(video_info, fields)
+        
+        return compressed_json_response({
             'valid': True,
             'info': video_info
         })
         
+    except OverloadedError as e:
+        return overloaded_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -394,38 +2912,92 @@ def extract_media():
         format_id = data.get('format_id')  # Optional specific format
         
         # User preferences from frontend
-        preferences = data.get('preferences', {})
-        preferred_format = None
-        quality_settings = {}
-        
-        if media_type == 'audio':
-            preferred_format = preferences.get('selectedAudioFormat', 'mp3')
-            quality_settings['audioQuality'] = preferences.get('audioQuality', '320k')
-        else:
-            preferred_format = preferences.get('selectedVideoFormat', 'mp4')
-            quality_settings['videoQuality'] = preferences.get('videoQuality', '720p')
-            quality_settings['audioQuality'] = preferences.get('audioQuality', '320k')
+        preferred_format, quality_settings = parse_preferences(media_type, data.get('preferences', {}))
         
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
         if not extractor.is_valid_url(url):
-            return jsonify({'error': 'Invalid YouTube or SoundCloud URL'}), 400
+            return jsonify({'error': invalid_url_message(url)}), 400
         
-        # Generate unique task ID
-        task_id = str(uuid.uuid4())
+        # Queue extraction on the worker pool, reusing identical jobs where possible
+        try:
+            admission.check_client(client_key())
+            task_id, queue_position, reused = schedule_extraction(
+                url, format_id, media_type, preferred_format, quality_settings, check_load=True
+            )
+        except OverloadedError as e:
+            return overloaded_response(e)
+        except QueueFullError as e:
+            return overloaded_response(queue_full_error(e))
+        except InsufficientStorageError as e:
+            return jsonify({'error': f'{str(e)}. Please retry later.'}), 507
         
-        # Start extraction in background thread with user preferences
-        thread = threading.Thread(
-            target=extractor.extract_raw_media, 
-            args=(url, task_id, format_id, media_type, preferred_format, quality_settings)
-        )
-        thread.daemon = True
-        thread.start()
+        if reused == 'completed':
+            message = f'Media already available with format: {preferred_format}'
+        elif reused == 'running':
+            message = f'Attached to running extraction with format: {preferred_format}'
+        else:
+            message = f'Media extraction queued with format: {preferred_format}'
         
         return jsonify({
             'task_id': task_id,
-            'message': f'Media extraction started with format: {preferred_format}',
+            'message': message,
+            'queue_position': queue_position,
+            'deduplicated': reused is not None,
+            'preferences': {
+                'format': preferred_format,
+                'quality': quality_settings
+            }
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/extract/batch', methods=['POST'])
+def extract_media_batch():
+    """Extract a list of URLs or a playlist/set URL as one batch
+
+    Body: {"urls": [...]} or {"url": "<playlist or set URL>"}, plus "type",
+    "preferences" and optional "concurrency" as for /api/extract.
+    """
+    try:
+        data = request.get_json() or {}
+        media_type = data.get('type', 'audio')
+        preferred_format, quality_settings = parse_preferences(media_type, data.get('preferences', {}))
+        concurrency = max(1, min(int(data.get('concurrency', BATCH_MAX_CONCURRENCY)), BATCH_MAX_CONCURRENCY))
+        
+        playlist_url = (data.get('url') or '').strip() or None
+        urls = [url.strip() for url in data.get('urls') or [] if url and url.strip()]
+        
+        if playlist_url:
+            if not extractor.is_playlist_url(playlist_url):
+                return jsonify({'error': 'Expected a YouTube playlist or SoundCloud set URL'}), 400
+        else:
+            if not urls:
+                return jsonify({'error': 'A list of URLs or a playlist URL is required'}), 400
+            if len(urls) > BATCH_MAX_ITEMS:
+                return jsonify({'error': f'Batches are limited to {BATCH_MAX_ITEMS} URLs'}), 400
+            invalid = [url for url in urls if not extractor.is_valid_url(url)]
+            if invalid:
+                return jsonify({'error': 'Invalid YouTube or SoundCloud URL', 'invalid_urls': invalid}), 400
+        
+        try:
+            # One token per batch: its items are already paced by the batch concurrency cap
+            admission.check_client(client_key())
+            admission.check_load()
+            batch_id = batch_manager.start(
+                urls, media_type, preferred_format, quality_settings, concurrency, playlist_url
+            )
+        except OverloadedError as e:
+            return overloaded_response(e)
+        except QueueFullError as e:
+            return overloaded_response(queue_full_error(e))
+        
+        return jsonify({
+            'batch_id': batch_id,
+            'message': 'Playlist expansion started' if playlist_url else f'Batch of {len(urls)} items started',
+            'concurrency': concurrency,
             'preferences': {
                 'format': preferred_format,
                 'quality': quality_settings
@@ -435,74 +3007,298 @@ def extract_media():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """Get aggregated progress and per-item status for a batch"""
+    status = batch_manager.status(batch_id)
+    if status is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    return jsonify(status)
+
+@app.route('/api/extract/stream', methods=['GET'])
+def extract_media_stream():
+    """Opt-in streaming mode: encode on the fly and send bytes while the job runs
+
+    Query parameters: url, type ('audio' or 'video'), format, audioQuality, videoQuality.
+    """
+    url = request.args.get('url', '').strip()
+    media_type = request.args.get('type', 'audio')
+    preferred_format = request.args.get('format') or ('mp3' if media_type == 'audio' else 'mp4')
+    quality_settings = {'audioQuality': normalize_audio_quality(request.args.get('audioQuality'))}
+    if media_type != 'audio':
+        quality_settings['videoQuality'] = request.args.get('videoQuality', '720p')
+    
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    
+    if not extractor.is_valid_url(url):
+        return jsonify({'error': invalid_url_message(url)}), 400
+    
+    try:
+        admission.check_client(client_key())
+        admission.check_load()
+    except OverloadedError as e:
+        return overloaded_response(e)
+    
+    if not extractor.stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many active streams, use /api/extract instead'}), 503
+    
+    try:
+        filename, mimetype, chunks = extractor.stream_through(
+            url, media_type, preferred_format, quality_settings
+        )
+        # Wait for the first encoded bytes so upstream failures still get a proper error status
+        first_chunk = next(chunks, None)
+    except ValueError as e:
+        extractor.stream_slots.release()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        extractor.stream_slots.release()
+        return jsonify({'error': f'Failed to start stream: {str(e)}'}), 500
+    
+    if first_chunk is None:
+        extractor.stream_slots.release()
+        return jsonify({'error': 'Upstream produced no media'}), 502
+    
+    def body():
+        try:
+            yield first_chunk
+            yield from chunks  # Closing body() on client disconnect also closes chunks
+        finally:
+            extractor.stream_slots.release()
+    
+    return Response(
+        body(),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f"inline; filename*=UTF-8''{quote(filename)}",
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@app.route('/api/proxy/<format_id>', methods=['GET'])
+def proxy_media(format_id):
+    """Relay an upstream format byte-for-byte for client-side processing (no transcoding)
+
+    Query parameter: url, the page URL the format was listed for by /api/validate.
+    """
+    url = request.args.get('url', '').strip()
+    
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    
+    if not extractor.is_valid_url(url):
+        return jsonify({'error': invalid_url_message(url)}), 400
+    
+    return extractor.stream_media(url, format_id, request.headers)
+
 @app.route('/api/status/<task_id>', methods=['GET'])
 def get_extraction_status(task_id):
     """Get extraction status"""
-    if task_id not in extractor.active_downloads:
+    task = extractor.tasks.get(task_id)
+    if task is None:
         return jsonify({'error': 'Task not found'}), 404
     
-    return jsonify(extractor.active_downloads[task_id])
+    record_poll(task_id, task)
+    queue_info = task_queue_info(task_id)
+    if queue_info:
+        task.update(queue_info)
+    
+    return jsonify(task)
 
-@app.route('/api/stream/<task_id>', methods=['GET'])
-def stream_media(task_id):
-    """Serve the downloaded file"""
-    if task_id not in extractor.active_downloads:
+def cancel_task(task_id):
+    """Cancel a queued or running extraction, or delete a finished task and its artifact
+
+    Returns the resulting state: 'cancelled' when the job never started,
+    'cancelling' when a running job has been told to stop, 'deleted' for
+    finished tasks, 'detached' when other deduplicated clients still share
+    the task (only this caller's attachment is dropped), or None if the
+    task does not exist.
+    """
+    while True:
+        task = extractor.tasks.get(task_id)
+        if task is None:
+            return None
+        attachments = task.get('attachments')
+        if (attachments or 1) <= 1:
+            break
+        # Fails only if another client attached or let go meanwhile; re-read and try again
+        if extractor.tasks.compare_and_update(task_id, {'attachments': attachments}, {'attachments': attachments - 1}):
+            return 'detached'
+    
+    if task['status'] in TERMINAL_STATUSES:
+        remove_artifact(task)
+        extractor.tasks.delete(task_id)
+        return 'deleted'
+    
+    # The flag reaches the owning worker through the store even if it runs in another process
+    extractor.tasks.update(task_id, {'cancel_requested': True})
+    if task['status'] == 'queued':
+        extraction_queue.cancel(task_id)
+        metrics.jobs_cancelled.inc(reason='cancelled')
+        extractor.tasks.update(task_id, {'status': 'cancelled', 'message': 'Cancelled by request'})
+        return 'cancelled'
+    
+    job_monitor.cancel(task_id)
+    extractor.tasks.update(task_id, {'message': 'Cancelling...'})
+    return 'cancelling'
+
+@app.route('/api/tasks/<task_id>', methods=['DELETE'])
+def delete_task(task_id):
+    """Cancel an extraction (freeing its worker, ffmpeg process and temp files) or delete its artifact"""
+    try:
+        state = cancel_task(task_id)
+    except Exception as e:
+        return jsonify({'error': f'Failed to cancel task: {str(e)}'}), 500
+    
+    if state is None:
+        return jsonify({'error': 'Task not found'}), 404
+    return jsonify({'task_id': task_id, 'status': state}), 202 if state == 'cancelling' else 200
+
+@app.route('/api/status/<task_id>/events', methods=['GET'])
+def stream_extraction_status(task_id):
+    """Push status changes as Server-Sent Events; /api/status/<task_id> remains the polling fallback"""
+    if extractor.tasks.get(task_id) is None:
         return jsonify({'error': 'Task not found'}), 404
     
-    task = extractor.active_downloads[task_id]
+    version = task_events.acquire(task_id)
+    if version is None:
+        return jsonify({'error': 'Too many open event streams, fall back to polling'}), 503
+    
+    def generate():
+        try:
+            yield f"retry: {SSE_RECHECK_INTERVAL * 1000}\n\n"
+            last_payload = None
+            last_sent = time.time()
+            current_version = version
+            while True:
+                task = extractor.tasks.get(task_id)
+                if task is None:
+                    yield 'event: gone\ndata: {}\n\n'
+                    return
+                
+                queue_info = task_queue_info(task_id)
+                if queue_info:
+                    task.update(queue_info)
+                
+                payload = json.dumps(task)
+                if payload != last_payload:
+                    yield f"event: status\ndata: {payload}\n\n"
+                    last_payload = payload
+                    last_sent = time.time()
+                elif time.time() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                    yield ': heartbeat\n\n'
+                    last_sent = time.time()
+                
+                if task['status'] in TERMINAL_STATUSES:
+                    return
+                
+                record_poll(task_id, task)  # An open stream counts as a client still watching
+                current_version = task_events.wait(task_id, current_version, SSE_RECHECK_INTERVAL)
+        finally:
+            task_events.release(task_id)
+    
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+        }
+    )
+
+def serve_artifact(task_id, as_attachment):
+    """Serve a completed artifact with Range, If-Range, ETag and Last-Modified support
+
+    send_file answers conditional and partial requests itself and hands the
+    file to the server's wsgi.file_wrapper, which uses sendfile(2) on servers
+    such as gunicorn. Behind nginx, X-Accel-Redirect lets nginx do all of it.
+    Artifacts in object storage are a redirect to a short-lived presigned URL.
+    """
+    task = extractor.tasks.get(task_id)
+    if task is None:
+        return jsonify({'error': 'Task not found'}), 404
     
     if task['status'] != 'completed':
         return jsonify({'error': 'Download not completed'}), 400
     
+    if task.get('artifact_key'):
+        filename = task.get('filename', 'download')
+        url = artifacts.presigned_url(task['artifact_key'], filename, as_attachment, artifact_mimetype(filename))
+        if not url:
+            return jsonify({'error': 'Downloaded file not found'}), 404
+        extractor.tasks.update(task_id, {'last_accessed_at': time.time()}, ttl=FILE_EXPIRY)
+        response = redirect(url, code=302)
+        response.headers['Cache-Control'] = 'no-store'  # The URL expires; always ask us for a fresh one
+        return response
+    
     file_path = task.get('file_path')
     if not file_path or not Path(file_path).exists():
         return jsonify({'error': 'Downloaded file not found'}), 404
     
-    try:
-        response = send_file(
-            file_path,
-            as_attachment=True,
-            download_name=task.get('filename', 'download'),
-            mimetype='application/octet-stream'
+    file_path = Path(file_path)
+    filename = task.get('filename', 'download')
+    
+    # Accessing an artifact keeps it (and its task) alive for another FILE_EXPIRY
+    extractor.tasks.update(task_id, {'last_accessed_at': time.time()}, ttl=FILE_EXPIRY)
+    disk_quota.touch(file_path)
+    
+    mimetype = artifact_mimetype(filename) if not as_attachment else 'application/octet-stream'
+    
+    endpoint = 'download' if as_attachment else 'stream'
+    if X_ACCEL_REDIRECT_PREFIX:
+        disposition = 'attachment' if as_attachment else 'inline'
+        if not request.headers.get('Range'):
+            metrics.served_bytes.inc(file_path.stat().st_size, endpoint=endpoint)  # nginx handles ranges itself
+        return Response(
+            mimetype=mimetype,
+            headers={
+                'X-Accel-Redirect': X_ACCEL_REDIRECT_PREFIX + quote(file_path.name),
+                'Content-Disposition': f"{disposition}; filename*=UTF-8''{quote(filename)}"
+            }
         )
-        return response
+    
+    stat_result = file_path.stat()
+    response = send_file(
+        file_path.resolve(),  # Flask resolves relative paths against the app's root, not the working directory
+        as_attachment=as_attachment,
+        download_name=filename,
+        mimetype=mimetype,
+        conditional=True,
+        etag=artifact_etag(stat_result),
+        last_modified=stat_result.st_mtime,
+        max_age=FILE_EXPIRY
+    )
+    # After conditional processing this is the 206 slice length, or 0 for a 304
+    if response.status_code in (200, 206):
+        metrics.served_bytes.inc(response.content_length or 0, endpoint=endpoint)
+    return response
+
+@app.route('/api/stream/<task_id>', methods=['GET'])
+def stream_media(task_id):
+    """Serve the downloaded file inline so media players can seek"""
+    try:
+        return serve_artifact(task_id, as_attachment=False)
     except Exception as e:
         return jsonify({'error': f'Failed to serve file: {str(e)}'}), 500
 
 @app.route('/api/download/<task_id>', methods=['GET']) 
 def download_file(task_id):
     """Download the processed file"""
-    if task_id not in extractor.active_downloads:
-        return jsonify({'error': 'Task not found'}), 404
-    
-    task = extractor.active_downloads[task_id]
-    
-    if task['status'] != 'completed':
-        return jsonify({'error': 'Download not completed'}), 400
-    
-    file_path = task.get('file_path')
-    if not file_path or not Path(file_path).exists():
-        return jsonify({'error': 'Downloaded file not found'}), 404
-    
     try:
-        response = send_file(
-            file_path,
-            as_attachment=True,
-            download_name=task.get('filename', 'download'),
-            mimetype='application/octet-stream'
-        )
-        return response
+        return serve_artifact(task_id, as_attachment=True)
     except Exception as e:
         return jsonify({'error': f'Failed to download file: {str(e)}'}), 500
 
 @app.route('/api/thumbnail/<task_id>', methods=['GET'])
 def get_thumbnail(task_id):
     """Get video thumbnail"""
-    if task_id not in extractor.active_downloads:
+    task = extractor.tasks.get(task_id)
+    if task is None:
         return jsonify({'error': 'Task not found'}), 404
     
-    task = extractor.active_downloads[task_id]
-    
     if task['status'] != 'completed':
         return jsonify({'error': 'Extraction not completed'}), 400
     
@@ -510,25 +3306,53 @@ def get_thumbnail(task_id):
     if not thumbnail_url:
         return jsonify({'error': 'Thumbnail not available'}), 404
     
+    size = request.args.get('size', 'large')
+    image_format = request.args.get('format')
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({'error': f'Invalid size, expected one of: {", ".join(THUMBNAIL_SIZES)}'}), 400
+    if image_format is not None and image_format not in THUMBNAIL_FORMATS:
+        return jsonify({'error': f'Invalid format, expected one of: {", ".join(THUMBNAIL_FORMATS)}'}), 400
+    
     try:
-        thumbnail_data = extractor.download_thumbnail(thumbnail_url)
-        if thumbnail_data:
-            return Response(
-                thumbnail_data,
-                content_type='image/jpeg',
-                headers={
-                    'Cache-Control': 'public, max-age=3600'
-                }
-            )
-        else:
+        entry = extractor.get_thumbnail(thumbnail_url, size, image_format)
+        if entry is None:
             return jsonify({'error': 'Failed to download thumbnail'}), 500
+        
+        data, content_type, etag = entry
+        headers = {
+            'Cache-Control': 'public, max-age=3600',
+            'ETag': f'"{etag}"'
+        }
+        if f'"{etag}"' in request.headers.get('If-None-Match', ''):
+            return Response(status=304, headers=headers)
+        
+        return Response(data, content_type=content_type, headers=headers)
     except Exception as e:
         return jsonify({'error': f'Thumbnail error: {str(e)}'}), 500
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'message': 'CarbaLite backend is running'})
+    return jsonify({
+        'status': 'healthy',
+        'message': 'CarbaLite backend is running',
+        'metadata_cache': extractor.metadata_cache.stats(),
+        'thumbnail_cache': extractor.thumbnail_cache.stats(),
+        'scheduler': extraction_queue.stats(),
+        'transcode_scheduler': transcode_scheduler.stats(),
+        'download_connections': download_connections.stats(),
+        'admission': admission.stats(),
+        'tasks': extractor.tasks.count(),
+        'event_streams': task_events.connections,
+        'disk': disk_quota.stats(),
+        'artifact_store': ARTIFACT_STORE_BACKEND,
+        'job_queue': JOB_QUEUE_BACKEND
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus-style metrics for this process"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/cors-test', methods=['GET', 'POST', 'OPTIONS'])
 def cors_test():
@@ -550,53 +3374,85 @@ def start_download():
     }), 410
 
 def cleanup_old_tasks():
-    """Clean up old extraction tasks and downloaded files"""
+    """Clean up expired extraction tasks and their files"""
+    # Account for artifacts left over from a previous run once, instead of rescanning every cycle
+    try:
+        disk_quota.seed()
+    except Exception as e:
+        print(f"Error scanning download directory: {e}")
+    
     while True:
         try:
             current_time = time.time()
-            # Remove tasks older than 1 hour and clean up files
-            tasks_to_remove = []
-            for task_id, task_data in extractor.active_downloads.items():
-                # Simple cleanup when too many tasks (in production, add timestamps)
-                if len(extractor.active_downloads) > 100:
-                    tasks_to_remove.append(task_id)
-            
-            for task_id in tasks_to_remove[:50]:  # Remove oldest 50 tasks
-                task_data = extractor.active_downloads.get(task_id)
-                if task_data and 'file_path' in task_data:
+            # Remove expired tasks (found through the store's expiry index) and their files
+            for task_id, task_data in extractor.tasks.expired(current_time):
+                if task_data.get('status') not in TERMINAL_STATUSES:
+                    # Still queued or running elsewhere; extend its lease instead of evicting it. Only the
+                    # expiry changes, and only if the status is still what we read, so a worker finishing
+                    # the job meanwhile is never overwritten with this stale copy
+                    extractor.tasks.compare_and_update(
+                        task_id, {'status': task_data.get('status')}, {}, ttl=DEFAULT_TASK_TTL
+                    )
+                    continue
+                
+                if 'file_path' in task_data or 'artifact_key' in task_data:
                     # Clean up downloaded file
                     try:
-                        file_path = Path(task_data['file_path'])
-                        if file_path.exists():
-                            file_path.unlink()
-                            print(f"Cleaned up file: {file_path}")
+                        remove_artifact(task_data)
+                        print(f"Cleaned up file: {task_data.get('file_path') or task_data['artifact_key']}")
                     except Exception as e:
                         print(f"Error cleaning up file: {e}")
                 
-                extractor.active_downloads.pop(task_id, None)
+                extractor.tasks.delete(task_id)
                 print(f"Cleaned up old task: {task_id}")
             
-            # Also clean up orphaned files in download directory
-            try:
-                for file_path in DOWNLOAD_DIR.glob('*'):
-                    if file_path.is_file():
-                        # Remove files older than 2 hours
-                        file_age = current_time - file_path.stat().st_mtime
-                        if file_age > 7200:  # 2 hours
-                            file_path.unlink()
-                            print(f"Cleaned up orphaned file: {file_path}")
-            except Exception as e:
-                print(f"Error cleaning up orphaned files: {e}")
+            # Pick up jobs from workers that died (deploys, crashes) and drop leftovers of finished ones
+            resume_orphaned_jobs()
+            remove_stray_temp_dirs()
+            
+            # Catch free-space pressure caused by anything outside our own accounting
+            disk_quota.enforce()
+            
+            # Retry batch items that could not be queued earlier because the queue was full,
+            # and carry on batches (or restart expansions) left behind by processes that went away
+            batch_manager.pump_all(adopt=True)
                 
         except Exception as e:
             print(f"Error during cleanup: {e}")
         
         time.sleep(CLEANUP_INTERVAL)
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_tasks)
-cleanup_thread.daemon = True
-cleanup_thread.start()
+cleanup_thread = None
+batch_pump_thread = None
+_background_lock = threading.Lock()
+
+def start_background_tasks():
+    """Create DOWNLOAD_DIR and start the cleanup thread, once per process
+
+    Nothing starts at import time, so serverless handlers that only import
+    this module stay cheap. Long-running servers start these on their first
+    request (or from the ASGI lifespan / __main__); worker pools start
+    themselves when the first job is submitted.
+    """
+    global cleanup_thread, batch_pump_thread
+    if cleanup_thread is not None:
+        return
+    with _background_lock:
+        if cleanup_thread is not None:
+            return
+        DOWNLOAD_DIR.mkdir(exist_ok=True)
+        if job_broker is not None:
+            batch_pump_thread = threading.Thread(target=batch_manager.poll, name='carbalite-batch-pump')
+            batch_pump_thread.daemon = True
+            batch_pump_thread.start()
+        thread = threading.Thread(target=cleanup_old_tasks, name='carbalite-cleanup')
+        thread.daemon = True
+        thread.start()
+        cleanup_thread = thread
+
+@app.before_request
+def ensure_background_tasks():
+    start_background_tasks()
 
 if __name__ == '__main__':
     print("CarbaLite Backend Server Starting...")
@@ -607,4 +3463,5 @@ if __name__ == '__main__':
     print("Ready for production deployment")
     print("=" * 60)
     
+    start_background_tasks()
     app.run(debug=True, port=5000, host='0.0.0.0')
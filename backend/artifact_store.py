@@ -0,0 +1,144 @@
+"""
+Artifact storage for CarbaLite
+Where completed outputs live once a job finishes: the local DOWNLOAD_DIR
+(served by the app itself) or an S3-compatible bucket (AWS S3, MinIO, R2...)
+that clients download from directly through short-lived presigned URLs
+"""
+
+import os
+from pathlib import Path
+from urllib.parse import quote
+
+ARTIFACT_STORE_BACKEND = os.getenv('CARBALITE_ARTIFACT_STORE', 'local')  # 'local' or 's3'
+S3_BUCKET = os.getenv('CARBALITE_S3_BUCKET')
+S3_ENDPOINT_URL = os.getenv('CARBALITE_S3_ENDPOINT_URL')  # e.g. http://127.0.0.1:9000 for a local MinIO
+S3_REGION = os.getenv('CARBALITE_S3_REGION', 'us-east-1')
+S3_PREFIX = os.getenv('CARBALITE_S3_PREFIX', 'artifacts/')
+PRESIGNED_URL_TTL = int(os.getenv('CARBALITE_PRESIGNED_URL_TTL', 300))  # Long enough to start, short enough not to share
+MULTIPART_CHUNK_SIZE = int(os.getenv('CARBALITE_MULTIPART_CHUNK_SIZE', 8 * 1024 * 1024))
+MULTIPART_CONCURRENCY = int(os.getenv('CARBALITE_MULTIPART_CONCURRENCY', 4))
+
+
+class ArtifactStore:
+    """Interface for artifact backends
+
+    put() takes a finished file from DOWNLOAD_DIR and returns the key the
+    task record keeps. Remote stores own the bytes afterwards (the local copy
+    is removed) and hand out presigned URLs; the local store leaves the file
+    where it is and is served by the app.
+    """
+
+    remote = False
+
+    def put(self, task_id, local_path, filename, content_type):
+        """Store a finished artifact and return its key"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def exists(self, key):
+        """Whether the artifact is still stored (remote objects can expire through bucket lifecycle rules)"""
+        raise NotImplementedError
+
+    def presigned_url(self, key, filename, as_attachment, content_type):
+        """Short-lived URL the client can fetch the artifact from directly, or None"""
+        return None
+
+
+class LocalArtifactStore(ArtifactStore):
+    """Artifacts stay in DOWNLOAD_DIR; the key is the file path"""
+
+    def put(self, task_id, local_path, filename, content_type):
+        return str(local_path)
+
+    def delete(self, key):
+        Path(key).unlink(missing_ok=True)
+
+    def exists(self, key):
+        return Path(key).exists()
+
+
+class S3ArtifactStore(ArtifactStore):
+    """Artifacts in an S3-compatible bucket, uploaded as streamed multipart uploads
+
+    Needs boto3. Credentials come from the usual AWS environment variables or
+    config files; set CARBALITE_S3_ENDPOINT_URL for MinIO and other
+    non-AWS services (path-style addressing is used so no DNS setup is needed).
+    """
+
+    remote = True
+
+    def __init__(self, bucket=S3_BUCKET, endpoint_url=S3_ENDPOINT_URL, region=S3_REGION, prefix=S3_PREFIX,
+                 url_ttl=PRESIGNED_URL_TTL):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError('The s3 artifact store needs boto3: pip install boto3')
+        if not bucket:
+            raise ValueError('CARBALITE_S3_BUCKET is required for the s3 artifact store')
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_ttl = url_ttl
+        self._client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(signature_version='s3v4', s3={'addressing_style': 'path'})
+        )
+        # Parts are read from disk and sent one chunk at a time, never the whole file in memory
+        self._transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+            max_concurrency=MULTIPART_CONCURRENCY
+        )
+
+    def put(self, task_id, local_path, filename, content_type):
+        key = f'{self.prefix}{task_id}/{Path(local_path).name}'
+        self._client.upload_file(
+            str(local_path), self.bucket, key,
+            ExtraArgs={
+                'ContentType': content_type,
+                'ContentDisposition': f"attachment; filename*=UTF-8''{quote(filename)}"
+            },
+            Config=self._transfer_config
+        )
+        Path(local_path).unlink(missing_ok=True)
+        return key
+
+    def delete(self, key):
+        self._client.delete_object(Bucket=self.bucket, Key=key)
+
+    def exists(self, key):
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=key)
+        except self._client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def presigned_url(self, key, filename, as_attachment, content_type):
+        disposition = 'attachment' if as_attachment else 'inline'
+        return self._client.generate_presigned_url(
+            'get_object',
+            Params={
+                'Bucket': self.bucket,
+                'Key': key,
+                'ResponseContentDisposition': f"{disposition}; filename*=UTF-8''{quote(filename)}",
+                'ResponseContentType': 'application/octet-stream' if as_attachment else content_type
+            },
+            ExpiresIn=self.url_ttl
+        )
+
+
+def create_artifact_store(backend=ARTIFACT_STORE_BACKEND):
+    """Build the configured artifact store"""
+    if backend == 'local':
+        return LocalArtifactStore()
+    if backend == 's3':
+        return S3ArtifactStore()
+    raise ValueError(f"Unknown artifact store backend: {backend}")
@@ -0,0 +1,472 @@
+"""
+ASGI serving mode for CarbaLite
+Serves the read-only, I/O-heavy endpoints (status polls, status events,
+artifact stream/download and the upstream proxy) from an asyncio event loop,
+so a slow client holds a coroutine instead of a worker thread. Every other
+route is handed to the Flask app through asgiref's WSGI adapter, and
+extraction jobs keep running on app.py's worker pools in the same process,
+sharing its task store, caches and event listeners.
+
+Run with any ASGI server, for example (from backend/):
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Blocking calls (task store reads, file reads, metadata resolution) run on a
+small fixed executor; the upstream proxy needs httpx and falls back to the
+Flask route without it.
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+from email.utils import formatdate
+from urllib.parse import parse_qs, quote
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+
+try:
+    import httpx  # Optional: non-blocking upstream I/O for /api/proxy
+except ImportError:
+    httpx = None
+
+import app as carbalite
+import metrics
+
+ASGI_BLOCKING_WORKERS = int(os.getenv('CARBALITE_ASGI_BLOCKING_WORKERS', 8))
+FILE_READ_SIZE = carbalite.ARTIFACT_CHUNK_SIZE
+
+STATUS_RE = re.compile(r'^/api/status/([\w-]+)$')
+EVENTS_RE = re.compile(r'^/api/status/([\w-]+)/events$')
+ARTIFACT_RE = re.compile(r'^/api/(stream|download)/([\w-]+)$')
+PROXY_RE = re.compile(r'^/api/proxy/([^/]+)$')
+
+_blocking_pool = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_WORKERS, thread_name_prefix='carbalite-asgi')
+_upstream_client = None
+
+
+async def run_blocking(func, *args):
+    """Run a short blocking call on the shared executor"""
+    return await asyncio.get_running_loop().run_in_executor(_blocking_pool, func, *args)
+
+
+def get_upstream_client():
+    global _upstream_client
+    if _upstream_client is None:
+        _upstream_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(carbalite.UPSTREAM_SOCKET_TIMEOUT),
+            limits=httpx.Limits(max_keepalive_connections=carbalite.PROXY_POOL_SIZE),
+            follow_redirects=True
+        )
+    return _upstream_client
+
+
+class AsyncTaskEvents:
+    """Asyncio counterpart of app.TaskEventHub: wakes event streams from task store writes
+
+    The store calls notify from whichever thread made the change, so waiters
+    are woken through their loop's call_soon_threadsafe.
+    """
+
+    def __init__(self, max_connections=carbalite.SSE_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self.connections = 0
+        self._waiters = {}  # task_id -> set of (loop, asyncio.Event)
+
+    def notify(self, task_id):
+        for loop, event in list(self._waiters.get(task_id, ())):
+            loop.call_soon_threadsafe(event.set)
+
+    def acquire(self, task_id):
+        """Reserve a stream slot; returns its event or None when at capacity"""
+        if self.connections >= self.max_connections:
+            return None
+        self.connections += 1
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        self._waiters.setdefault(task_id, set()).add(waiter)
+        return waiter
+
+    def release(self, task_id, waiter):
+        self.connections -= 1
+        waiters = self._waiters.get(task_id)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del self._waiters[task_id]
+
+    async def wait(self, waiter, timeout):
+        """Sleep until the task changes in this process or timeout passes"""
+        event = waiter[1]
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+
+task_events = AsyncTaskEvents()
+carbalite.extractor.tasks.add_listener(task_events.notify)
+
+
+class Request:
+    """The parts of an ASGI HTTP scope the native handlers need"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers') or []}
+        self.args = {name: values[0] for name, values in
+                     parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+
+    def header(self, name):
+        return self.headers.get(name.lower())
+
+    def cors_headers(self):
+        """Mirror the flask-cors policy for responses that never reach Flask"""
+        origin = self.header('Origin')
+        if origin not in carbalite.ALLOWED_ORIGINS:
+            return []
+        return [
+            ('Access-Control-Allow-Origin', origin),
+            ('Access-Control-Expose-Headers', 'Content-Length, Content-Type, Content-Disposition, '
+                                              'Accept-Ranges, Content-Range, ETag, Last-Modified'),
+            ('Vary', 'Origin'),
+        ]
+
+
+def watch_disconnect(receive):
+    """Return an event set once the client goes away, so long responses can stop early"""
+    disconnected = asyncio.Event()
+
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    disconnected.watcher = asyncio.ensure_future(watch())
+    return disconnected
+
+
+async def start_response(send, request, status, headers):
+    headers = list(headers) + request.cors_headers()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers],
+    })
+
+
+async def send_json(send, request, status, payload, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await start_response(send, request, status, [
+        ('Content-Type', 'application/json'), ('Content-Length', len(body))
+    ] + list(headers))
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def status_endpoint(request, send, task_id):
+    """GET /api/status/<task_id>, as in app.get_extraction_status"""
+    def load():
+        task = carbalite.extractor.tasks.get(task_id)
+        if task is not None:
+            carbalite.record_poll(task_id, task)
+            task.update(carbalite.task_queue_info(task_id) or {})
+        return task
+
+    task = await run_blocking(load)
+    if task is None:
+        await send_json(send, request, 404, {'error': 'Task not found'})
+        return
+    await send_json(send, request, 200, task)
+
+
+async def events_endpoint(request, receive, send, task_id):
+    """GET /api/status/<task_id>/events, as in app.stream_extraction_status"""
+    if await run_blocking(carbalite.extractor.tasks.get, task_id) is None:
+        await send_json(send, request, 404, {'error': 'Task not found'})
+        return
+
+    waiter = task_events.acquire(task_id)
+    if waiter is None:
+        await send_json(send, request, 503, {'error': 'Too many open event streams, fall back to polling'})
+        return
+
+    def load():
+        task = carbalite.extractor.tasks.get(task_id)
+        if task is not None:
+            task.update(carbalite.task_queue_info(task_id) or {})
+        return task
+
+    async def emit(text):
+        await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+    disconnected = watch_disconnect(receive)
+    try:
+        await start_response(send, request, 200, [
+            ('Content-Type', 'text/event-stream'),
+            ('Cache-Control', 'no-cache'),
+            ('X-Accel-Buffering', 'no'),
+        ])
+        await emit(f"retry: {carbalite.SSE_RECHECK_INTERVAL * 1000}\n\n")
+        last_payload = None
+        last_sent = time.time()
+        while not disconnected.is_set():
+            task = await run_blocking(load)
+            if task is None:
+                await emit('event: gone\ndata: {}\n\n')
+                break
+
+            payload = json.dumps(task)
+            if payload != last_payload:
+                await emit(f"event: status\ndata: {payload}\n\n")
+                last_payload = payload
+                last_sent = time.time()
+            elif time.time() - last_sent >= carbalite.SSE_HEARTBEAT_INTERVAL:
+                await emit(': heartbeat\n\n')
+                last_sent = time.time()
+
+            if task['status'] in carbalite.TERMINAL_STATUSES:
+                break
+
+            await run_blocking(carbalite.record_poll, task_id, task)
+            await task_events.wait(waiter, carbalite.SSE_RECHECK_INTERVAL)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.watcher.cancel()
+        task_events.release(task_id, waiter)
+
+
+async def artifact_endpoint(request, receive, send, task_id, as_attachment):
+    """GET/HEAD /api/stream|download/<task_id>, as in app.serve_artifact"""
+    def load():
+        task = carbalite.extractor.tasks.get(task_id)
+        if task is None or task['status'] != 'completed':
+            return task, None
+        if task.get('artifact_key'):
+            filename = task.get('filename', 'download')
+            url = carbalite.artifacts.presigned_url(
+                task['artifact_key'], filename, as_attachment, carbalite.artifact_mimetype(filename)
+            )
+            if url:
+                carbalite.extractor.tasks.update(task_id, {'last_accessed_at': time.time()}, ttl=carbalite.FILE_EXPIRY)
+            return task, url
+        file_path = carbalite.Path(task.get('file_path') or '')
+        if not task.get('file_path') or not file_path.exists():
+            return task, None
+        carbalite.extractor.tasks.update(task_id, {'last_accessed_at': time.time()}, ttl=carbalite.FILE_EXPIRY)
+        carbalite.disk_quota.touch(file_path)
+        return task, (file_path, file_path.stat())
+
+    task, artifact = await run_blocking(load)
+    if task is None:
+        await send_json(send, request, 404, {'error': 'Task not found'})
+        return
+    if task['status'] != 'completed':
+        await send_json(send, request, 400, {'error': 'Download not completed'})
+        return
+    if artifact is None:
+        await send_json(send, request, 404, {'error': 'Downloaded file not found'})
+        return
+    if isinstance(artifact, str):
+        # In object storage: redirect to a short-lived presigned URL
+        await start_response(send, request, 302, [
+            ('Location', artifact), ('Cache-Control', 'no-store'), ('Content-Length', 0)
+        ])
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    file_path, stat_result = artifact
+    filename = task.get('filename', 'download')
+    endpoint = 'download' if as_attachment else 'stream'
+    disposition = 'attachment' if as_attachment else 'inline'
+    headers = [
+        ('Content-Type', 'application/octet-stream' if as_attachment else carbalite.artifact_mimetype(filename)),
+        ('Content-Disposition', f"{disposition}; filename*=UTF-8''{quote(filename)}"),
+    ]
+
+    if carbalite.X_ACCEL_REDIRECT_PREFIX:
+        if not request.header('Range'):
+            metrics.served_bytes.inc(stat_result.st_size, endpoint=endpoint)  # nginx handles ranges itself
+        headers.append(('X-Accel-Redirect', carbalite.X_ACCEL_REDIRECT_PREFIX + quote(file_path.name)))
+        await start_response(send, request, 200, headers + [('Content-Length', 0)])
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    etag = carbalite.artifact_etag(stat_result)
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers += [
+        ('ETag', f'"{etag}"'),
+        ('Last-Modified', last_modified),
+        ('Accept-Ranges', 'bytes'),
+        ('Cache-Control', f'public, max-age={carbalite.FILE_EXPIRY}'),
+    ]
+    if carbalite.artifact_not_modified(
+        request.header('If-None-Match'), request.header('If-Modified-Since'), etag, stat_result.st_mtime
+    ):
+        await start_response(send, request, 304, headers)
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    file_size = stat_result.st_size
+    status, start, end = 200, 0, file_size - 1
+    try:
+        byte_range = carbalite.artifact_byte_range(
+            request.header('Range'), request.header('If-Range'), etag, stat_result.st_mtime, file_size
+        )
+    except ValueError:
+        await start_response(send, request, 416, [('Content-Range', f'bytes */{file_size}'), ('Content-Length', 0)])
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    if byte_range is not None:
+        status, (start, end) = 206, byte_range
+        headers.append(('Content-Range', f'bytes {start}-{end}/{file_size}'))
+
+    length = max(0, end - start + 1)
+    await start_response(send, request, status, headers + [('Content-Length', length)])
+    if request.method == 'HEAD':
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    metrics.served_bytes.inc(length, endpoint=endpoint)
+    if status == 200 and 'http.response.pathsend' in (request.scope.get('extensions') or {}):
+        await send({'type': 'http.response.pathsend', 'path': str(file_path.resolve())})  # Server sends it, e.g. with sendfile
+        return
+
+    f = await run_blocking(open, file_path, 'rb')
+    disconnected = watch_disconnect(receive)
+    try:
+        await run_blocking(f.seek, start)
+        remaining = length
+        while remaining > 0 and not disconnected.is_set():
+            chunk = await run_blocking(f.read, min(FILE_READ_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            # send() waits for the client to drain, so a slow reader only parks this coroutine
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+        if remaining > 0:
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.watcher.cancel()
+        await run_blocking(f.close)
+
+
+async def proxy_endpoint(request, receive, send, format_id):
+    """GET /api/proxy/<format_id>, as in MediaExtractor.stream_media, with non-blocking upstream reads"""
+    url = request.args.get('url', '').strip()
+    if not url:
+        await send_json(send, request, 400, {'error': 'URL is required'})
+        return
+    if not carbalite.extractor.is_valid_url(url):
+        await send_json(send, request, 400, {'error': 'Invalid YouTube or SoundCloud URL'})
+        return
+
+    client = get_upstream_client()
+
+    async def open_upstream(fmt):
+        headers = dict(carbalite.PROXY_DEFAULT_HEADERS)
+        headers.update(fmt.get('http_headers') or {})  # Headers yt-dlp says the URL needs
+        headers['Accept-Encoding'] = 'identity'
+        for name in carbalite.PROXY_FORWARD_HEADERS:
+            if request.header(name):
+                headers[name] = request.header(name)
+        return await client.send(client.build_request('GET', fmt['url'], headers=headers), stream=True)
+
+    try:
+        fmt = await run_blocking(carbalite.extractor._find_format, url, format_id)
+        response = await open_upstream(fmt)
+        if response.status_code in (403, 410):
+            # Signed URL expired or was revoked: re-resolve once and retry
+            metrics.upstream_errors.inc(source='proxy', type=f'http_{response.status_code}')
+            await response.aclose()
+            fmt = await run_blocking(carbalite.extractor._find_format, url, format_id, True)
+            response = await open_upstream(fmt)
+    except LookupError as e:
+        await send_json(send, request, 404, {'error': str(e)})
+        return
+    except Exception as e:
+        if isinstance(e, httpx.HTTPError):
+            metrics.upstream_errors.inc(source='proxy', type=type(e).__name__)
+        print(f"Streaming error: {e}")
+        await send_json(send, request, 500, {'error': f'Failed to stream media: {str(e)}'})
+        return
+
+    try:
+        if response.status_code >= 400 and response.status_code != 416:
+            metrics.upstream_errors.inc(source='proxy', type=f'http_{response.status_code}')
+            await send_json(send, request, 502, {'error': f'Upstream returned HTTP {response.status_code}'})
+            return
+
+        headers = [(name, response.headers[name]) for name in carbalite.PROXY_RESPONSE_HEADERS
+                   if name in response.headers]
+        if 'Accept-Ranges' not in response.headers:
+            headers.append(('Accept-Ranges', 'bytes'))
+        headers += [('Cache-Control', 'no-cache'), ('X-Content-Type-Options', 'nosniff')]
+        await start_response(send, request, response.status_code, headers)
+        disconnected = watch_disconnect(receive)
+        try:
+            async for chunk in response.aiter_raw(carbalite.PROXY_CHUNK_SIZE):
+                if disconnected.is_set():
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.watcher.cancel()
+    finally:
+        await response.aclose()
+
+
+def route(request):
+    """Return a coroutine for natively served requests, or None to hand them to Flask"""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    match = ARTIFACT_RE.match(request.path)
+    if match:
+        return lambda receive, send: artifact_endpoint(request, receive, send, match.group(2), match.group(1) == 'download')
+    if request.method != 'GET':
+        return None
+    match = STATUS_RE.match(request.path)
+    if match:
+        return lambda receive, send: status_endpoint(request, send, match.group(1))
+    match = EVENTS_RE.match(request.path)
+    if match:
+        return lambda receive, send: events_endpoint(request, receive, send, match.group(1))
+    match = PROXY_RE.match(request.path)
+    if match and httpx is not None:
+        return lambda receive, send: proxy_endpoint(request, receive, send, match.group(1))
+    return None
+
+
+flask_app = WsgiToAsgi(carbalite.app)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            carbalite.start_background_tasks()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _upstream_client is not None:
+                await _upstream_client.aclose()
+            await run_blocking(carbalite.shutdown_scheduler)
+            _blocking_pool.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        handler = route(Request(scope))
+        if handler is not None:
+            await handler(receive, send)
+            return
+    await flask_app(scope, receive, send)
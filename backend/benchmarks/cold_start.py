@@ -0,0 +1,191 @@
+"""
+Cold-start benchmark for the serverless handlers in api/
+Imports each handler in a fresh interpreter, as a serverless platform does on
+a cold start, and reports import latency, total process start-up time,
+resident memory, threads left running and which heavy dependencies were
+loaded. With --importtime it adds the slowest modules from
+python -X importtime for each handler. Results are written as JSON.
+
+Usage (from backend/):
+    python benchmarks/cold_start.py --runs 5 --importtime --output cold_start.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCHMARK_DIR.parent
+API_DIR = BACKEND_DIR.parent / 'api'
+
+sys.path.insert(0, str(BENCHMARK_DIR))
+
+from run import git_commit
+
+HANDLERS = ('health', 'status', 'download', 'validate', 'extract')
+HEAVY_MODULES = ('yt_dlp', 'requests', 'PIL', 'flask')
+
+# Runs in the fresh interpreter: load one handler file and report what it cost
+PROBE = r'''
+import sys, json, time, threading, importlib.util
+started_at = time.perf_counter()
+spec = importlib.util.spec_from_file_location('cold_start_handler', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+import_seconds = time.perf_counter() - started_at
+
+rss_kib = None
+try:
+    with open('/proc/self/status') as f:
+        rss_kib = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+except (OSError, StopIteration):
+    try:
+        import resource
+        rss_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+
+print(json.dumps({
+    'import_seconds': import_seconds,
+    'rss_kib': rss_kib,
+    'threads': threading.active_count(),
+    'loaded': [name for name in json.loads(sys.argv[2]) if name in sys.modules],
+}))
+'''
+
+
+def run_probe(handler_path, workdir, importtime=False):
+    """Import one handler in a new interpreter; returns (probe report, wall seconds, stderr)"""
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', PROBE, str(handler_path), json.dumps(HEAVY_MODULES)]
+    env = dict(os.environ, CARBALITE_TASK_DB=str(workdir / 'tasks.db'), PYTHONDONTWRITEBYTECODE='1')
+
+    started_at = time.perf_counter()
+    result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True, timeout=300)
+    wall_seconds = time.perf_counter() - started_at
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'probe failed')
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return report, wall_seconds, result.stderr
+
+
+def parse_importtime(stderr, top):
+    """The slowest modules by cumulative import time from python -X importtime output"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            modules[name.strip()] = (int(cumulative_us), int(self_us))
+        except ValueError:
+            continue
+    slowest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    return [
+        {'module': name, 'cumulative_ms': round(cumulative / 1000, 2), 'self_ms': round(own / 1000, 2)}
+        for name, (cumulative, own) in slowest
+    ]
+
+
+def describe(values, scale=1, digits=2):
+    values = [value * scale for value in values if value is not None]
+    if not values:
+        return {}
+    return {
+        'median': round(statistics.median(values), digits),
+        'min': round(min(values), digits),
+        'max': round(max(values), digits),
+    }
+
+
+def run_cold_start(args):
+    results = []
+    for name in args.handlers:
+        handler_path = API_DIR / f'{name}.py'
+        runs = []
+        error = None
+        for _ in range(args.runs):
+            # A fresh directory per run, so no task database or downloads/ carries over
+            with tempfile.TemporaryDirectory(prefix='carbalite-cold-') as workdir:
+                try:
+                    runs.append(run_probe(handler_path, Path(workdir)))
+                except (RuntimeError, subprocess.SubprocessError) as e:
+                    error = str(e)
+                    break
+        if error:
+            print(f"{name:10s} failed: {error}", file=sys.stderr)
+            results.append({'handler': name, 'error': error})
+            continue
+
+        reports = [report for report, _, _ in runs]
+        result = {
+            'handler': name,
+            'runs': len(runs),
+            'import_ms': describe([report['import_seconds'] for report in reports], scale=1000),
+            'process_ms': describe([wall for _, wall, _ in runs], scale=1000),
+            'rss_mib': describe([report['rss_kib'] for report in reports], scale=1 / 1024),
+            'threads_after_import': max(report['threads'] for report in reports),
+            'loaded_modules': reports[-1]['loaded'],
+        }
+        if args.importtime:
+            with tempfile.TemporaryDirectory(prefix='carbalite-cold-') as workdir:
+                _, _, stderr = run_probe(handler_path, Path(workdir), importtime=True)
+            result['import_profile'] = parse_importtime(stderr, args.top)
+        results.append(result)
+        print(f"{name:10s} import={result['import_ms'].get('median')}ms "
+              f"process={result['process_ms'].get('median')}ms rss={result['rss_mib'].get('median')}MiB "
+              f"threads={result['threads_after_import']} loaded={','.join(result['loaded_modules']) or '-'}",
+              file=sys.stderr)
+
+    return {
+        'started_at': args.started_at,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'git_commit': git_commit(),
+        },
+        'parameters': {'runs': args.runs, 'handlers': args.handlers},
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Measure cold-start cost of the serverless handlers in api/')
+    parser.add_argument('--handlers', default=','.join(HANDLERS),
+                        help=f'Comma-separated subset of: {", ".join(HANDLERS)}')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per handler')
+    parser.add_argument('--importtime', action='store_true',
+                        help='Add the slowest modules from python -X importtime for each handler')
+    parser.add_argument('--top', type=int, default=15, help='Modules to list in each import profile')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    args.handlers = [value for value in args.handlers.split(',') if value]
+    unknown = set(args.handlers) - set(HANDLERS)
+    if unknown:
+        parser.error(f'Unknown handlers: {", ".join(sorted(unknown))}')
+    args.started_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = json.dumps(run_cold_start(args), indent=2)
+    if args.output:
+        Path(args.output).write_text(report)
+        print(f"Results written to {args.output}")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
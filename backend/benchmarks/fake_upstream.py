@@ -0,0 +1,198 @@
+"""
+Offline stand-in for the upstream media sites
+A local HTTP server that serves synthetic media bytes, plus a fake
+yt_dlp.YoutubeDL that "extracts" info dicts pointing at it and downloads from
+it, so the Flask app can be benchmarked on a machine with no network.
+"""
+
+import re
+import time
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from urllib.request import urlopen
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MEDIA_PATH_RE = re.compile(r'^/media/([\w-]+)\.(\w+)$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# JPEG magic plus padding: enough for thumbnail type sniffing and caching
+THUMBNAIL_BYTES = b'\xff\xd8\xff\xe0' + bytes(4096)
+
+
+class FakeUpstream:
+    """Threaded HTTP server serving deterministic media bytes with Range support"""
+
+    def __init__(self, media_size=2 * 1024 * 1024, latency=0.0):
+        self.media_size = media_size
+        self.latency = latency  # Seconds added before every response, like a distant CDN
+        self.payload = (bytes(range(256)) * (media_size // 256 + 1))[:media_size]
+        self.requests_served = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def media_url(self, media_id, ext):
+        return f'{self.base_url}/media/{media_id}.{ext}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-upstream')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass  # Keep benchmark output clean
+
+            def do_GET(self):
+                if upstream.latency:
+                    time.sleep(upstream.latency)
+                with upstream._lock:
+                    upstream.requests_served += 1
+
+                if self.path.startswith('/thumbnail/'):
+                    self._send(200, THUMBNAIL_BYTES, 'image/jpeg')
+                    return
+                if not MEDIA_PATH_RE.match(self.path.split('?')[0]):
+                    self._send(404, b'not found', 'text/plain')
+                    return
+
+                payload = upstream.payload
+                match = RANGE_RE.match(self.headers.get('Range', ''))
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        end = min(int(match.group(2)), len(payload) - 1) if match.group(2) else len(payload) - 1
+                    else:
+                        start, end = max(0, len(payload) - int(match.group(2))), len(payload) - 1
+                    if start >= len(payload) or start > end:
+                        self._send(416, b'', 'text/plain', {'Content-Range': f'bytes */{len(payload)}'})
+                        return
+                    self._send(206, payload[start:end + 1], 'application/octet-stream',
+                               {'Content-Range': f'bytes {start}-{end}/{len(payload)}'})
+                    return
+                self._send(200, payload, 'application/octet-stream')
+
+            def _send(self, status, body, content_type, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Accept-Ranges', 'bytes')
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+def fake_yt_dlp(upstream, metadata_latency=0.0):
+    """Return a stand-in for the yt_dlp module backed by upstream
+
+    Only the parts of the YoutubeDL API that app.py uses are implemented:
+    extract_info, sanitize_info, process_ie_result with progress hooks and
+    post_process, which "converts" by renaming the file to the target extension.
+    metadata_latency simulates the time a real extractor spends resolving a page.
+    """
+
+    class FakeYoutubeDL:
+        def __init__(self, params=None):
+            self.params = params or {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def extract_info(self, url, download=False):
+            if metadata_latency:
+                time.sleep(metadata_latency)
+            media_id = url.rstrip('/').split('v=')[-1].split('/')[-1][:11]
+            size = upstream.media_size
+            return {
+                'id': media_id,
+                'title': f'Benchmark {media_id}',
+                'uploader': 'CarbaLite Bench',
+                'duration': 180,
+                'thumbnail': f'{upstream.base_url}/thumbnail/{media_id}.jpg',
+                'description': 'Synthetic media served by the benchmark harness',
+                'upload_date': '20240101',
+                'view_count': 0,
+                'webpage_url': url,
+                'formats': [
+                    {
+                        'format_id': '140', 'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none',
+                        'abr': 128, 'filesize': size, 'url': upstream.media_url(media_id, 'm4a'),
+                    },
+                    {
+                        'format_id': '18', 'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1.42001E',
+                        'height': 360, 'width': 640, 'fps': 30, 'vbr': 500, 'filesize': size,
+                        'url': upstream.media_url(media_id, 'mp4'),
+                    },
+                ],
+            }
+
+        def sanitize_info(self, info):
+            return info
+
+        def process_ie_result(self, info, download=True):
+            selector = self.params.get('format', '')
+            by_id = {fmt['format_id']: fmt for fmt in info['formats']}
+            # Planned jobs name a format_id; fallback selectors are picked by media type
+            fmt = by_id.get(selector.split('+')[0]) or info['formats'][0 if 'bestaudio' in selector else 1]
+            ext = fmt['ext']
+            if '+' in selector and self.params.get('merge_output_format'):
+                ext = self.params['merge_output_format']
+            for postprocessor in self.params.get('postprocessors') or []:
+                ext = postprocessor.get('preferredcodec') or postprocessor.get('preferedformat') or ext
+
+            output_path = self.params['outtmpl'] % {'title': info['title'], 'ext': ext}
+            hooks = self.params.get('progress_hooks') or []
+            downloaded = 0
+            with urlopen(fmt['url']) as response, open(output_path, 'wb') as f:
+                total = int(response.headers.get('Content-Length') or 0)
+                while True:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    downloaded += len(chunk)
+                    for hook in hooks:
+                        hook({'status': 'downloading', 'downloaded_bytes': downloaded, 'total_bytes': total})
+            for hook in hooks:
+                hook({'status': 'finished', 'downloaded_bytes': downloaded, 'total_bytes': downloaded,
+                      'filename': output_path})
+            return info
+
+        def post_process(self, filename, info, files_to_move=None):
+            path = Path(filename)
+            hooks = self.params.get('postprocessor_hooks') or []
+            for postprocessor in self.params.get('postprocessors') or []:
+                for hook in hooks:
+                    hook({'status': 'started', 'postprocessor': postprocessor['key'], 'info_dict': info})
+                ext = postprocessor.get('preferredcodec') or postprocessor.get('preferedformat')
+                if ext and path.suffix != f'.{ext}':
+                    path = path.rename(path.with_suffix(f'.{ext}'))
+                for hook in hooks:
+                    hook({'status': 'finished', 'postprocessor': postprocessor['key'], 'info_dict': info})
+            info.update(filepath=str(path), ext=path.suffix[1:])
+            return info
+
+    return SimpleNamespace(YoutubeDL=FakeYoutubeDL)
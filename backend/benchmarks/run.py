@@ -0,0 +1,393 @@
+"""
+Offline benchmark harness for the CarbaLite backend
+Runs the Flask app on a local port against FakeUpstream and measures
+throughput and latency percentiles for validate, extract, status polling and
+file serving at several concurrency levels. Results are written as JSON.
+
+Usage (from backend/):
+    python benchmarks/run.py --concurrency 1,4,16 --requests 200 --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCHMARK_DIR.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from fake_upstream import FakeUpstream, fake_yt_dlp
+
+SCENARIOS = ('validate', 'validate_cached', 'extract', 'status', 'download', 'processing_paths')
+# (type, preferences, expected processing_path): the fake's m4a/aac and mp4/h264 sources
+# can be stream-copied to aac and remuxed into mkv without a transcode
+PROCESSING_PATH_JOBS = (
+    ('audio', {'selectedAudioFormat': 'aac'}, 'copy'),
+    ('video', {'selectedVideoFormat': 'mkv', 'videoQuality': '360p'}, 'remux'),
+    ('audio', {'selectedAudioFormat': 'mp3'}, 'transcode'),
+)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarise(latencies):
+    """Latency distribution in milliseconds"""
+    values = sorted(latency * 1000 for latency in latencies)
+    if not values:
+        return {}
+    return {
+        'mean': round(sum(values) / len(values), 3),
+        'p50': round(percentile(values, 0.50), 3),
+        'p90': round(percentile(values, 0.90), 3),
+        'p99': round(percentile(values, 0.99), 3),
+        'max': round(values[-1], 3),
+    }
+
+
+class BenchmarkClient:
+    """Minimal HTTP client for the app under test; one connection per request"""
+
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body=None):
+        """Return (status, response_bytes, latency_seconds)"""
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        started_at = time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            return response.status, data, time.perf_counter() - started_at
+        finally:
+            conn.close()
+
+
+class MediaIds:
+    """Unique 11-character YouTube-shaped IDs so every request can miss the caches"""
+
+    def __init__(self):
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def new_url(self):
+        with self._lock:
+            self._next += 1
+            return f'https://www.youtube.com/watch?v=bench{self._next:06d}'
+
+
+def run_load(concurrency, total_requests, make_request):
+    """Run make_request(i) total_requests times across concurrency threads
+
+    make_request returns (ok, latency_seconds, bytes_received).
+    """
+    latencies = []
+    errors = 0
+    received = 0
+    lock = threading.Lock()
+
+    def worker(i):
+        nonlocal errors, received
+        try:
+            ok, latency, nbytes = make_request(i)
+        except Exception as e:
+            print(f"Request failed: {e}", file=sys.stderr)
+            ok, latency, nbytes = False, None, 0
+        with lock:
+            if latency is not None:
+                latencies.append(latency)
+            if not ok:
+                errors += 1
+            received += nbytes
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(total_requests)))
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        'concurrency': concurrency,
+        'requests': total_requests,
+        'errors': errors,
+        'duration_seconds': round(elapsed, 3),
+        'throughput_rps': round(total_requests / elapsed, 2) if elapsed else None,
+        'bytes_received': received,
+        'throughput_mib_s': round(received / elapsed / 1024 ** 2, 2) if elapsed else None,
+        'latency_ms': summarise(latencies),
+    }
+
+
+def wait_for_tasks(client, task_ids, timeout):
+    """Poll until every task is terminal; returns {task_id: final status record}"""
+    pending = set(task_ids)
+    finished = {}
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        for task_id in list(pending):
+            status, data, _ = client.request('GET', f'/api/status/{task_id}')
+            record = json.loads(data) if status == 200 else {'status': 'missing'}
+            if record.get('status') in ('completed', 'error', 'missing'):
+                finished[task_id] = record
+                pending.discard(task_id)
+        if pending:
+            time.sleep(0.05)
+    for task_id in pending:
+        finished[task_id] = {'status': 'timeout'}
+    return finished
+
+
+def run_benchmarks(args):
+    """Start the fake upstream and the app, run every scenario and return the results dict"""
+    upstream = FakeUpstream(media_size=args.media_size, latency=args.upstream_latency / 1000).start()
+
+    # The app keeps downloads and the task database relative to the working directory
+    workdir = Path(tempfile.mkdtemp(prefix='carbalite-bench-'))
+    os.chdir(workdir)
+    os.environ.setdefault('CARBALITE_TASK_DB', str(workdir / 'tasks.db'))
+    os.environ.setdefault('CARBALITE_JOB_QUEUE_MAX_DEPTH', str(max(args.requests, 100)))
+    os.environ.setdefault('CARBALITE_DISK_MIN_FREE_BYTES', '0')
+    # One client hammering the server is the point here, not something to throttle
+    os.environ.setdefault('CARBALITE_RATE_LIMIT_PER_MINUTE', '0')
+    os.environ.setdefault('CARBALITE_ADMISSION_QUEUE_HIGH_WATER', '1')
+
+    import app as carbalite
+    from werkzeug.serving import make_server
+
+    carbalite.yt_dlp = fake_yt_dlp(upstream, metadata_latency=args.metadata_latency / 1000)
+    carbalite.DOWNLOAD_DIR.mkdir(exist_ok=True)
+
+    server = make_server('127.0.0.1', 0, carbalite.app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, name='carbalite-bench-app')
+    server_thread.daemon = True
+    server_thread.start()
+
+    client = BenchmarkClient(server.server_port)
+    media_ids = MediaIds()
+    results = []
+    completed_tasks = []
+
+    def record(scenario, concurrency, result, **extra):
+        result.update(extra)
+        result['scenario'] = scenario
+        results.append(result)
+        latency = result['latency_ms']
+        print(f"{scenario:16s} c={concurrency:<4d} {result['throughput_rps']:>9} req/s  "
+              f"p50={latency.get('p50')}ms p99={latency.get('p99')}ms errors={result['errors']}", file=sys.stderr)
+
+    try:
+        if 'processing_paths' in args.scenarios:
+            # Correctness check rather than load: each processing path must run a job to completion
+            paths = {}
+            for media_type, preferences, expected in PROCESSING_PATH_JOBS:
+                status, data, _ = client.request('POST', '/api/extract', {
+                    'url': media_ids.new_url(), 'type': media_type, 'preferences': preferences,
+                })
+                task_id = json.loads(data)['task_id'] if status == 200 else None
+                task = wait_for_tasks(client, [task_id], args.job_timeout)[task_id] if task_id else {}
+                paths[expected] = {
+                    'status': task.get('status', f'http_{status}'),
+                    'processing_path': task.get('processing_path'),
+                    'ok': task.get('status') == 'completed' and task.get('processing_path') == expected,
+                }
+            results.append({'scenario': 'processing_paths', 'concurrency': 1, 'paths': paths})
+            print(f"{'processing_paths':16s} " + ' '.join(
+                f"{expected}={'ok' if path['ok'] else path['status']}" for expected, path in paths.items()
+            ), file=sys.stderr)
+
+        for concurrency in args.concurrency:
+            if 'validate' in args.scenarios:
+                def validate(i):
+                    status, _, latency = client.request('POST', '/api/validate', {'url': media_ids.new_url()})
+                    return status == 200, latency, 0
+                record('validate', concurrency, run_load(concurrency, args.requests, validate))
+
+            if 'validate_cached' in args.scenarios:
+                cached_url = media_ids.new_url()
+                client.request('POST', '/api/validate', {'url': cached_url})
+
+                def validate_cached(i):
+                    status, _, latency = client.request('POST', '/api/validate', {'url': cached_url})
+                    return status == 200, latency, 0
+                record('validate_cached', concurrency, run_load(concurrency, args.requests, validate_cached))
+
+            if 'extract' in args.scenarios:
+                task_ids = []
+                task_lock = threading.Lock()
+
+                def extract(i):
+                    status, data, latency = client.request('POST', '/api/extract', {
+                        'url': media_ids.new_url(),
+                        'type': 'audio',
+                        'preferences': {'selectedAudioFormat': 'mp3', 'audioQuality': '128k'},
+                    })
+                    if status == 200:
+                        with task_lock:
+                            task_ids.append(json.loads(data)['task_id'])
+                    return status == 200, latency, 0
+
+                result = run_load(concurrency, args.requests, extract)
+
+                # Enqueueing is fast; jobs/s is what the worker pool actually sustains
+                drain_started_at = time.perf_counter()
+                finished = wait_for_tasks(client, task_ids, args.job_timeout)
+                drain_seconds = time.perf_counter() - drain_started_at + result['duration_seconds']
+                job_latencies = [
+                    task['completed_at'] - task['created_at']
+                    for task in finished.values()
+                    if task.get('status') == 'completed' and task.get('created_at')
+                ]
+                completed_tasks.extend(
+                    task_id for task_id, task in finished.items() if task.get('status') == 'completed'
+                )
+                record('extract', concurrency, result, jobs={
+                    'completed': len(job_latencies),
+                    'failed': len(finished) - len(job_latencies),
+                    'jobs_per_second': round(len(job_latencies) / drain_seconds, 2) if drain_seconds else None,
+                    'latency_ms': summarise(job_latencies),
+                })
+
+            if not completed_tasks and ('status' in args.scenarios or 'download' in args.scenarios):
+                # Status and download need finished tasks; make a few if extract was skipped
+                seed_ids = []
+                for _ in range(min(args.requests, 8)):
+                    status, data, _ = client.request('POST', '/api/extract', {'url': media_ids.new_url()})
+                    if status == 200:
+                        seed_ids.append(json.loads(data)['task_id'])
+                completed_tasks.extend(
+                    task_id for task_id, task in wait_for_tasks(client, seed_ids, args.job_timeout).items()
+                    if task.get('status') == 'completed'
+                )
+
+            if 'status' in args.scenarios and completed_tasks:
+                def status_poll(i):
+                    task_id = completed_tasks[i % len(completed_tasks)]
+                    status, _, latency = client.request('GET', f'/api/status/{task_id}')
+                    return status == 200, latency, 0
+                record('status', concurrency, run_load(concurrency, args.requests, status_poll))
+
+            if 'download' in args.scenarios and completed_tasks:
+                def download(i):
+                    task_id = completed_tasks[i % len(completed_tasks)]
+                    status, data, latency = client.request('GET', f'/api/download/{task_id}')
+                    return status == 200, latency, len(data)
+                record('download', concurrency, run_load(concurrency, args.requests, download))
+    finally:
+        server.shutdown()
+        upstream.stop()
+
+    return {
+        'run_id': uuid.uuid4().hex,
+        'started_at': args.started_at,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'git_commit': git_commit(),
+            'task_store': os.getenv('CARBALITE_TASK_STORE', 'sqlite'),
+            'job_workers': carbalite.JOB_WORKERS,
+        },
+        'parameters': {
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'scenarios': args.scenarios,
+            'media_size': args.media_size,
+            'metadata_latency_ms': args.metadata_latency,
+            'upstream_latency_ms': args.upstream_latency,
+        },
+        'upstream_requests': upstream.requests_served,
+        'results': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CarbaLite backend against a local fake upstream')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='Comma-separated client concurrency levels (default: 1,4,16)')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario and concurrency level')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Comma-separated subset of: {", ".join(SCENARIOS)}')
+    parser.add_argument('--media-size', type=int, default=2 * 1024 * 1024, help='Synthetic media size in bytes')
+    parser.add_argument('--metadata-latency', type=float, default=50,
+                        help='Simulated extractor latency per metadata lookup, in ms')
+    parser.add_argument('--upstream-latency', type=float, default=0,
+                        help='Simulated latency per upstream HTTP request, in ms')
+    parser.add_argument('--job-timeout', type=float, default=300, help='Seconds to wait for extraction jobs')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    args.concurrency = [int(value) for value in args.concurrency.split(',') if value]
+    args.scenarios = [value for value in args.scenarios.split(',') if value]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+    args.started_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    if args.output:
+        args.output = str(Path(args.output).resolve())  # run_benchmarks changes directory
+    return args
+
+
+def failed_job_runs(results):
+    """Runs whose jobs never reached 'completed', so their timings measure nothing"""
+    failed = [
+        f"{result['scenario']} c={result['concurrency']}"
+        for result in results['results']
+        if 'jobs' in result and result['jobs']['completed'] == 0
+    ]
+    failed.extend(
+        f"processing_paths {expected}"
+        for result in results['results'] if result['scenario'] == 'processing_paths'
+        for expected, path in result['paths'].items() if not path['ok']
+    )
+    ran = {result['scenario'] for result in results['results']}
+    # status and download are skipped outright when there is no completed task to use
+    failed.extend(
+        scenario for scenario in ('status', 'download')
+        if scenario in results['parameters']['scenarios'] and scenario not in ran
+    )
+    return failed
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_benchmarks(args)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(report)
+        print(f"Results written to {args.output}")
+    else:
+        print(report)
+
+    failed = failed_job_runs(results)
+    if failed:
+        sys.exit(f"Jobs did not complete in: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
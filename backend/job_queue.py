@@ -0,0 +1,507 @@
+"""
+External job queue for CarbaLite
+Carries extraction jobs from the web processes to carbalite-worker processes,
+so downloads and transcodes run on their own hosts and scale apart from the
+API. The broker only holds waiting and claimed jobs; progress and results go
+through the shared task store as before.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import deque
+from pathlib import Path
+
+JOB_QUEUE_BACKEND = os.getenv('CARBALITE_JOB_QUEUE', 'local')  # 'local', 'sqlite', 'redis' or 'memory'
+JOB_QUEUE_PATH = Path(os.getenv('CARBALITE_JOB_QUEUE_DB', 'carbalite_queue.db'))
+REDIS_URL = os.getenv('CARBALITE_REDIS_URL', 'redis://localhost:6379/0')
+REDIS_PREFIX = os.getenv('CARBALITE_REDIS_PREFIX', 'carbalite:')
+WORKER_HEARTBEAT_INTERVAL = 5  # Seconds between worker heartbeats
+WORKER_HEARTBEAT_TTL = int(os.getenv('CARBALITE_WORKER_HEARTBEAT_TTL', 30))  # Silent this long means dead
+
+
+class JobBroker:
+    """Interface for job queue backends
+
+    Jobs are the JSON-serialisable descriptors kept in each task record,
+    keyed by task_id; a task is queued at most once. claim() moves the
+    oldest waiting job to a worker, which acks it once the task store
+    records that worker as the owner. Claims held by a worker whose
+    heartbeats stop are put back at the front of the queue by
+    requeue_stale(), so a crashed worker loses no jobs.
+    """
+
+    def enqueue(self, task_id, job):
+        """Queue a job unless it is already waiting or claimed; returns its 1-based position"""
+        raise NotImplementedError
+
+    def claim(self, worker_id):
+        """Take the oldest waiting job for worker_id; returns (task_id, job) or None"""
+        raise NotImplementedError
+
+    def ack(self, task_id):
+        """Forget a claimed job once its worker has taken ownership of the task"""
+        raise NotImplementedError
+
+    def cancel(self, task_id):
+        """Drop a job that has not been claimed; returns False if it is not waiting"""
+        raise NotImplementedError
+
+    def contains(self, task_id):
+        """True while the job is waiting or claimed"""
+        raise NotImplementedError
+
+    def position(self, task_id):
+        """1-based queue position of a waiting job and when it was queued, or None"""
+        raise NotImplementedError
+
+    def depth(self):
+        """Number of waiting jobs"""
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id, slots, load=None):
+        """Record that worker_id is alive and runs up to slots jobs at once
+
+        load is a small JSON-serialisable dict describing the worker's host
+        (running ffmpeg processes, whether its disk has room) that the web
+        tier's admission control reads back through worker_loads().
+        """
+        raise NotImplementedError
+
+    def worker_loads(self):
+        """Return the load dicts last published by each live worker"""
+        raise NotImplementedError
+
+    def is_alive(self, worker_id):
+        """True if worker_id has sent a heartbeat within WORKER_HEARTBEAT_TTL"""
+        raise NotImplementedError
+
+    def release(self, worker_id):
+        """Put a worker's claimed jobs back at the front of the queue; returns their task IDs"""
+        raise NotImplementedError
+
+    def requeue_stale(self):
+        """Release the claims of every worker that stopped sending heartbeats"""
+        raise NotImplementedError
+
+    def stats(self):
+        """Return queued_jobs, claimed_jobs, workers (live processes) and slots (their job capacity)"""
+        raise NotImplementedError
+
+
+class MemoryJobBroker(JobBroker):
+    """In-process broker, intended for tests and single-process development"""
+
+    def __init__(self):
+        self._waiting = deque()  # task_ids, oldest first
+        self._jobs = {}  # task_id -> (job, enqueued_at)
+        self._claims = {}  # task_id -> worker_id
+        self._workers = {}  # worker_id -> (seen_at, slots, load)
+        self._lock = threading.Lock()
+
+    def enqueue(self, task_id, job):
+        with self._lock:
+            if task_id not in self._jobs:
+                self._jobs[task_id] = (json.loads(json.dumps(job)), time.time())
+                self._waiting.append(task_id)
+            return self._position(task_id)
+
+    def claim(self, worker_id):
+        with self._lock:
+            if not self._waiting:
+                return None
+            task_id = self._waiting.popleft()
+            self._claims[task_id] = worker_id
+            return task_id, self._jobs[task_id][0]
+
+    def ack(self, task_id):
+        with self._lock:
+            self._claims.pop(task_id, None)
+            self._jobs.pop(task_id, None)
+
+    def cancel(self, task_id):
+        with self._lock:
+            if task_id in self._claims or task_id not in self._jobs:
+                return False
+            self._waiting.remove(task_id)
+            del self._jobs[task_id]
+            return True
+
+    def contains(self, task_id):
+        with self._lock:
+            return task_id in self._jobs
+
+    def _position(self, task_id):
+        try:
+            return self._waiting.index(task_id) + 1
+        except ValueError:
+            return None
+
+    def position(self, task_id):
+        with self._lock:
+            position = self._position(task_id)
+            return (position, self._jobs[task_id][1]) if position else None
+
+    def depth(self):
+        with self._lock:
+            return len(self._waiting)
+
+    def heartbeat(self, worker_id, slots, load=None):
+        with self._lock:
+            self._workers[worker_id] = (time.time(), slots, load or {})
+
+    def worker_loads(self):
+        cutoff = time.time() - WORKER_HEARTBEAT_TTL
+        with self._lock:
+            return [load for seen_at, _, load in self._workers.values() if seen_at >= cutoff]
+
+    def is_alive(self, worker_id):
+        with self._lock:
+            entry = self._workers.get(worker_id)
+            return entry is not None and entry[0] >= time.time() - WORKER_HEARTBEAT_TTL
+
+    def release(self, worker_id):
+        with self._lock:
+            released = [task_id for task_id, owner in self._claims.items() if owner == worker_id]
+            for task_id in reversed(released):
+                del self._claims[task_id]
+                self._waiting.appendleft(task_id)
+            return released
+
+    def requeue_stale(self):
+        with self._lock:
+            owners = set(self._claims.values())
+        return [
+            task_id for worker_id in owners if not self.is_alive(worker_id)
+            for task_id in self.release(worker_id)
+        ]
+
+    def stats(self):
+        cutoff = time.time() - WORKER_HEARTBEAT_TTL
+        with self._lock:
+            live = [slots for seen_at, slots, _ in self._workers.values() if seen_at >= cutoff]
+            return {
+                'queued_jobs': len(self._waiting),
+                'claimed_jobs': len(self._claims),
+                'workers': len(live),
+                'slots': sum(live)
+            }
+
+
+class SQLiteJobBroker(JobBroker):
+    """Queue table in a SQLite WAL database, for web and worker processes on the same host
+
+    Jobs are claimed in enqueue order inside BEGIN IMMEDIATE transactions, so
+    concurrent workers never take the same one. A released claim keeps its
+    original sequence number and so goes back to its old place in line.
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH):
+        self.path = str(path)
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        self._connect().executescript('''
+            CREATE TABLE IF NOT EXISTS queue (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL UNIQUE,
+                job TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                claimed_by TEXT,
+                claimed_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS queue_waiting ON queue (claimed_by, seq);
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                slots INTEGER NOT NULL,
+                load TEXT,
+                seen_at REAL NOT NULL
+            );
+        ''')
+
+    def _transaction(self, body):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = body(conn)
+            conn.execute('COMMIT')
+            return result
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def enqueue(self, task_id, job):
+        self._connect().execute(
+            'INSERT OR IGNORE INTO queue (task_id, job, enqueued_at) VALUES (?, ?, ?)',
+            (task_id, json.dumps(job), time.time())
+        )
+        position = self.position(task_id)
+        return position[0] if position else None
+
+    def claim(self, worker_id):
+        def take(conn):
+            row = conn.execute(
+                'SELECT seq, task_id, job FROM queue WHERE claimed_by IS NULL ORDER BY seq LIMIT 1'
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE queue SET claimed_by = ?, claimed_at = ? WHERE seq = ?',
+                (worker_id, time.time(), row[0])
+            )
+            return row[1], json.loads(row[2])
+        return self._transaction(take)
+
+    def ack(self, task_id):
+        self._connect().execute('DELETE FROM queue WHERE task_id = ?', (task_id,))
+
+    def cancel(self, task_id):
+        cursor = self._connect().execute(
+            'DELETE FROM queue WHERE task_id = ? AND claimed_by IS NULL', (task_id,)
+        )
+        return cursor.rowcount > 0
+
+    def contains(self, task_id):
+        return self._connect().execute(
+            'SELECT 1 FROM queue WHERE task_id = ?', (task_id,)
+        ).fetchone() is not None
+
+    def position(self, task_id):
+        row = self._connect().execute('''
+            SELECT (SELECT COUNT(*) FROM queue AS ahead
+                    WHERE ahead.claimed_by IS NULL AND ahead.seq <= queue.seq),
+                   enqueued_at
+            FROM queue WHERE task_id = ? AND claimed_by IS NULL
+        ''', (task_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def depth(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM queue WHERE claimed_by IS NULL'
+        ).fetchone()[0]
+
+    def heartbeat(self, worker_id, slots, load=None):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO workers (worker_id, slots, load, seen_at) VALUES (?, ?, ?, ?)',
+            (worker_id, slots, json.dumps(load or {}), time.time())
+        )
+
+    def worker_loads(self):
+        rows = self._connect().execute(
+            'SELECT load FROM workers WHERE seen_at >= ?', (time.time() - WORKER_HEARTBEAT_TTL,)
+        ).fetchall()
+        return [json.loads(row[0] or '{}') for row in rows]
+
+    def is_alive(self, worker_id):
+        return self._connect().execute(
+            'SELECT 1 FROM workers WHERE worker_id = ? AND seen_at >= ?',
+            (worker_id, time.time() - WORKER_HEARTBEAT_TTL)
+        ).fetchone() is not None
+
+    def release(self, worker_id):
+        def release_claims(conn):
+            task_ids = [row[0] for row in conn.execute(
+                'SELECT task_id FROM queue WHERE claimed_by = ?', (worker_id,)
+            )]
+            conn.execute(
+                'UPDATE queue SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?', (worker_id,)
+            )
+            return task_ids
+        return self._transaction(release_claims)
+
+    def requeue_stale(self):
+        cutoff = time.time() - WORKER_HEARTBEAT_TTL
+
+        def release_stale(conn):
+            stale = 'claimed_by IS NOT NULL AND claimed_by NOT IN (SELECT worker_id FROM workers WHERE seen_at >= ?)'
+            task_ids = [row[0] for row in conn.execute(f'SELECT task_id FROM queue WHERE {stale}', (cutoff,))]
+            if task_ids:
+                conn.execute(f'UPDATE queue SET claimed_by = NULL, claimed_at = NULL WHERE {stale}', (cutoff,))
+            # Forget workers that have been gone long enough that nothing can refer to them
+            conn.execute('DELETE FROM workers WHERE seen_at < ?', (cutoff - 10 * WORKER_HEARTBEAT_TTL,))
+            return task_ids
+        return self._transaction(release_stale)
+
+    def stats(self):
+        conn = self._connect()
+        queued, claimed = conn.execute(
+            'SELECT COUNT(*) - COUNT(claimed_by), COUNT(claimed_by) FROM queue'
+        ).fetchone()
+        workers, slots = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(slots), 0) FROM workers WHERE seen_at >= ?',
+            (time.time() - WORKER_HEARTBEAT_TTL,)
+        ).fetchone()
+        return {'queued_jobs': queued, 'claimed_jobs': claimed, 'workers': workers, 'slots': slots}
+
+
+class RedisJobBroker(JobBroker):
+    """Queue in Redis (or a compatible server), for workers spread over several hosts
+
+    Waiting task_ids sit in a list (pushed on the left, claimed from the
+    right); job descriptors, claims and worker heartbeats live in hashes and
+    a sorted set next to it. Multi-key steps run as Lua scripts, so each is
+    atomic however many web and worker processes share the server.
+    """
+
+    ENQUEUE = '''
+        if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 0 then
+            redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+            redis.call('LPUSH', KEYS[1], ARGV[1])
+        end
+        local index = redis.call('LPOS', KEYS[1], ARGV[1])
+        if not index then return 0 end
+        return redis.call('LLEN', KEYS[1]) - index
+    '''
+    CLAIM = '''
+        local task_id = redis.call('RPOP', KEYS[1])
+        if not task_id then return nil end
+        redis.call('HSET', KEYS[3], task_id, ARGV[1])
+        return {task_id, redis.call('HGET', KEYS[2], task_id)}
+    '''
+    CANCEL = '''
+        if redis.call('LREM', KEYS[1], 0, ARGV[1]) == 0 then return 0 end
+        redis.call('HDEL', KEYS[2], ARGV[1])
+        return 1
+    '''
+    RELEASE = '''
+        local released = {}
+        local claims = redis.call('HGETALL', KEYS[2])
+        for i = 1, #claims, 2 do
+            if claims[i + 1] == ARGV[1] then
+                redis.call('HDEL', KEYS[2], claims[i])
+                redis.call('RPUSH', KEYS[1], claims[i])
+                table.insert(released, claims[i])
+            end
+        end
+        return released
+    '''
+
+    def __init__(self, url=REDIS_URL, prefix=REDIS_PREFIX):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis job queue needs the redis package: pip install redis')
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._queue_key = f'{prefix}queue'
+        self._jobs_key = f'{prefix}queue_jobs'
+        self._claims_key = f'{prefix}queue_claims'
+        self._enqueued_key = f'{prefix}queue_enqueued_at'
+        self._workers_key = f'{prefix}workers'
+        self._slots_key = f'{prefix}worker_slots'
+        self._load_key = f'{prefix}worker_load'
+        self._enqueue = self._redis.register_script(self.ENQUEUE)
+        self._claim = self._redis.register_script(self.CLAIM)
+        self._cancel = self._redis.register_script(self.CANCEL)
+        self._release = self._redis.register_script(self.RELEASE)
+
+    def enqueue(self, task_id, job):
+        self._redis.hsetnx(self._enqueued_key, task_id, time.time())
+        return self._enqueue(keys=[self._queue_key, self._jobs_key], args=[task_id, json.dumps(job)]) or None
+
+    def claim(self, worker_id):
+        result = self._claim(keys=[self._queue_key, self._jobs_key, self._claims_key], args=[worker_id])
+        if not result:
+            return None
+        task_id, job = result
+        return task_id, json.loads(job)
+
+    def ack(self, task_id):
+        pipe = self._redis.pipeline()
+        pipe.hdel(self._claims_key, task_id)
+        pipe.hdel(self._jobs_key, task_id)
+        pipe.hdel(self._enqueued_key, task_id)
+        pipe.execute()
+
+    def cancel(self, task_id):
+        if not self._cancel(keys=[self._queue_key, self._jobs_key], args=[task_id]):
+            return False
+        self._redis.hdel(self._enqueued_key, task_id)
+        return True
+
+    def contains(self, task_id):
+        return bool(self._redis.hexists(self._jobs_key, task_id))
+
+    def position(self, task_id):
+        pipe = self._redis.pipeline()
+        pipe.lpos(self._queue_key, task_id)
+        pipe.llen(self._queue_key)
+        pipe.hget(self._enqueued_key, task_id)
+        index, length, enqueued_at = pipe.execute()
+        if index is None:
+            return None
+        return length - index, float(enqueued_at or time.time())
+
+    def depth(self):
+        return self._redis.llen(self._queue_key)
+
+    def heartbeat(self, worker_id, slots, load=None):
+        pipe = self._redis.pipeline()
+        pipe.zadd(self._workers_key, {worker_id: time.time()})
+        pipe.hset(self._slots_key, worker_id, slots)
+        pipe.hset(self._load_key, worker_id, json.dumps(load or {}))
+        pipe.execute()
+
+    def worker_loads(self):
+        live = self._redis.zrangebyscore(self._workers_key, time.time() - WORKER_HEARTBEAT_TTL, '+inf')
+        if not live:
+            return []
+        return [json.loads(value) for value in self._redis.hmget(self._load_key, live) if value]
+
+    def is_alive(self, worker_id):
+        seen_at = self._redis.zscore(self._workers_key, worker_id)
+        return seen_at is not None and seen_at >= time.time() - WORKER_HEARTBEAT_TTL
+
+    def release(self, worker_id):
+        return self._release(keys=[self._queue_key, self._claims_key], args=[worker_id])
+
+    def requeue_stale(self):
+        owners = set(self._redis.hvals(self._claims_key))
+        released = [
+            task_id for worker_id in owners if not self.is_alive(worker_id)
+            for task_id in self.release(worker_id)
+        ]
+        # Forget workers that have been gone long enough that nothing can refer to them
+        gone = self._redis.zrangebyscore(self._workers_key, '-inf', time.time() - 10 * WORKER_HEARTBEAT_TTL)
+        if gone:
+            pipe = self._redis.pipeline()
+            pipe.zrem(self._workers_key, *gone)
+            pipe.hdel(self._slots_key, *gone)
+            pipe.hdel(self._load_key, *gone)
+            pipe.execute()
+        return released
+
+    def stats(self):
+        live = self._redis.zrangebyscore(self._workers_key, time.time() - WORKER_HEARTBEAT_TTL, '+inf')
+        slots = self._redis.hmget(self._slots_key, live) if live else []
+        return {
+            'queued_jobs': self.depth(),
+            'claimed_jobs': self._redis.hlen(self._claims_key),
+            'workers': len(live),
+            'slots': sum(int(value) for value in slots if value)
+        }
+
+
+def create_job_broker(backend=JOB_QUEUE_BACKEND, path=JOB_QUEUE_PATH):
+    """Build the configured broker, or None when jobs run in the web process's own pool"""
+    if backend == 'local':
+        return None
+    if backend == 'memory':
+        return MemoryJobBroker()
+    if backend == 'sqlite':
+        return SQLiteJobBroker(path)
+    if backend == 'redis':
+        return RedisJobBroker()
+    raise ValueError(f"Unknown job queue backend: {backend}")
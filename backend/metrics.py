@@ -0,0 +1,191 @@
+"""
+Operational metrics for CarbaLite
+A small, dependency-free registry of counters, histograms and callback gauges
+rendered in the Prometheus text exposition format. Values are per process.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+# Stage latencies span sub-second cache hits to multi-minute transcodes
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of the with-block"""
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started_at, **labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry):
+                    cumulative += count
+                    result.append((f'{self.name}_bucket', key, (('le', _format_value(float(bound))),), cumulative))
+                result.append((f'{self.name}_sum', key, (), entry[-2]))
+                result.append((f'{self.name}_count', key, (), entry[-1]))
+        return result
+
+
+class CallbackMetric:
+    """Gauge or counter whose values are read from a callback at scrape time
+
+    The callback returns a number, or a dict mapping label-value tuples to numbers.
+    """
+
+    def __init__(self, name, documentation, callback, labelnames=(), kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, key, (), value) for key, value in sorted(values.items()) if value is not None]
+
+
+class MetricsRegistry:
+    """Holds every metric and renders them for /api/metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, callback, labelnames=(), kind='gauge'):
+        return self.register(CallbackMetric(name, documentation, callback, labelnames, kind))
+
+    def render(self):
+        """Return all metrics in the Prometheus text format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Metrics collection error for {metric.name}: {e}")
+                continue
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for sample_name, key, extra, value in samples:
+                labels = _format_labels(metric.labelnames, key, extra)
+                lines.append(f'{sample_name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+stage_duration = registry.histogram(
+    'carbalite_stage_duration_seconds',
+    'Time spent in each stage of an extraction job',
+    ['stage']
+)
+served_bytes = registry.counter(
+    'carbalite_served_bytes_total',
+    'Artifact bytes handed to clients',
+    ['endpoint']
+)
+upstream_errors = registry.counter(
+    'carbalite_upstream_errors_total',
+    'Failures talking to upstream media sites',
+    ['source', 'type']
+)
+jobs_cancelled = registry.counter(
+    'carbalite_jobs_cancelled_total',
+    'Extraction jobs stopped before completing',
+    ['reason']
+)
+processing_paths = registry.counter(
+    'carbalite_processing_paths_total',
+    'Extraction jobs by how the output was produced (direct, copy, remux, transcode)',
+    ['path']
+)
+admission_rejections = registry.counter(
+    'carbalite_admission_rejections_total',
+    'Requests for new work refused by admission control',
+    ['reason']
+)
@@ -0,0 +1,518 @@
+"""
+Task state storage for CarbaLite
+Keeps extraction task status somewhere every worker process can see it: on this
+host (SQLite) or, for workers spread over several hosts, in Redis
+"""
+
+import os
+import json
+import time
+import heapq
+import itertools
+import sqlite3
+import threading
+from pathlib import Path
+
+TASK_STORE_BACKEND = os.getenv('CARBALITE_TASK_STORE', 'sqlite')  # 'sqlite', 'redis' or 'memory'
+TASK_STORE_PATH = Path(os.getenv('CARBALITE_TASK_DB', 'carbalite_tasks.db'))
+REDIS_URL = os.getenv('CARBALITE_REDIS_URL', 'redis://localhost:6379/0')
+REDIS_PREFIX = os.getenv('CARBALITE_REDIS_PREFIX', 'carbalite:')
+DEFAULT_TASK_TTL = 3600  # Task records expire after 1 hour unless refreshed
+TERMINAL_STATUSES = ('completed', 'error', 'cancelled')
+
+
+class TaskStore:
+    """Interface for task-state backends
+
+    Task records are JSON-serialisable dicts. Every record carries an expiry
+    timestamp so cleanup can find stale tasks without scanning everything.
+    The store also keeps the deduplication index (job key -> task_id).
+    Listeners registered with add_listener are called with the task_id after
+    every change made through this store instance.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Call callback(task_id) whenever a task is changed through this store"""
+        self._listeners.append(callback)
+
+    def _changed(self, task_id):
+        for callback in self._listeners:
+            try:
+                callback(task_id)
+            except Exception as e:
+                print(f"Task listener error: {e}")
+
+    def get(self, task_id):
+        """Return a copy of the task record, or None"""
+        raise NotImplementedError
+
+    def set(self, task_id, data, ttl=DEFAULT_TASK_TTL, keep=()):
+        """Replace the task record and reset its expiry
+
+        Fields named in keep are carried over from the current record in the
+        same atomic step, so counters other clients update concurrently
+        (e.g. attachments) survive the replacement.
+        """
+        raise NotImplementedError
+
+    def update(self, task_id, fields, ttl=None):
+        """Atomically merge fields into an existing record; returns False if it is missing
+
+        When ttl is given the record's expiry is also pushed out to now + ttl.
+        """
+        raise NotImplementedError
+
+    def compare_and_update(self, task_id, expected, fields, ttl=None):
+        """Like update, but only if every key in expected currently has that value
+
+        Lets several processes race to claim the same record with exactly one winner.
+        """
+        raise NotImplementedError
+
+    def delete(self, task_id):
+        """Remove a task record"""
+        raise NotImplementedError
+
+    def unfinished(self, limit=500):
+        """Return up to limit (task_id, record) pairs whose status is not terminal"""
+        raise NotImplementedError
+
+    def expired(self, now=None, limit=100):
+        """Return up to limit (task_id, record) pairs whose expiry has passed, oldest first"""
+        raise NotImplementedError
+
+    def count(self):
+        """Return the number of stored tasks"""
+        raise NotImplementedError
+
+    def get_job(self, job_key):
+        """Return the task_id registered for a deduplication key, or None"""
+        raise NotImplementedError
+
+    def set_job(self, job_key, task_id):
+        """Register a task_id for a deduplication key"""
+        raise NotImplementedError
+
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+
+
+class MemoryTaskStore(TaskStore):
+    """In-process task store, intended for tests and single-process development"""
+
+    def __init__(self):
+        super().__init__()
+        self._tasks = {}  # task_id -> (expires_at, data)
+        self._expiry_heap = []  # (expires_at, task_id), may hold stale entries
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, task_id):
+        with self._lock:
+            entry = self._tasks.get(task_id)
+            return json.loads(json.dumps(entry[1])) if entry else None
+
+    def set(self, task_id, data, ttl=DEFAULT_TASK_TTL, keep=()):
+        expires_at = time.time() + ttl
+        data = json.loads(json.dumps(data))
+        with self._lock:
+            current = self._tasks.get(task_id)
+            if current is not None:
+                data.update({key: current[1][key] for key in keep if key in current[1]})
+            self._tasks[task_id] = (expires_at, data)
+            heapq.heappush(self._expiry_heap, (expires_at, task_id))
+        self._changed(task_id)
+
+    def update(self, task_id, fields, ttl=None):
+        return self.compare_and_update(task_id, {}, fields, ttl)
+
+    def compare_and_update(self, task_id, expected, fields, ttl=None):
+        with self._lock:
+            entry = self._tasks.get(task_id)
+            if entry is None:
+                return False
+            if any(entry[1].get(key) != value for key, value in expected.items()):
+                return False
+            entry[1].update(json.loads(json.dumps(fields)))
+            if ttl is not None:
+                expires_at = time.time() + ttl
+                self._tasks[task_id] = (expires_at, entry[1])
+                heapq.heappush(self._expiry_heap, (expires_at, task_id))
+        self._changed(task_id)
+        return True
+
+    def delete(self, task_id):
+        with self._lock:
+            self._tasks.pop(task_id, None)
+            for job_key in [key for key, value in self._jobs.items() if value == task_id]:
+                del self._jobs[job_key]
+        self._changed(task_id)
+
+    def unfinished(self, limit=500):
+        with self._lock:
+            return [
+                (task_id, json.loads(json.dumps(data)))
+                for task_id, (_, data) in self._tasks.items()
+                if data.get('status') not in TERMINAL_STATUSES
+            ][:limit]
+
+    def expired(self, now=None, limit=100):
+        now = time.time() if now is None else now
+        result = []
+        with self._lock:
+            heap = self._expiry_heap
+            while heap and heap[0][0] <= now and len(result) < limit:
+                expires_at, task_id = heapq.heappop(heap)
+                entry = self._tasks.get(task_id)
+                # Skip heap entries superseded by a later set()
+                if entry is not None and entry[0] == expires_at:
+                    result.append((task_id, json.loads(json.dumps(entry[1]))))
+            # Put returned entries back; callers delete what they actually evict
+            for task_id, _ in result:
+                heapq.heappush(heap, (self._tasks[task_id][0], task_id))
+        return result
+
+    def count(self):
+        with self._lock:
+            return len(self._tasks)
+
+    def get_job(self, job_key):
+        with self._lock:
+            return self._jobs.get(job_key)
+
+    def set_job(self, job_key, task_id):
+        with self._lock:
+            self._jobs[job_key] = task_id
+
+
+class SQLiteTaskStore(TaskStore):
+    """SQLite task store in WAL mode, shared by every process on the host
+
+    The record's status is mirrored into its own column so unfinished() reads a
+    partial index of the few running tasks instead of parsing every row's JSON.
+    """
+
+    # Literal rather than bound, so the planner can match the partial index to the query
+    UNFINISHED_CLAUSE = 'status NOT IN ({})'.format(', '.join(f"'{status}'" for status in TERMINAL_STATUSES))
+
+    def __init__(self, path=TASK_STORE_PATH):
+        super().__init__()
+        self.path = str(path)
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')  # WAL keeps this crash-safe
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                status TEXT
+            );
+            CREATE INDEX IF NOT EXISTS tasks_expires_at ON tasks (expires_at);
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_key TEXT PRIMARY KEY,
+                task_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_task_id ON jobs (task_id);
+        ''')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(tasks)')}
+        if 'status' not in columns:
+            # Stores created before the status column: add and backfill it once
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(tasks)')}
+                if 'status' not in columns:
+                    conn.execute('ALTER TABLE tasks ADD COLUMN status TEXT')
+                    conn.execute("UPDATE tasks SET status = json_extract(data, '$.status')")
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS tasks_unfinished ON tasks (task_id) WHERE {self.UNFINISHED_CLAUSE}'
+        )
+
+    def get(self, task_id):
+        row = self._connect().execute(
+            'SELECT data FROM tasks WHERE task_id = ?', (task_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, task_id, data, ttl=DEFAULT_TASK_TTL, keep=()):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if keep:
+                row = conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+                if row is not None:
+                    current = json.loads(row[0])
+                    data = {**data, **{key: current[key] for key in keep if key in current}}
+            now = time.time()
+            conn.execute(
+                'INSERT OR REPLACE INTO tasks (task_id, data, updated_at, expires_at, status) VALUES (?, ?, ?, ?, ?)',
+                (task_id, json.dumps(data), now, now + ttl, data.get('status'))
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._changed(task_id)
+
+    def update(self, task_id, fields, ttl=None):
+        return self.compare_and_update(task_id, {}, fields, ttl)
+
+    def compare_and_update(self, task_id, expected, fields, ttl=None):
+        conn = self._connect()
+        # BEGIN IMMEDIATE takes the write lock up front so the read-modify-write is atomic
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                conn.execute('ROLLBACK')
+                return False
+            data = json.loads(row[0])
+            if any(data.get(key) != value for key, value in expected.items()):
+                conn.execute('ROLLBACK')
+                return False
+            data.update(fields)
+            now = time.time()
+            if ttl is None:
+                conn.execute(
+                    'UPDATE tasks SET data = ?, updated_at = ?, status = ? WHERE task_id = ?',
+                    (json.dumps(data), now, data.get('status'), task_id)
+                )
+            else:
+                conn.execute(
+                    'UPDATE tasks SET data = ?, updated_at = ?, expires_at = ?, status = ? WHERE task_id = ?',
+                    (json.dumps(data), now, now + ttl, data.get('status'), task_id)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._changed(task_id)
+        return True
+
+    def delete(self, task_id):
+        conn = self._connect()
+        conn.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+        conn.execute('DELETE FROM jobs WHERE task_id = ?', (task_id,))
+        self._changed(task_id)
+
+    def unfinished(self, limit=500):
+        rows = self._connect().execute(
+            f'SELECT task_id, data FROM tasks INDEXED BY tasks_unfinished WHERE {self.UNFINISHED_CLAUSE} LIMIT ?',
+            (limit,)
+        ).fetchall()
+        return [(task_id, json.loads(data)) for task_id, data in rows]
+
+    def expired(self, now=None, limit=100):
+        now = time.time() if now is None else now
+        rows = self._connect().execute(
+            'SELECT task_id, data FROM tasks WHERE expires_at <= ? ORDER BY expires_at LIMIT ?',
+            (now, limit)
+        ).fetchall()
+        return [(task_id, json.loads(data)) for task_id, data in rows]
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+
+    def get_job(self, job_key):
+        row = self._connect().execute(
+            'SELECT task_id FROM jobs WHERE job_key = ?', (job_key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_job(self, job_key, task_id):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO jobs (job_key, task_id) VALUES (?, ?)', (job_key, task_id)
+        )
+
+
+class RedisTaskStore(TaskStore):
+    """Task store in Redis (or a compatible server), shared by processes on every host
+
+    Records are JSON strings under <prefix>task:<id>; a sorted set of expiry
+    times stands in for SQLite's expires_at index, a set of non-terminal task
+    ids for its partial status index, and compare_and_update uses WATCH/MULTI
+    so concurrent claims still have exactly one winner.
+    """
+
+    SCAN_BATCH = 500
+
+    def __init__(self, url=REDIS_URL, prefix=REDIS_PREFIX):
+        super().__init__()
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis task store needs the redis package: pip install redis')
+        self._redis_errors = redis.exceptions
+        self._redis = redis.Redis.from_url(url)
+        self._expiry_key = f'{prefix}task_expiry'
+        self._unfinished_key = f'{prefix}task_unfinished'
+        self._jobs_key = f'{prefix}jobs'
+        self._prefix = prefix
+        self._index_unfinished()
+
+    def _index_unfinished(self):
+        """Fill the unfinished set once for stores written before it existed"""
+        marker = f'{self._prefix}task_unfinished_indexed'
+        if self._redis.exists(marker):
+            return
+        start = 0
+        while True:
+            task_ids = self._redis.zrange(self._expiry_key, start, start + self.SCAN_BATCH - 1)
+            if not task_ids:
+                break
+            unfinished = [
+                task_id for task_id, data in self._load_many(task_ids)
+                if data.get('status') not in TERMINAL_STATUSES
+            ]
+            if unfinished:
+                self._redis.sadd(self._unfinished_key, *unfinished)
+            start += self.SCAN_BATCH
+        self._redis.set(marker, 1)
+
+    def _track_status(self, pipe, task_id, data):
+        """Queue the unfinished-set change for the record's status on pipe"""
+        if data.get('status') in TERMINAL_STATUSES:
+            pipe.srem(self._unfinished_key, task_id)
+        else:
+            pipe.sadd(self._unfinished_key, task_id)
+
+    def _task_key(self, task_id):
+        return f'{self._prefix}task:{task_id}'
+
+    def _task_jobs_key(self, task_id):
+        return f'{self._prefix}task_jobs:{task_id}'
+
+    def get(self, task_id):
+        raw = self._redis.get(self._task_key(task_id))
+        return json.loads(raw) if raw else None
+
+    def set(self, task_id, data, ttl=DEFAULT_TASK_TTL, keep=()):
+        key = self._task_key(task_id)
+        with self._redis.pipeline() as pipe:
+            while True:
+                try:
+                    if keep:
+                        pipe.watch(key)
+                        raw = pipe.get(key)
+                        if raw is not None:
+                            current = json.loads(raw)
+                            data = {**data, **{name: current[name] for name in keep if name in current}}
+                    pipe.multi()
+                    pipe.set(key, json.dumps(data))
+                    pipe.zadd(self._expiry_key, {task_id: time.time() + ttl})
+                    self._track_status(pipe, task_id, data)
+                    pipe.execute()
+                    break
+                except self._redis_errors.WatchError:
+                    continue
+        self._changed(task_id)
+
+    def update(self, task_id, fields, ttl=None):
+        return self.compare_and_update(task_id, {}, fields, ttl)
+
+    def compare_and_update(self, task_id, expected, fields, ttl=None):
+        key = self._task_key(task_id)
+        with self._redis.pipeline() as pipe:
+            while True:
+                try:
+                    # WATCH makes EXEC fail if anyone else writes the record in between
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    if raw is None:
+                        pipe.unwatch()
+                        return False
+                    data = json.loads(raw)
+                    if any(data.get(name) != value for name, value in expected.items()):
+                        pipe.unwatch()
+                        return False
+                    data.update(fields)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(data))
+                    if 'status' in fields:
+                        self._track_status(pipe, task_id, data)
+                    if ttl is not None:
+                        pipe.zadd(self._expiry_key, {task_id: time.time() + ttl})
+                    pipe.execute()
+                    break
+                except self._redis_errors.WatchError:
+                    continue
+        self._changed(task_id)
+        return True
+
+    def delete(self, task_id):
+        job_keys = self._redis.smembers(self._task_jobs_key(task_id))
+        pipe = self._redis.pipeline()
+        pipe.delete(self._task_key(task_id), self._task_jobs_key(task_id))
+        pipe.zrem(self._expiry_key, task_id)
+        pipe.srem(self._unfinished_key, task_id)
+        if job_keys:
+            pipe.hdel(self._jobs_key, *job_keys)
+        pipe.execute()
+        self._changed(task_id)
+
+    def _load_many(self, task_ids):
+        task_ids = [task_id.decode() if isinstance(task_id, bytes) else task_id for task_id in task_ids]
+        if not task_ids:
+            return []
+        raws = self._redis.mget([self._task_key(task_id) for task_id in task_ids])
+        return [(task_id, json.loads(raw)) for task_id, raw in zip(task_ids, raws) if raw]
+
+    def unfinished(self, limit=500):
+        task_ids = list(itertools.islice(self._redis.sscan_iter(self._unfinished_key, count=self.SCAN_BATCH), limit))
+        records = self._load_many(task_ids)
+        result = [(task_id, data) for task_id, data in records if data.get('status') not in TERMINAL_STATUSES]
+        # Ids whose record is gone or already finished, e.g. left by a writer that died mid-way
+        stale = set(task_id.decode() if isinstance(task_id, bytes) else task_id for task_id in task_ids)
+        stale.difference_update(task_id for task_id, _ in result)
+        if stale:
+            self._redis.srem(self._unfinished_key, *stale)
+        return result
+
+    def expired(self, now=None, limit=100):
+        now = time.time() if now is None else now
+        task_ids = self._redis.zrangebyscore(self._expiry_key, '-inf', now, start=0, num=limit)
+        return self._load_many(task_ids)
+
+    def count(self):
+        return self._redis.zcard(self._expiry_key)
+
+    def get_job(self, job_key):
+        task_id = self._redis.hget(self._jobs_key, job_key)
+        return task_id.decode() if task_id else None
+
+    def set_job(self, job_key, task_id):
+        pipe = self._redis.pipeline()
+        pipe.hset(self._jobs_key, job_key, task_id)
+        pipe.sadd(self._task_jobs_key(task_id), job_key)
+        pipe.execute()
+
+
+def create_task_store(backend=TASK_STORE_BACKEND, path=TASK_STORE_PATH):
+    """Build the configured task store"""
+    if backend == 'memory':
+        return MemoryTaskStore()
+    if backend == 'sqlite':
+        return SQLiteTaskStore(path)
+    if backend == 'redis':
+        return RedisTaskStore()
+    raise ValueError(f"Unknown task store backend: {backend}")
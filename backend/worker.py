@@ -0,0 +1,142 @@
+"""
+carbalite-worker: runs extraction jobs from the external job queue
+Claims jobs queued by the web processes (CARBALITE_JOB_QUEUE=sqlite or redis),
+runs the download and transcode stages here and publishes progress through
+the shared task store, so the API and the workers scale separately. Start as
+many as the network and CPUs allow, on one host (sqlite) or several (redis,
+with CARBALITE_TASK_STORE=redis and CARBALITE_ARTIFACT_STORE=s3).
+
+Usage (from backend/):
+    CARBALITE_JOB_QUEUE=redis CARBALITE_TASK_STORE=redis python worker.py --concurrency 8
+"""
+
+import sys
+import time
+import signal
+import argparse
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import app as carbalite
+from job_queue import WORKER_HEARTBEAT_INTERVAL
+
+SHARED_QUEUE_BACKENDS = ('sqlite', 'redis')
+
+
+class Worker:
+    """Claim loop threads plus a heartbeat, all under this process's worker_id"""
+
+    def __init__(self, broker, concurrency, poll_interval):
+        self.broker = broker
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.worker_id = carbalite.current_worker_id()
+        self.completed_jobs = 0
+        self._stopping = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.broker.heartbeat(self.worker_id, self.concurrency, carbalite.admission.worker_load())  # Alive before the first claim
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name='carbalite-worker-heartbeat')
+        heartbeat.daemon = True
+        heartbeat.start()
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._claim_loop, name=f'carbalite-worker-{i}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        print(f"Worker {self.worker_id} running {self.concurrency} job(s) at a time "
+              f"from the {carbalite.JOB_QUEUE_BACKEND} queue")
+
+    def stop(self, *_):
+        self._stopping.set()
+
+    def wait(self):
+        while not self._stopping.wait(1):
+            pass
+
+    def _heartbeat_loop(self):
+        # Keeps beating while draining, so running jobs are not handed to another worker
+        while True:
+            time.sleep(WORKER_HEARTBEAT_INTERVAL)
+            try:
+                # Published so the web tier's admission control sees this host's ffmpeg and disk load
+                self.broker.heartbeat(self.worker_id, self.concurrency, carbalite.admission.worker_load())
+            except Exception as e:
+                print(f"Worker heartbeat error: {e}")
+
+    def _claim_loop(self):
+        while not self._stopping.is_set():
+            try:
+                claimed = self.broker.claim(self.worker_id)
+            except Exception as e:
+                print(f"Job queue error: {e}")
+                claimed = None
+            if claimed is None:
+                self._stopping.wait(self.poll_interval)
+                continue
+            self._run(*claimed)
+
+    def _run(self, task_id, job):
+        # Owning the task record is what lets the job be resumed elsewhere if this process dies
+        # after the ack, e.g. while the transcode stage is still running
+        if not carbalite.extractor.tasks.update(task_id, {'worker_id': self.worker_id}):
+            self.broker.ack(task_id)  # Deleted while it was queued
+            return
+        try:
+            carbalite.run_queued_job(task_id, job)
+        except Exception as e:
+            print(f"Job {task_id} failed: {e}")
+        finally:
+            self.broker.ack(task_id)
+            with self._lock:
+                self.completed_jobs += 1
+
+    def drain(self, timeout):
+        """Let claimed jobs finish, then hand back any still running after timeout"""
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.time()))
+        # The next worker to claim these takes over the task record; their threads here die with the process
+        released = self.broker.release(self.worker_id)
+        if released:
+            print(f"Returned {len(released)} unfinished job(s) to the queue")
+        print(f"Worker {self.worker_id} stopped after {self.completed_jobs} job(s)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='carbalite-worker', description='Run CarbaLite extraction jobs from the external job queue'
+    )
+    parser.add_argument('--concurrency', type=int, default=carbalite.JOB_WORKERS,
+                        help='Jobs downloading at once (transcodes use CARBALITE_TRANSCODE_WORKERS)')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='Seconds to wait before asking again when the queue is empty')
+    parser.add_argument('--drain-timeout', type=float, default=carbalite.SHUTDOWN_DRAIN_TIMEOUT,
+                        help='Seconds running jobs get to finish on SIGTERM before they are re-queued')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # 'local' has no broker and 'memory' is private to one process, so neither can receive jobs from the web tier
+    if carbalite.JOB_QUEUE_BACKEND not in SHARED_QUEUE_BACKENDS:
+        sys.exit('carbalite-worker needs a shared job queue: set CARBALITE_JOB_QUEUE to sqlite or redis')
+
+    # Expiry cleanup, disk quota and resuming jobs from dead workers run here too
+    carbalite.start_background_tasks()
+    worker = Worker(carbalite.job_broker, args.concurrency, args.poll_interval)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.start()
+    worker.wait()
+
+    print("Stopping: no new jobs will be claimed")
+    worker.drain(args.drain_timeout)
+
+
+if __name__ == '__main__':
+    main()
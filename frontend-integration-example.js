@@ -69,7 +69,7 @@ class CarbaLiteClient {
     return await response.json();
   }
 
-  async waitForExtraction(taskId, onProgress = null) {
+  async pollForExtraction(taskId, onProgress = null) {
     while (true) {
       const status = await this.getStatus(taskId);
       
@@ -79,7 +79,7 @@ class CarbaLiteClient {
       
       if (status.status === 'completed') {
         return status;
-      } else if (status.status === 'error') {
+      } else if (status.status === 'error' || status.status === 'cancelled') {
         throw new Error(status.message);
       }
       
@@ -88,6 +88,41 @@ class CarbaLiteClient {
     }
   }
 
+  waitForExtraction(taskId, onProgress = null) {
+    // Fall back to polling where Server-Sent Events are not available
+    if (typeof EventSource === 'undefined') {
+      return this.pollForExtraction(taskId, onProgress);
+    }
+
+    return new Promise((resolve, reject) => {
+      const events = new EventSource(`${this.backendUrl}/api/status/${taskId}/events`);
+      let finished = false;
+
+      events.addEventListener('status', (event) => {
+        const status = JSON.parse(event.data);
+        if (onProgress) {
+          onProgress(status);
+        }
+        if (status.status === 'completed') {
+          finished = true;
+          events.close();
+          resolve(status);
+        } else if (status.status === 'error' || status.status === 'cancelled') {
+          finished = true;
+          events.close();
+          reject(new Error(status.message));
+        }
+      });
+
+      events.onerror = () => {
+        if (finished) return;
+        // Stream refused (connection cap) or dropped: switch to polling
+        events.close();
+        this.pollForExtraction(taskId, onProgress).then(resolve, reject);
+      };
+    });
+  }
+
   async downloadRawMedia(taskId) {
     const response = await fetch(`${this.backendUrl}/api/stream/${taskId}`);
     
@@ -1,4 +1,4 @@
-import { useState, useCallback } from 'react';
+import { useState, useCallback, useRef } from 'react';
 
 // Types for the hook
 export interface VideoInfo {
@@ -82,6 +82,78 @@ class CarbaLiteClient {
     return await response.json();
   }
 
+  // Stop a queued or running extraction so it no longer holds a worker. Resolves with
+  // status 'detached' when other clients share the task: it keeps running for them
+  async cancelTask(taskId: string): Promise<any> {
+    const response = await fetch(`${this.backendUrl}/tasks/${taskId}`, { method: 'DELETE' });
+    
+    if (!response.ok) {
+      throw new Error(`Cancel failed: ${response.statusText}`);
+    }
+    
+    return await response.json();
+  }
+
+  // Resolve with the final status, using Server-Sent Events when available
+  // and falling back to 1-second polling if the stream is unavailable.
+  // Aborting the signal stops watching and rejects
+  waitForCompletion(taskId: string, onUpdate: (status: any) => void, signal?: AbortSignal): Promise<any> {
+    return new Promise((resolve, reject) => {
+      let events: EventSource | null = null;
+      signal?.addEventListener('abort', () => {
+        events?.close();
+        reject(new Error('Cancelled'));
+      });
+
+      const settle = (statusResponse: any) => {
+        if (signal?.aborted) return true;
+        onUpdate(statusResponse);
+        if (statusResponse.status === 'completed') {
+          resolve(statusResponse);
+          return true;
+        }
+        if (statusResponse.status === 'error' || statusResponse.status === 'cancelled') {
+          reject(new Error(statusResponse.message || 'Extraction failed'));
+          return true;
+        }
+        return false;
+      };
+
+      const poll = async () => {
+        while (!signal?.aborted) {
+          try {
+            if (settle(await this.getStatus(taskId))) return;
+          } catch (statusError) {
+            console.error('Status check error:', statusError);
+            // Continue polling, might be a temporary network issue
+          }
+          await new Promise(r => setTimeout(r, 1000));
+        }
+      };
+
+      if (typeof EventSource === 'undefined') {
+        poll();
+        return;
+      }
+
+      const stream = new EventSource(`${this.backendUrl}/status/${taskId}/events`);
+      events = stream;
+      let finished = false;
+      stream.addEventListener('status', (event: MessageEvent) => {
+        if (settle(JSON.parse(event.data))) {
+          finished = true;
+          stream.close();
+        }
+      });
+      stream.onerror = () => {
+        if (finished || signal?.aborted) return;
+        // Connection cap reached or stream unsupported by this deployment
+        stream.close();
+        poll();
+      };
+    });
+  }
+
   async downloadFile(taskId: string): Promise<ArrayBuffer> {
     const response = await fetch(`${this.backendUrl}/download/${taskId}`);
     
@@ -122,6 +194,8 @@ const useCarbaLite = () => {
   });
 
   const client = new CarbaLiteClient();
+  const taskIdRef = useRef<string | null>(null);
+  const watchRef = useRef<AbortController | null>(null);
 
   const updateStatus = useCallback((newStatus: Partial<DownloadStatus>) => {
     setStatus(prev => ({ ...prev, ...newStatus }));
@@ -156,6 +230,7 @@ const useCarbaLite = () => {
       // Step 2: Start extraction
       const extraction = await client.extractMedia(url, options);
       const taskId = extraction.task_id;
+      taskIdRef.current = taskId;
 
       updateStatus({
         stage: 'extracting',
@@ -163,54 +238,43 @@ const useCarbaLite = () => {
         progress: 30
       });
 
-      // Step 3: Poll for completion
-      let extractionComplete = false;
-      while (!extractionComplete) {
-        await new Promise(resolve => setTimeout(resolve, 1000));
-        
-        try {
-          const statusResponse = await client.getStatus(taskId);
-          
+      // Step 3: Wait for completion (server push, polling fallback)
+      watchRef.current = new AbortController();
+      try {
+        await client.waitForCompletion(taskId, (statusResponse) => {
           updateStatus({
             stage: 'extracting',
             message: statusResponse.message || 'Processing...',
             progress: Math.min(statusResponse.progress || 30, 80)
           });
-
-          if (statusResponse.status === 'completed') {
-            extractionComplete = true;
-            
-            updateStatus({
-              stage: 'downloading',
-              message: 'Downloading file...',
-              progress: 90
-            });
-
-            // Step 4: Download the file
-            const fileData = await client.downloadFile(taskId);
-            const filename = client.generateFilename(
-              validation.video_info.title, 
-              options.type
-            );
-
-            // Step 5: Trigger download
-            client.downloadBlob(fileData, filename);
-
-            updateStatus({
-              stage: 'completed',
-              message: 'Download completed successfully!',
-              progress: 100
-            });
-
-          } else if (statusResponse.status === 'error') {
-            throw new Error(statusResponse.message || 'Extraction failed');
-          }
-        } catch (statusError) {
-          console.error('Status check error:', statusError);
-          // Continue polling, might be a temporary network issue
-        }
+        }, watchRef.current.signal);
+      } finally {
+        taskIdRef.current = null;
+        watchRef.current = null;
       }
 
+      updateStatus({
+        stage: 'downloading',
+        message: 'Downloading file...',
+        progress: 90
+      });
+
+      // Step 4: Download the file
+      const fileData = await client.downloadFile(taskId);
+      const filename = client.generateFilename(
+        validation.video_info.title, 
+        options.type
+      );
+
+      // Step 5: Trigger download
+      client.downloadBlob(fileData, filename);
+
+      updateStatus({
+        stage: 'completed',
+        message: 'Download completed successfully!',
+        progress: 100
+      });
+
     } catch (error: any) {
       console.error('Process media error:', error);
       updateStatus({
@@ -223,9 +287,26 @@ const useCarbaLite = () => {
     }
   }, [updateStatus]);
 
+  // Stop the running extraction; waitForCompletion then rejects with the 'cancelled' status.
+  // A task shared with other clients keeps running, so stop watching it here instead
+  const cancel = useCallback(async () => {
+    const taskId = taskIdRef.current;
+    if (!taskId) return;
+    updateStatus({ message: 'Cancelling...' });
+    try {
+      const result = await client.cancelTask(taskId);
+      if (result.status === 'detached') {
+        watchRef.current?.abort();
+      }
+    } catch (error) {
+      console.error('Cancel error:', error);
+    }
+  }, [updateStatus]);
+
   return {
     status,
     processMedia,
+    cancel,
     reset
   };
 };